@@ -1,5 +1,7 @@
 import importlib
 from image.sentinel import ImageStack, BufferedImageStack, load_buffered_stack_bands
+from image.cache import load_cached_stack_bands
+from active_fire.general import transform_by_blocks
 from shapely.geometry import Point
 import rasterio
 import geopandas as gpd
@@ -8,6 +10,9 @@ import os
 # Cache used to minimize IO
 DATAFRAME_BIOME_CACHE = {}
 
+# Bands used by the biome methods
+BIOME_BANDS = (4, 11, 12)
+
 BIOME_TO_AFD_MAP = {
     'Tropical & Subtropical Moist Broadleaf Forests' : 'TropicalMoistForest',
     'Tropical & Subtropical Dry Broadleaf Forests' : 'TropicalDryForest',
@@ -32,6 +37,12 @@ BIOME_TO_AFD_MAP = {
 
 class BiomeAFD:
 
+    # Coefficients of the criteria 1: B4 <= (a * B12) + b
+    coefficient_a = None
+    coefficient_b = None
+    # The methods are pixel-wise (see active_fire.general.transform_by_blocks)
+    halo = 0
+
     def criteria_1(self, b4, b12, coefficient_a, coefficient_b):
         c1 = (b4 <= (coefficient_a * b12 + coefficient_b))
         return c1
@@ -44,8 +55,29 @@ class BiomeAFD:
         c3 = (b11 >= coefficient_c) | (b12 >= coefficient_d)
         return c3
 
+    def block_prefilter(self, block_stats, **kwargs):
+        """Blocks that can have detections (see image.blocks.BlockStats).
+        The criteria 1 needs min(B4) <= a * max(B12) + b in the block (a > 0).
+        """
+        # Tolerance for the rounding of the criteria
+        return block_stats.minimum[4] <= (self.coefficient_a * block_stats.maximum[12] + self.coefficient_b + 1e-6)
+
+    def additional_criteria(self, buffered_img : BufferedImageStack):
+        """Criteria combined (AND) with the criteria 1 by the method (C2, C3...).
+
+        Args:
+            buffered_img (BufferedImageStack): Image buffer with the bands loaded
+
+        Returns:
+            np.array: mask of the additional criteria or None if the method uses only the criteria 1
+        """
+        return None
+
 class TropicalMoistForestAFD(BiomeAFD):
 
+    coefficient_a = 1.045
+    coefficient_b = -0.071
+
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an active fire detection mask for Tropical & Subtropical Moist Broadleaf Forests
         C1 = B4 <= (1.045 * B12) - 0.071
@@ -59,16 +91,28 @@ class TropicalMoistForestAFD(BiomeAFD):
             np.array: active fire mask
         """
         b4 = buffered_img.read(4)
-        b11 = buffered_img.read(11)
         b12 = buffered_img.read(12)
 
-        c1 = super().criteria_1(b4, b12, 1.045, -0.071)
-        c2 = super().criteria_2(b12/b11, 1)
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
+        c2 = self.additional_criteria(buffered_img)
 
         return (c1 & c2)
 
+    def additional_criteria(self, buffered_img : BufferedImageStack):
+        b11 = buffered_img.read(11)
+        b12 = buffered_img.read(12)
+
+        return super().criteria_2(b12/b11, 1)
+
+    def block_prefilter(self, block_stats, **kwargs):
+        # C2 needs B12 >= B11
+        return super().block_prefilter(block_stats) & (block_stats.maximum[12] >= block_stats.minimum[11])
+
 
 class TropicalDryForestAFD(BiomeAFD):
+
+    coefficient_a = 0.681
+    coefficient_b = -0.052
     
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an activa fire detection mask for Tropical & Subtropical Dry Broadleaf Forests
@@ -83,11 +127,14 @@ class TropicalDryForestAFD(BiomeAFD):
         b4 = buffered_img.read(4)
         b12 = buffered_img.read(12)
 
-        c1 = super().criteria_1(b4, b12, 0.681, -0.052)
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
         return c1
 
 class SavannaAFD(BiomeAFD):
 
+    coefficient_a = 0.677
+    coefficient_b = -0.052
+
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an activa fire detection mask for Tropical & Subtropical Grassland, Savannas & Shrublands
         mask = B4 <= (0.677 * B12) - 0.052
@@ -101,10 +148,13 @@ class SavannaAFD(BiomeAFD):
         b4 = buffered_img.read(4)
         b12 = buffered_img.read(12)
         
-        c1 = super().criteria_1(b4, b12, 0.677, -0.052)
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
         return c1
 
 class MediterraneanForestAFD(BiomeAFD):
+
+    coefficient_a = 0.743
+    coefficient_b = -0.068
     
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an activa fire detection mask for Mediterranean Forests, Woodlands & Scrub
@@ -120,20 +170,36 @@ class MediterraneanForestAFD(BiomeAFD):
             np.array: active fire mask
         """
         b4 = buffered_img.read(4)
+        b12 = buffered_img.read(12)
+
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
+        meta = buffered_img.metas[12]
+        meta.update(count=1)
+
+        return (c1 & self.additional_criteria(buffered_img))
+
+    def additional_criteria(self, buffered_img : BufferedImageStack):
         b11 = buffered_img.read(11)
         b12 = buffered_img.read(12)
 
-        c1 = super().criteria_1(b4, b12, 0.743, -0.068)
         c2 = super().criteria_2(b12, 0.355)
         c3 = super().criteria_3(b11, b12, 0.475, 1.0)
-        meta = buffered_img.metas[12]
-        meta.update(count=1)
 
-        return (c1 & c2 & c3)
+        return (c2 & c3)
+
+    def block_prefilter(self, block_stats, **kwargs):
+        # C2 needs B12 >= 0.355 and C3 needs B11 >= 0.475 or B12 >= 1.0
+        c2 = block_stats.maximum[12] >= 0.355
+        c3 = (block_stats.maximum[11] >= 0.475) | (block_stats.maximum[12] >= 1.0)
+
+        return super().block_prefilter(block_stats) & c2 & c3
 
 
 class ConiferForestAFD(BiomeAFD):
 
+    coefficient_a = 0.504
+    coefficient_b = -0.198
+
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an activa fire detection mask for Temperate Conifer Forests
         mask = B4 <= (0.504 * B12) - 0.198
@@ -147,12 +213,15 @@ class ConiferForestAFD(BiomeAFD):
         b4 = buffered_img.read(4)
         b12 = buffered_img.read(12)
         
-        c1 = super().criteria_1(b4, b12, 0.504, -0.198)
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
         return c1
 
     
 class TaigaAFD(BiomeAFD):
 
+    coefficient_a = 0.727
+    coefficient_b = -0.11
+
     def transform(self, buffered_img : BufferedImageStack):
         """Generate an activa fire detection mask for Boreal Forests/Taiga
         mask = B4 <= (0.727 * B12) - 0.11
@@ -166,46 +235,88 @@ class TaigaAFD(BiomeAFD):
         b4 = buffered_img.read(4)
         b12 = buffered_img.read(12)
         
-        c1 = super().criteria_1(b4, b12, 0.727, -0.11)
+        c1 = super().criteria_1(b4, b12, self.coefficient_a, self.coefficient_b)
         return c1
 
 
 
-def resolve_biome_and_apply_afd(biome_shape_file, image_dir, stack_partial_name, biome_column_name='BIOME_NAME'):
+def resolve_biome(biome_shape_file, buffered_stack : BufferedImageStack, biome_column_name='BIOME_NAME'):
     """Find out the biome of the image based on the central pixel.
-    The biome shapefile with the biomes geometry will be stored in the memory, if the same file is read more than once, the memory copy will be used, reducing IO.
-    The images stack must be stored in the image_dir.
+    The biome shapefile is stored in the memory (one copy per CRS), if the same file is read more than once, the memory copy will be used, reducing IO.
 
     Args:
         biome_shape_file (str): shape file with the biomes geometry
-        image_dir (str): path where the images stack are stored
-        stack_partial_name (str): name of the stack without the spatial resolution sufix
+        buffered_stack (BufferedImageStack): image with at least one band loaded
         biome_column_name (str, optional): Column name where the biome name is stored. Defaults to 'BIOME_NAME'.
 
     Returns:
-        tuple(np.array, BufferedStackImage): active fire mask and the buffer with the Sentinel bands  
+        str: biome name
     """
-
-    bands = (4, 11, 12) 
-    buffered_stack = load_buffered_stack_bands(image_dir, stack_partial_name, bands)
-    buffered_stack.apply_valid_data_mask_to_stack()
+    first_band = next(iter(buffered_stack.metas))
+    crs = buffered_stack.metas[first_band]['crs']
 
     # Load the geometries
-    if biome_shape_file in DATAFRAME_BIOME_CACHE:
+    cache_key = (biome_shape_file, str(crs))
+    if cache_key in DATAFRAME_BIOME_CACHE:
         # Load from cache
-        df = DATAFRAME_BIOME_CACHE[biome_shape_file].copy()
+        df = DATAFRAME_BIOME_CACHE[cache_key]
     else:
         df = gpd.read_file(biome_shape_file)
-        df = df.to_crs(buffered_stack.metas[12]['crs'])
+        df = df.to_crs(crs)
         # Remove invalid geometry
         df = df[ df['geometry'].is_valid ].reset_index()
         # Store in cache
-        DATAFRAME_BIOME_CACHE[biome_shape_file] = df.copy()
-    
-    center_point = Point(buffered_stack.get_center_coord_band())
-    biome = df[df.contains(center_point)][biome_column_name].iloc[0]
+        DATAFRAME_BIOME_CACHE[cache_key] = df
 
-    if len(biome) == 0 or biome not in BIOME_TO_AFD_MAP:
+    center_point = Point(buffered_stack.get_center_coord_band(first_band))
+    biomes = df[df.contains(center_point)][biome_column_name]
+
+    if len(biomes) == 0:
+        raise Exception('Biome not found in the shapefile')
+
+    return biomes.iloc[0]
+
+
+def load_biome_bands(image_dir, stack_partial_name, cache_dir=None):
+    """Load the bands of the biome methods from the image stacks, with the nodata mask applied to each band.
+
+    Args:
+        image_dir (str): path where the images stack are stored
+        stack_partial_name (str): name of the stack without the spatial resolution sufix
+        cache_dir (str, optional): directory of the band cache (see image.cache). Defaults to None (no cache).
+
+    Returns:
+        BufferedImageStack: bands loaded
+    """
+    buffered_stack = load_cached_stack_bands(cache_dir, image_dir, stack_partial_name, BIOME_BANDS)
+    buffered_stack.apply_valid_data_mask_to_stack()
+
+    return buffered_stack
+
+
+def resolve_biome_and_apply_afd(biome_shape_file, image_dir, stack_partial_name, biome_column_name='BIOME_NAME', cache_dir=None, use_blocks=False, buffered_stack=None):
+    """Find out the biome of the image based on the central pixel.
+    The biome shapefile with the biomes geometry will be stored in the memory, if the same file is read more than once, the memory copy will be used, reducing IO.
+    The images stack must be stored in the image_dir.
+
+    Args:
+        biome_shape_file (str): shape file with the biomes geometry
+        image_dir (str): path where the images stack are stored
+        stack_partial_name (str): name of the stack without the spatial resolution sufix
+        biome_column_name (str, optional): Column name where the biome name is stored. Defaults to 'BIOME_NAME'.
+        cache_dir (str, optional): directory of the band cache (see image.cache). Defaults to None (no cache).
+        use_blocks (bool, optional): apply the method only to the blocks that can have detections (see active_fire.general.transform_by_blocks). Defaults to False.
+        buffered_stack (BufferedImageStack, optional): bands already loaded (see load_biome_bands). Defaults to None (loaded from the stack).
+
+    Returns:
+        tuple(np.array, BufferedStackImage): active fire mask and the buffer with the Sentinel bands  
+    """
+    if buffered_stack is None:
+        buffered_stack = load_biome_bands(image_dir, stack_partial_name, cache_dir)
+
+    biome = resolve_biome(biome_shape_file, buffered_stack, biome_column_name)
+
+    if biome not in BIOME_TO_AFD_MAP:
         raise Exception('Biome not found in the shapefile')
 
     if BIOME_TO_AFD_MAP[biome] == '':
@@ -216,10 +327,13 @@ def resolve_biome_and_apply_afd(biome_shape_file, image_dir, stack_partial_name,
     algorithm = getattr(module, '{}AFD'.format(BIOME_TO_AFD_MAP[biome]))
     algorithm = algorithm()
 
+    if use_blocks:
+        return transform_by_blocks(algorithm, buffered_stack), buffered_stack
+
     return algorithm.transform(buffered_stack), buffered_stack
 
 
-def apply_biome_afd(biome_name, image_dir, stack_partial_name):
+def apply_biome_afd(biome_name, image_dir, stack_partial_name, cache_dir=None, use_blocks=False, buffered_stack=None):
     """Apply an biome method to segmentate Active Fire  in a Sentinel image.
     It will load the image channels from the stack and apply the specified method.
     An stack has all channels to a specific spatial resolution.
@@ -229,6 +343,9 @@ def apply_biome_afd(biome_name, image_dir, stack_partial_name):
         biome_name (str): Biome method's name
         image_dir (str): Path to the image stack
         stack_partial_name (str): Stack partial name (without the spacial resolution sufix)
+        cache_dir (str, optional): directory of the band cache (see image.cache). Defaults to None (no cache).
+        use_blocks (bool, optional): apply the method only to the blocks that can have detections (see active_fire.general.transform_by_blocks). Defaults to False.
+        buffered_stack (BufferedImageStack, optional): bands already loaded (see load_biome_bands). Defaults to None (loaded from the stack).
 
     Returns:
         tuple: The mask and the sentinel image buffer
@@ -238,8 +355,10 @@ def apply_biome_afd(biome_name, image_dir, stack_partial_name):
     algorithm = algorithm()
 
     # Load the bands needed from the image stacks
-    bands = (4, 11, 12) 
-    buffered_stack = load_buffered_stack_bands(image_dir, stack_partial_name, bands)
-    buffered_stack.apply_valid_data_mask_to_stack()
+    if buffered_stack is None:
+        buffered_stack = load_biome_bands(image_dir, stack_partial_name, cache_dir)
     
+    if use_blocks:
+        return transform_by_blocks(algorithm, buffered_stack), buffered_stack
+
     return algorithm.transform(buffered_stack), buffered_stack
@@ -0,0 +1,322 @@
+''' Calibration of the active fire methods over many labelled images.
+Each image is reduced, in parallel, to compact sufficient statistics (sparse joint histograms of the bands and the label,
+or histograms of a continuous index). The parameter grid is searched over the statistics instead of the pixels,
+so a new search does not read the images again.
+'''
+import importlib
+import numpy as np
+from PIL import Image
+from joblib import Parallel, delayed
+
+from image.cache import load_cached_stack_bands
+from image.sentinel import QUANTIFICATION_VALUE, SATURATION_VALUE
+from image.histogram import JointHistogram
+from active_fire.tuning import ThresholdSweep
+from active_fire.metrics import scores_from_counts
+from utils.metadata import get_image_metadata
+
+LABEL = 'label'
+
+
+def load_sample(sample, bands, cache_dir=None):
+    """Load the bands and the ground truth mask of a labelled sample.
+
+    Args:
+        sample (dict): sample with the keys 'image_dir', 'stack' (stack partial name) and 'mask' (ground truth image).
+            Optionally 'mtd_tl' and 'mtd_msil' (metadata xml)
+        bands (tuple): bands to load
+        cache_dir (str, optional): directory of the band cache (see image.cache). Defaults to None.
+
+    Returns:
+        tuple: BufferedImageStack, ground truth (bool) and metadata (or None)
+    """
+    buffered_stack = load_cached_stack_bands(cache_dir, sample['image_dir'], sample['stack'], bands)
+    ground_truth = np.array(Image.open(sample['mask'])) > 0
+    if ground_truth.ndim == 3:
+        ground_truth = ground_truth.any(axis=-1)
+
+    metadata = None
+    if 'mtd_tl' in sample and 'mtd_msil' in sample:
+        metadata = get_image_metadata(sample['mtd_tl'], sample['mtd_msil'])
+
+    return buffered_stack, ground_truth, metadata
+
+
+def get_label_histogram(bands):
+    """Joint histogram of the label and the bands. The reflectance is kept without loss (the thresholds are searched on it).
+    """
+    num_bands = len(bands)
+    return JointHistogram((LABEL,) + tuple(bands), scales=(1,) + (QUANTIFICATION_VALUE,) * num_bands, max_codes=(1,) + (SATURATION_VALUE,) * num_bands)
+
+
+def sample_band_statistics(sample, bands, precondition=None, precondition_bands=(), cache_dir=None):
+    """Compute the joint histogram of (label, bands) of a sample.
+    The pixels that can never be detected (invalid data or outside the precondition) are only counted.
+
+    Args:
+        sample (dict): labelled sample (see load_sample)
+        bands (tuple): bands of the histogram
+        precondition (callable, optional): function(buffered_stack) returning the pixels that can be detected (or None). Defaults to None.
+        precondition_bands (tuple, optional): other bands needed by the precondition. Defaults to ().
+        cache_dir (str, optional): directory of the band cache. Defaults to None.
+
+    Returns:
+        tuple: JointHistogram, number of undetectable fire pixels and number of undetectable background pixels
+    """
+    load_bands = tuple(bands) + tuple(band for band in precondition_bands if band not in bands)
+    buffered_stack, ground_truth, _ = load_sample(sample, load_bands, cache_dir)
+
+    detectable = buffered_stack.read_mask()
+    if precondition is not None:
+        criteria = precondition(buffered_stack)
+        if criteria is not None:
+            detectable = detectable & criteria
+
+    histogram = get_label_histogram(bands)
+    histogram.update([ground_truth] + [buffered_stack.read(band) for band in bands], mask=detectable)
+
+    num_fire = int(np.count_nonzero(ground_truth))
+    num_fire_detectable = int(np.count_nonzero(ground_truth & detectable))
+    num_detectable = int(np.count_nonzero(detectable))
+
+    undetectable_fire = num_fire - num_fire_detectable
+    undetectable_background = (ground_truth.size - num_detectable) - undetectable_fire
+
+    return histogram, undetectable_fire, undetectable_background
+
+
+def sample_index_statistics(sample, bands, index_function, thresholds, cache_dir=None):
+    """Compute the histograms of a continuous index (see active_fire.tuning.ThresholdSweep) of a sample.
+
+    Args:
+        sample (dict): labelled sample (see load_sample)
+        bands (tuple): bands needed by the index
+        index_function (callable): function(buffered_stack, metadata) returning the continuous index
+        thresholds (np.array): thresholds evaluated
+        cache_dir (str, optional): directory of the band cache. Defaults to None.
+
+    Returns:
+        ThresholdSweep: histograms of the sample
+    """
+    buffered_stack, ground_truth, metadata = load_sample(sample, bands, cache_dir)
+    index = index_function(buffered_stack, metadata)
+
+    return ThresholdSweep(thresholds).update(index, ground_truth, buffered_stack.read_mask())
+
+
+class BandStatistics:
+
+    def __init__(self, histogram : JointHistogram, undetectable_fire=0, undetectable_background=0) -> None:
+        """Sufficient statistics of many samples to calibrate pixel-wise methods.
+
+        Args:
+            histogram (JointHistogram): joint histogram of the label and the bands of the detectable pixels
+            undetectable_fire (int, optional): fire pixels that can never be detected. Defaults to 0.
+            undetectable_background (int, optional): background pixels that can never be detected. Defaults to 0.
+        """
+        self.histogram = histogram
+        self.undetectable_fire = undetectable_fire
+        self.undetectable_background = undetectable_background
+
+        labels = histogram.get_codes(LABEL).astype(bool)
+        self.fire_counts = np.where(labels, histogram.counts, 0).astype(np.int64)
+        self.background_counts = np.where(labels, 0, histogram.counts).astype(np.int64)
+
+    @classmethod
+    def collect(cls, samples, bands, precondition=None, precondition_bands=(), cache_dir=None, n_jobs=-2):
+        """Compute the statistics of the samples in parallel and merge them.
+
+        Args:
+            samples (list): labelled samples (see load_sample)
+            bands (tuple): bands of the histogram
+            precondition (callable, optional): function(buffered_stack) returning the pixels that can be detected (or None). Defaults to None.
+            precondition_bands (tuple, optional): other bands needed by the precondition. Defaults to ().
+            cache_dir (str, optional): directory of the band cache. Defaults to None.
+            n_jobs (int, optional): number of parallel jobs. Defaults to -2.
+
+        Returns:
+            BandStatistics: merged statistics
+        """
+        results = Parallel(n_jobs=n_jobs, verbose=0)(
+            delayed(sample_band_statistics)(sample, bands, precondition, precondition_bands, cache_dir) for sample in samples
+        )
+
+        histogram = get_label_histogram(bands)
+        undetectable_fire = 0
+        undetectable_background = 0
+        for sample_histogram, sample_fire, sample_background in results:
+            histogram.merge(sample_histogram)
+            undetectable_fire += sample_fire
+            undetectable_background += sample_background
+
+        return cls(histogram, undetectable_fire, undetectable_background)
+
+    def get_counts(self, detected):
+        """Get the confusion matrix of a detection over the cells.
+
+        Args:
+            detected (np.array): cells detected as fire. Can have one extra leading dimension (ex: one row per parameter)
+
+        Returns:
+            dict: tp, fp, fn and tn
+        """
+        tp = np.sum(np.where(detected, self.fire_counts, 0), axis=-1)
+        fp = np.sum(np.where(detected, self.background_counts, 0), axis=-1)
+
+        return {
+            'tp': tp,
+            'fp': fp,
+            'fn': self.fire_counts.sum() + self.undetectable_fire - tp,
+            'tn': self.background_counts.sum() + self.undetectable_background - fp,
+        }
+
+    def grid_search(self, predicate, parameter_grid, metric='f1'):
+        """Evaluate a pixel-wise method for every combination of parameters.
+
+        Args:
+            predicate (callable): function(buffered_stack, **parameters) returning the detected pixels.
+                Only pixel-wise methods can be evaluated, the cells have no neighbourhood (ex: Sahm, not Yongxue)
+            parameter_grid (list): parameters (dict) to evaluate
+            metric (str, optional): score to maximize. Defaults to 'f1'.
+
+        Returns:
+            tuple(dict, list): the best parameters and the scores of each parameter combination
+        """
+        buffered_stack = self.histogram.to_stack([dimension for dimension in self.histogram.dimensions if dimension != LABEL])
+
+        results = []
+        for parameters in parameter_grid:
+            counts = self.get_counts(predicate(buffered_stack, **parameters))
+            scores = scores_from_counts(counts['tp'], counts['fp'], counts['fn'], counts['tn'])
+            scores = {key: float(value) for key, value in scores.items()}
+            scores.update({key: int(value) for key, value in counts.items()})
+            results.append({'parameters': parameters, **scores})
+
+        best = max(results, key=lambda result: result[metric])
+
+        return best['parameters'], results
+
+    def search_criteria_1(self, coefficients_a, coefficients_b, metric='f1', b4_band=4, b12_band=12):
+        """Search the coefficients of the biome criteria 1 (B4 <= a * B12 + b).
+        For each coefficient a the cells are sorted by B4 - a * B12, so every coefficient b is evaluated with a cumulative sum.
+
+        Args:
+            coefficients_a (np.array): values of the coefficient a
+            coefficients_b (np.array): values of the coefficient b
+            metric (str, optional): score to maximize. Defaults to 'f1'.
+            b4_band (optional): band identifier of B4 in the histogram. Defaults to 4.
+            b12_band (optional): band identifier of B12 in the histogram. Defaults to 12.
+
+        Returns:
+            tuple: best (a, b) and the scores (dict of arrays with shape len(a) x len(b))
+        """
+        b4 = self.histogram.get_values(b4_band)
+        b12 = self.histogram.get_values(b12_band)
+        coefficients_b = np.asarray(coefficients_b, dtype=np.float64)
+
+        tp = np.zeros((len(coefficients_a), len(coefficients_b)), dtype=np.int64)
+        fp = np.zeros((len(coefficients_a), len(coefficients_b)), dtype=np.int64)
+        for index, coefficient_a in enumerate(coefficients_a):
+            residual = b4 - coefficient_a * b12
+            order = np.argsort(residual, kind='stable')
+            sorted_residual = residual[order]
+            fire_cumsum = np.concatenate([[0], np.cumsum(self.fire_counts[order])])
+            background_cumsum = np.concatenate([[0], np.cumsum(self.background_counts[order])])
+
+            # Number of cells with residual <= b
+            num_cells = np.searchsorted(sorted_residual, coefficients_b, side='right')
+            tp[index] = fire_cumsum[num_cells]
+            fp[index] = background_cumsum[num_cells]
+
+        fn = self.fire_counts.sum() + self.undetectable_fire - tp
+        tn = self.background_counts.sum() + self.undetectable_background - fp
+
+        scores = scores_from_counts(tp, fp, fn, tn)
+        scores.update({'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn})
+
+        best_a, best_b = np.unravel_index(np.argmax(scores[metric]), tp.shape)
+
+        return (coefficients_a[best_a], coefficients_b[best_b]), scores
+
+
+def collect_index_sweep(samples, bands, index_function, thresholds, cache_dir=None, n_jobs=-2):
+    """Compute the threshold sweep of a continuous index over many samples in parallel.
+
+    Args:
+        samples (list): labelled samples (see load_sample)
+        bands (tuple): bands needed by the index
+        index_function (callable): function(buffered_stack, metadata) returning the continuous index
+        thresholds (np.array): thresholds evaluated
+        cache_dir (str, optional): directory of the band cache. Defaults to None.
+        n_jobs (int, optional): number of parallel jobs. Defaults to -2.
+
+    Returns:
+        ThresholdSweep: merged sweep
+    """
+    sweeps = Parallel(n_jobs=n_jobs, verbose=0)(
+        delayed(sample_index_statistics)(sample, bands, index_function, thresholds, cache_dir) for sample in samples
+    )
+
+    sweep = ThresholdSweep(thresholds)
+    for sample_sweep in sweeps:
+        sweep.merge(sample_sweep)
+
+    return sweep
+
+
+def get_biome_afd(biome_name):
+    """Instanciate the biome method by name
+    """
+    module = importlib.import_module('active_fire.biome', '.')
+    algorithm = getattr(module, '{}AFD'.format(biome_name))
+
+    return algorithm()
+
+
+def calibrate_biome_afd(biome_name, samples, coefficients_a, coefficients_b, metric='f1', cache_dir=None, n_jobs=-2):
+    """Calibrate the coefficients (a, b) of the criteria 1 of a biome method.
+    The additional criteria of the method (C2, C3) are kept with their published values.
+
+    Args:
+        biome_name (str): biome method's name (ex: MediterraneanForest)
+        samples (list): labelled samples (see load_sample)
+        coefficients_a (np.array): values of the coefficient a
+        coefficients_b (np.array): values of the coefficient b
+        metric (str, optional): score to maximize. Defaults to 'f1'.
+        cache_dir (str, optional): directory of the band cache. Defaults to None.
+        n_jobs (int, optional): number of parallel jobs. Defaults to -2.
+
+    Returns:
+        tuple: best (a, b), the scores of the grid and the statistics
+    """
+    algorithm = get_biome_afd(biome_name)
+
+    # Only B4 and B12 are in the histogram, the other criteria are applied before (fewer cells)
+    statistics = BandStatistics.collect(samples, (4, 12), precondition=algorithm.additional_criteria, precondition_bands=(11,), cache_dir=cache_dir, n_jobs=n_jobs)
+    best, scores = statistics.search_criteria_1(coefficients_a, coefficients_b, metric)
+
+    return best, scores, statistics
+
+
+def count_sidecar_detections(histogram_file, predicate, parameters):
+    return JointHistogram.load(histogram_file).count(predicate, **parameters)
+
+
+def count_detections(histogram_files, predicate, n_jobs=-2, **parameters):
+    """Count the pixels a pixel-wise method detects in many images, using the band histogram sidecars (see image.histogram.build_band_histogram).
+    Ex: count_detections(files, ActiveFireIndex('Sahm').transform, th=0.35)
+
+    Args:
+        histogram_files (list): band histogram files of the images
+        predicate (callable): function(buffered_stack, **parameters) returning the detected pixels
+        n_jobs (int, optional): number of parallel jobs. Defaults to -2.
+        parameters: parameters of the predicate
+
+    Returns:
+        dict: number of pixels detected in each image (by file)
+    """
+    counts = Parallel(n_jobs=n_jobs, verbose=0)(
+        delayed(count_sidecar_detections)(histogram_file, predicate, parameters) for histogram_file in histogram_files
+    )
+
+    return dict(zip(histogram_files, counts))
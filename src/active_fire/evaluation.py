@@ -0,0 +1,121 @@
+''' Evaluation of active fire masks against the ground truth.
+Each image is reduced to the confusion matrix counts of each method, the images are evaluated in parallel
+and the counts are aggregated as micro (sum of the counts) and macro (mean of the image scores) metrics.
+'''
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from PIL import Image
+from joblib import Parallel, delayed
+
+from image.sparse import SparseMask
+from active_fire.metrics import ConfusionMatrix, scores_from_counts
+
+COUNT_COLUMNS = ['tp', 'fp', 'fn', 'tn']
+SCORE_COLUMNS = ['precision', 'recall', 'f1', 'iou', 'accuracy', 'f1_macro']
+
+
+def load_mask(mask_path):
+    """Load a binary mask saved as sparse (npz, see image.sparse), txt (np.savetxt), tif or an image file (png).
+
+    Args:
+        mask_path (str): path to the mask
+
+    Returns:
+        np.array: mask (bool)
+    """
+    extension = os.path.splitext(mask_path)[1].lower()
+
+    if extension == '.npz':
+        return SparseMask.load(mask_path).to_dense()
+    elif extension == '.txt':
+        mask = np.loadtxt(mask_path, dtype=np.uint8)
+    elif extension in ('.tif', '.tiff'):
+        with rasterio.open(mask_path) as src:
+            mask = src.read(1)
+    else:
+        mask = np.array(Image.open(mask_path))
+        if mask.ndim == 3:
+            mask = mask.max(axis=-1)
+
+    return mask > 0
+
+
+def evaluate_sample(sample):
+    """Compute the confusion matrix of each method in an image.
+
+    Args:
+        sample (dict): sample with the keys 'name', 'ground_truth' (mask path) and 'predictions' ({method: mask path}).
+            Optionally 'biome' (used to group the results)
+
+    Returns:
+        list: one row (dict) per method with the image name, method, biome and the counts
+    """
+    ground_truth = load_mask(sample['ground_truth'])
+
+    rows = []
+    for method, prediction_path in sample['predictions'].items():
+        prediction = load_mask(prediction_path)
+        if prediction.shape != ground_truth.shape:
+            raise Exception('Prediction and ground truth with different shapes: {} - {}'.format(prediction_path, sample['ground_truth']))
+
+        confusion_matrix = ConfusionMatrix().update(prediction, ground_truth)
+
+        row = {'image': sample['name'], 'method': method, 'biome': sample.get('biome')}
+        row.update(confusion_matrix.get_counts())
+        rows.append(row)
+
+    return rows
+
+
+def evaluate_samples(samples, n_jobs=-2, verbose=0):
+    """Evaluate the images in parallel.
+
+    Args:
+        samples (list): samples (see evaluate_sample)
+        n_jobs (int, optional): number of parallel jobs. Defaults to -2.
+        verbose (int, optional): joblib verbosity. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: one row per image and method with the counts and the scores of the image
+    """
+    results = Parallel(n_jobs=n_jobs, verbose=verbose)(delayed(evaluate_sample)(sample) for sample in samples)
+
+    df = pd.DataFrame([row for rows in results for row in rows], columns=['image', 'method', 'biome'] + COUNT_COLUMNS)
+    scores = scores_from_counts(df['tp'].values, df['fp'].values, df['fn'].values, df['tn'].values)
+    for column in SCORE_COLUMNS:
+        df[column] = scores[column]
+
+    return df
+
+
+def summarize(df, by_biome=False):
+    """Aggregate the results of the images per method (and biome).
+    The micro metrics are computed from the counts summed over the images, each pixel has the same weight.
+    The macro metrics are the mean of the image scores, each image has the same weight.
+
+    Args:
+        df (pd.DataFrame): results of the images (see evaluate_samples)
+        by_biome (bool, optional): group the results by biome too. Defaults to False.
+
+    Returns:
+        pd.DataFrame: one row per group with the summed counts, the micro scores (micro_*) and the macro scores (macro_*)
+    """
+    group_columns = ['method', 'biome'] if by_biome else ['method']
+    # Images without biome are grouped as unknown
+    df = df.fillna({'biome': 'Unknown'})
+
+    groups = df.groupby(group_columns)
+    summary = groups[COUNT_COLUMNS].sum()
+    summary['num_images'] = groups.size()
+
+    scores = scores_from_counts(summary['tp'].values, summary['fp'].values, summary['fn'].values, summary['tn'].values)
+    for column in SCORE_COLUMNS:
+        summary['micro_{}'.format(column)] = scores[column]
+
+    macro = groups[SCORE_COLUMNS].mean()
+    for column in SCORE_COLUMNS:
+        summary['macro_{}'.format(column)] = macro[column]
+
+    return summary.reset_index()
@@ -0,0 +1,129 @@
+''' Extraction of fire events from the active fire masks.
+An event is a connected component of fire pixels (8-connectivity). The components and the statistics are computed
+only from the fire pixels, with the bands already in memory, so the tile is not read again.
+'''
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from rasterio.warp import transform as transform_coords
+
+from image.sentinel import BufferedImageStack
+from image.sparse import SparseMask
+from image.converter import band_reflectance_to_radiance
+
+EVENT_COLUMNS = [
+    'event_id', 'num_pixels', 'row_min', 'row_max', 'col_min', 'col_max', 'row', 'col', 'x', 'y', 'lon', 'lat',
+]
+
+# Bands summarized in each event (max and mean)
+EVENT_BANDS = (12, 11)
+
+
+def label_events(mask, connectivity=8):
+    """Label the connected components of the fire pixels.
+    The components are computed on the graph of the neighbour fire pixels, so the cost depends on the number of
+    fire pixels and not on the area of the tile.
+
+    Args:
+        mask (np.array | SparseMask): active fire mask
+        connectivity (int, optional): 4 or 8. Defaults to 8.
+
+    Returns:
+        tuple: rows, columns and label (1..n) of each fire pixel, and the number of events
+    """
+    if isinstance(mask, SparseMask):
+        indices, width = mask.indices.astype(np.int64), mask.shape[1]
+    else:
+        indices, width = np.flatnonzero(mask), np.shape(mask)[1]
+
+    rows, cols = np.divmod(indices, width)
+    if len(indices) == 0:
+        return rows, cols, np.zeros(0, dtype=np.int64), 0
+
+    # Neighbours after each pixel (row-major): right and below (and the diagonals with 8-connectivity)
+    offsets = [(0, 1), (1, 0)] + ([(1, -1), (1, 1)] if connectivity == 8 else [])
+
+    sources, targets = [], []
+    for row_offset, col_offset in offsets:
+        neighbours = indices + row_offset * width + col_offset
+        positions = np.minimum(np.searchsorted(indices, neighbours), len(indices) - 1)
+        found = (indices[positions] == neighbours) & (cols + col_offset >= 0) & (cols + col_offset < width)
+
+        sources.append(np.flatnonzero(found))
+        targets.append(positions[found])
+
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    graph = coo_matrix((np.ones(len(sources), dtype=bool), (sources, targets)), shape=(len(indices), len(indices)))
+    num_events, labels = connected_components(graph, directed=False)
+
+    return rows, cols, labels.astype(np.int64) + 1, num_events
+
+
+def reduce_events(labels, values, num_events):
+    """Compute the max and the mean of the values of each event.
+
+    Returns:
+        tuple(np.array, np.array): max and mean of each event
+    """
+    order = np.argsort(labels, kind='stable')
+    starts = np.searchsorted(labels[order], np.arange(1, num_events + 1))
+
+    maximum = np.maximum.reduceat(values[order], starts)
+    mean = np.bincount(labels, weights=values, minlength=num_events + 1)[1:] / np.bincount(labels, minlength=num_events + 1)[1:]
+
+    return maximum, mean
+
+
+def extract_events(mask, buffered_stack : BufferedImageStack, metadata=None, connectivity=8, band=12):
+    """Extract the fire events of a mask (any AFI/AFD mask).
+
+    Args:
+        mask (np.array | SparseMask): active fire mask
+        buffered_stack (BufferedImageStack): stack used to detect the fires (the bands are read from memory)
+        metadata (dict, optional): image metadata (see utils.reflectance_conversion.get_image_metadata), to add the
+            radiance of the bands (b12_radiance_max, b11_radiance_max...). Defaults to None.
+        connectivity (int, optional): 4 or 8. Defaults to 8.
+        band (optional): band with the geotransform and the CRS. Defaults to 12.
+
+    Returns:
+        pd.DataFrame: one row per event with the number of pixels, the bounding box (rows/columns), the centroid
+            (row/col, map x/y and lon/lat) and the max and mean of the bands (b12_max, b12_mean...)
+    """
+    rows, cols, labels, num_events = label_events(mask, connectivity)
+
+    bands = [b for b in EVENT_BANDS if b in buffered_stack.buffer]
+    columns = EVENT_COLUMNS + ['b{}_{}'.format(b, stat) for b in bands for stat in ('max', 'mean')]
+    if metadata is not None:
+        columns += ['b{}_radiance_{}'.format(b, stat) for b in bands for stat in ('max', 'mean')]
+
+    if num_events == 0:
+        return pd.DataFrame(columns=columns)
+
+    num_pixels = np.bincount(labels, minlength=num_events + 1)[1:]
+    events = {
+        'event_id': np.arange(1, num_events + 1),
+        'num_pixels': num_pixels,
+        'row_min': reduce_events(labels, -rows, num_events)[0] * -1,
+        'row_max': reduce_events(labels, rows, num_events)[0],
+        'col_min': reduce_events(labels, -cols, num_events)[0] * -1,
+        'col_max': reduce_events(labels, cols, num_events)[0],
+        'row': np.bincount(labels, weights=rows, minlength=num_events + 1)[1:] / num_pixels,
+        'col': np.bincount(labels, weights=cols, minlength=num_events + 1)[1:] / num_pixels,
+    }
+
+    # Centroid in the map (center of the pixels) and geographic coordinates
+    meta = buffered_stack.metas[band]
+    events['x'], events['y'] = meta['transform'] * (events['col'] + 0.5, events['row'] + 0.5)
+    lon, lat = transform_coords(meta['crs'], 'EPSG:4326', events['x'], events['y'])
+    events['lon'], events['lat'] = np.array(lon), np.array(lat)
+
+    for b in bands:
+        events['b{}_max'.format(b)], events['b{}_mean'.format(b)] = reduce_events(labels, buffered_stack.read(b)[rows, cols], num_events)
+
+    if metadata is not None:
+        for b in bands:
+            radiance = band_reflectance_to_radiance(buffered_stack.read(b)[rows, cols], b, metadata)
+            events['b{}_radiance_max'.format(b)], events['b{}_radiance_mean'.format(b)] = reduce_events(labels, radiance, num_events)
+
+    return pd.DataFrame(events, columns=columns)
@@ -1,19 +1,39 @@
 import numpy as np
-from image.sentinel import BufferedImageStack
+from image.sentinel import BufferedImageStack, QUANTIFICATION_VALUE, SATURATION_VALUE
+from image.blocks import BLOCK_SIZE, reduce_blocks
 import importlib
 from scipy import ndimage
 import cv2
 import joblib
 from image.converter import reflectance_to_radiance, band_reflectance_to_radiance
 
+# Density of seeds (fraction of the pixels) below which the neighborhood operations are computed only around the seeds
+SPARSE_MAX_DENSITY = 0.001
+# Margin for the rounding of the local means computed in the sparse mode
+SPARSE_TOLERANCE = 1e-9
+
 class ActiveFireIndex:
 
-    def __init__(self, method='baseline'):
+    def __init__(self, method='baseline', use_blocks=False, block_size=BLOCK_SIZE):
+        """Active fire method resolved by name.
+
+        Args:
+            method (str, optional): method's name. Defaults to 'baseline'.
+            use_blocks (bool, optional): apply the method only to the blocks that can have detections (see transform_by_blocks). Defaults to False.
+            block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+        """
         self.method = method
+        self.use_blocks = use_blocks
+        self.block_size = block_size
         self.algorithm = self.resolve_algorithm()
         # print(self.algorithm)
 
     def transform(self, buffered_stack : BufferedImageStack, *args, **kwargs):
+        # The blocks to evaluate can be informed (ex: the responsibility of the tile, see active_fire.overlap)
+        candidates = kwargs.pop('candidates', None)
+        if self.use_blocks or candidates is not None:
+            return transform_by_blocks(self.algorithm, buffered_stack, *args, block_size=self.block_size, candidates=candidates, **kwargs)
+
         return self.algorithm.transform(buffered_stack, *args, **kwargs)
 
     def resolve_algorithm(self):
@@ -36,16 +56,22 @@ class CicalaAFI:
 
 
     def transform(self, buffered_stack : BufferedImageStack, metadata, alpha=0.5, th=5.0, **kwargs):
-        # Transform the reflectance to radiance
-        buffered_stack = reflectance_to_radiance(buffered_stack, metadata)
-        
-        afi = self.cicala_afi3(buffered_stack, alpha)
+        afi = self.index(buffered_stack, metadata, alpha)
         afi = afi > th
 
         valid_data_mask =  buffered_stack.read_mask()
 
         return afi & valid_data_mask
 
+    def index(self, buffered_stack : BufferedImageStack, metadata, alpha=0.5):
+        """Compute the continuous AFI3 index (before the threshold) over the radiance.
+        Used to tune the threshold without recomputing the index (see active_fire.tuning).
+        """
+        # Transform the reflectance to radiance
+        buffered_stack = reflectance_to_radiance(buffered_stack, metadata)
+        
+        return self.cicala_afi3(buffered_stack, alpha)
+
     def cicala_baseline_afi(self, buffered_stack : BufferedImageStack):
        
         b12 = buffered_stack.read(12)
@@ -74,9 +100,17 @@ class LiangrocapartAFI:
     DOI: 10.1109/ECTI-CON49241.2020.9158262
     """
 
+    # Pixels used around each pixel (see transform_by_blocks)
+    halo = 0
+
     def transform(self, buffered_stack, **kwargs):
         return self.calculate_afi(buffered_stack)
 
+    def block_prefilter(self, block_stats, **kwargs):
+        """Blocks that can have detections: every criteria needs B12 >= 0.8
+        """
+        return (block_stats.maximum[12] >= 0.8) & (block_stats.valid > 0)
+
     def calculate_afi(self, buffered_stack):
         
         b12 = buffered_stack.read(12)
@@ -124,7 +158,26 @@ class LiangrocapartAFI:
 class SahmAFI:
     """https://custom-scripts.sentinel-hub.com/custom-scripts/sentinel-2/active_fire_detection/script.js"""
 
-    def transform(self, buffered_stack : BufferedImageStack, **kwargs):
+    halo = 0
+
+    def block_prefilter(self, block_stats, th=0.4, b12_th=1.0, **kwargs):
+        """Blocks that can have detections: B12 > b12_th or (B12 - B11)/(B12 + B11) > th.
+        The index criteria is the same as B12 * (1 - th) > B11 * (1 + th), bounded by the max of B12 and the min of B11.
+        """
+        max_b12 = block_stats.maximum[12]
+        candidates = max_b12 > b12_th
+
+        if th < 0:
+            # Pixels with B12 = B11 = 0 have index 0
+            return np.ones(block_stats.grid_shape, dtype=bool)
+
+        if th < 1:
+            # Tolerance for the rounding of the index
+            candidates |= (max_b12 * (1 - th) + 1e-6) >= (block_stats.minimum[11] * (1 + th))
+
+        return candidates & (block_stats.valid > 0)
+
+    def transform(self, buffered_stack : BufferedImageStack, th=0.4, b12_th=1.0, **kwargs):
         b12 = buffered_stack.read(12) 
         b11 = buffered_stack.read(11) 
 
@@ -132,23 +185,35 @@ class SahmAFI:
 
         valid_data_mask =  buffered_stack.read_mask()
 
-        return np.logical_or(afi > 0.4, b12 > 1.0) & valid_data_mask
+        return np.logical_or(afi > th, b12 > b12_th) & valid_data_mask
 
 
 class PierreMarkuseAFI:
     """https://pierre-markuse.net/2018/04/30/visualizing-wildfires-burn-scars-sentinel-hub-eo-browser/"""
 
+    halo = 0
+
     def __init__(self):
         self.sensitivity = 1.0
 
-    def transform(self, buffered_stack, **kwargs):
+    def block_prefilter(self, block_stats, sensitivity=None, **kwargs):
+        """Blocks that can have detections: B12 + B11 > 2 / sensitivity
+        """
+        if sensitivity is None:
+            sensitivity = self.sensitivity
+
+        return ((block_stats.maximum[12] + block_stats.maximum[11]) > (2.0 / sensitivity)) & (block_stats.valid > 0)
+
+    def transform(self, buffered_stack, sensitivity=None, **kwargs):
         # b12 = buffered_stack.read_radiance(12)
         # b11 = buffered_stack.read_radiance(11)
+        if sensitivity is None:
+            sensitivity = self.sensitivity
 
         b12 = buffered_stack.read(12)
         b11 = buffered_stack.read(11)
 
-        afi_zone2 = (b12 + b11) > (2.0 / self.sensitivity)
+        afi_zone2 = (b12 + b11) > (2.0 / sensitivity)
 
 
         valid_data_mask =  buffered_stack.read_mask()
@@ -157,8 +222,25 @@ class PierreMarkuseAFI:
 
 class YongxueAFI:
 
-    def transform(self, buffered_stack, **kwargs):
-        
+    # 15x15 mean (7) + 15x15 buffer (7) + 8-pixel neighborhood (1)
+    halo = 15
+
+    def block_prefilter(self, block_stats, **kwargs):
+        """Blocks that can have detections: the detections need B12 > 0.15 (the saturated pixels B12 >= 1)
+        """
+        return (block_stats.maximum[12] > 0.15) & (block_stats.valid > 0)
+
+    def transform(self, buffered_stack, sparse=True, **kwargs):
+        """Apply the method. When there are few seeds (pixels that can be in the initial segmentation) the local means and the buffers
+        are computed only around them (sparse mode), with the same result as the dense mode.
+
+        Args:
+            buffered_stack (BufferedImageStack): Image buffer with the bands 8A, 11 and 12 loaded
+            sparse (bool, optional): use the sparse mode when the density of seeds is below SPARSE_MAX_DENSITY. Defaults to True.
+
+        Returns:
+            np.array: active fire mask
+        """
         b12 = buffered_stack.read(12)
         b11 = buffered_stack.read(11)
         b8 = buffered_stack.read('8A')
@@ -171,6 +253,14 @@ class YongxueAFI:
         tai_p = tai.copy()
         tai_p[ tai<0 ] = 0
 
+        valid_data_mask =  buffered_stack.read_mask()
+
+        if sparse and min(tai.shape) >= 15:
+            # The mean is not negative, so the segmentation needs tai_p > 0.45 (with a margin for the rounding of the mean)
+            seeds = np.nonzero(tai_p > (0.45 - SPARSE_TOLERANCE))
+            if len(seeds[0]) <= SPARSE_MAX_DENSITY * tai.size:
+                return self.transform_sparse(b12, b11, b8, tai, tai_p, seeds, valid_data_mask)
+
         # Step 2 - compute the mean of tai_p in a 15x15 window 
         tai_mean = cv2.blur(tai_p, ksize=(15,15))
 
@@ -197,12 +287,58 @@ class YongxueAFI:
         hta_pixels = hta_pixels | satured
 
         false_alarm_control = ~( (b11 <= 0.05) | (b8 <= 0.01) )
-        valid_data_mask =  buffered_stack.read_mask()
 
         return hta_pixels & false_alarm_control & valid_data_mask
 
+    def transform_sparse(self, b12, b11, b8, tai, tai_p, seeds, valid_data_mask):
+        """Same steps of transform, computed only at the seeds and their neighborhood (pixel indices instead of images).
+        """
+        shape = tai.shape
+
+        # Step 2 - mean of tai_p in the 15x15 window of each seed, with the border of cv2.blur (reflect 101)
+        offsets = np.arange(-7, 8)
+        window_rows = reflect_101(seeds[0][:, None, None] + offsets[None, :, None], shape[0])
+        window_cols = reflect_101(seeds[1][:, None, None] + offsets[None, None, :], shape[1])
+        tai_mean = tai_p[window_rows, window_cols].sum(axis=(1, 2)) / 225.0
+
+        difference = tai_p[seeds] - tai_mean
+        if np.any(np.abs(difference - 0.45) <= SPARSE_TOLERANCE):
+            # cv2.blur uses running sums, its rounding can change the result at the threshold
+            difference = tai_p[seeds] - cv2.blur(tai_p, ksize=(15,15))[seeds]
+
+        segmentation = (seeds[0][difference > 0.45], seeds[1][difference > 0.45])
+
+        # Step 3 - 15-pixel buffer around the segmentation
+        buffer = dilate_indices(segmentation, 7, shape)
+
+        # Step 4 - pixels with TAI >= 0.45 in the buffer, refined
+        hta_pixels = np.flatnonzero((tai >= 0.45) & ((b12 - b11) > (b11 - b8)) & (b12 > 0.15))
+        hta_pixels = hta_pixels[np.isin(hta_pixels, buffer)]
+
+        # Saturated pixels in the 8-pixel neighborhood
+        neighborhood = dilate_indices(np.unravel_index(hta_pixels, shape), 1, shape)
+        neighborhood_coords = np.unravel_index(neighborhood, shape)
+        satured = neighborhood[(b12[neighborhood_coords] >= 1) & (b11[neighborhood_coords] >= 1)]
+
+        detections = np.union1d(hta_pixels, satured)
+        coords = np.unravel_index(detections, shape)
+        false_alarm_control = ~( (b11[coords] <= 0.05) | (b8[coords] <= 0.01) )
+
+        mask = np.zeros(shape, dtype=bool)
+        keep = false_alarm_control & (valid_data_mask[coords] > 0)
+        mask[coords[0][keep], coords[1][keep]] = True
+
+        return mask
+
 class KatoNakamuraAFI:
 
+    halo = 0
+
+    def block_prefilter(self, block_stats, **kwargs):
+        """Blocks that can have detections: B12/B8A > 5 needs B12 > 5 * B8A
+        """
+        return (block_stats.maximum[12] + 1e-6 >= 5 * block_stats.minimum['8A']) & (block_stats.valid > 0)
+
     def transform(self, buffered_stack, metadata, **kwargs):
 
         # if 'metadata' not in kwargs:
@@ -227,15 +363,29 @@ class KatoNakamuraAFI:
 
 
 class MurphyAFI:
-    
 
-    def transform(self, buffered_stack, **kwargs):
+    # 8-pixel neighborhood of the unambiguous fires
+    halo = 1
+
+    def block_prefilter(self, block_stats, **kwargs):
+        """Blocks that can have detections: the unambiguous fires need P7 >= 0.15 and the potential fires are in their neighborhood,
+        so a block is a candidate if it or a neighbor block has P7 >= 0.15
+        """
+        candidates = (block_stats.maximum[12] >= 0.15).astype(np.uint8)
+        return cv2.dilate(candidates, cv2.getStructuringElement(cv2.MORPH_RECT, (3,3))).astype(bool)
+
+    def transform(self, buffered_stack, sparse=True, **kwargs):
         
         p7 = buffered_stack.read(12)
         p6 = buffered_stack.read(11)
         p5 = buffered_stack.read('8A')
         
         unamb_fires = ( generalized_normalized_difference_index(p7, p6) >= 1.4) & (generalized_normalized_difference_index(p7,p5) >= 1.4) & (p7 >= 0.15)
+
+        if sparse:
+            num_unamb_fires = np.count_nonzero(unamb_fires)
+            if 0 < num_unamb_fires <= SPARSE_MAX_DENSITY * unamb_fires.size:
+                return self.transform_sparse(p7, p6, p5, unamb_fires)
         
         if np.any (unamb_fires):
             neighborhood = cv2.dilate(unamb_fires.astype(np.uint8), cv2.getStructuringElement(cv2.MORPH_RECT, (3,3))).astype(unamb_fires.dtype)
@@ -249,6 +399,158 @@ class MurphyAFI:
 
         return (final_mask.astype(np.bool))
 
+    def transform_sparse(self, p7, p6, p5, unamb_fires):
+        """Same as transform, but the potential fires are evaluated only in the neighborhood of the unambiguous fires.
+        """
+        shape = unamb_fires.shape
+        neighborhood = dilate_indices(np.nonzero(unamb_fires), 1, shape)
+        coords = np.unravel_index(neighborhood, shape)
+
+        saturation_value = SATURATION_VALUE / QUANTIFICATION_VALUE
+        saturated = (p7[coords] == saturation_value) | (p6[coords] == saturation_value)
+        potential_fires = ((generalized_normalized_difference_index(p6[coords], p5[coords]) >= 2) & (p6[coords] >= 0.5)) | saturated
+
+        final_mask = unamb_fires.copy()
+        final_mask[coords[0][potential_fires], coords[1][potential_fires]] = True
+
+        return final_mask
+
+
+def transform_by_blocks(algorithm, buffered_stack : BufferedImageStack, *args, block_size=BLOCK_SIZE, candidates=None, **kwargs):
+    """Apply a method only to the blocks that can have detections, the other blocks are set as no fire.
+    The blocks are ruled out with the block statistics (min, max) by the block_prefilter of the method.
+    Each run of consecutive candidate blocks of a row is processed as a window with a margin of halo pixels,
+    so the methods that use the neighborhood get the same result as in the whole image.
+    The methods without block_prefilter are applied to the whole image (or to the candidates informed).
+
+    Args:
+        algorithm: active fire method (ex: YongxueAFI())
+        buffered_stack (BufferedImageStack): Image buffer with the bands loaded
+        block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+        candidates (np.array, optional): blocks to evaluate, combined with the block_prefilter (ex: set by a previous method). Defaults to None (all blocks).
+
+    Returns:
+        np.array: active fire mask
+    """
+    if not hasattr(algorithm, 'block_prefilter') and candidates is None:
+        return algorithm.transform(buffered_stack, *args, **kwargs)
+
+    block_stats = buffered_stack.get_block_stats(block_size)
+    if candidates is None:
+        candidates = np.ones(block_stats.grid_shape, dtype=bool)
+    if hasattr(algorithm, 'block_prefilter'):
+        candidates = candidates & algorithm.block_prefilter(block_stats, **kwargs)
+    halo = getattr(algorithm, 'halo', 0)
+
+    mask = np.zeros(block_stats.shape, dtype=bool)
+    for row in range(block_stats.grid_shape[0]):
+        # Runs of consecutive candidate blocks: [start, end)
+        row_candidates = np.concatenate([[False], candidates[row], [False]]).astype(np.int8)
+        changes = np.flatnonzero(np.diff(row_candidates))
+        for start, end in zip(changes[::2], changes[1::2]):
+            core_rows, core_cols = block_stats.get_block_window(row, start)
+            core_cols = slice(core_cols.start, block_stats.get_block_window(row, end - 1)[1].stop)
+            rows = slice(max(core_rows.start - halo, 0), min(core_rows.stop + halo, block_stats.shape[0]))
+            cols = slice(max(core_cols.start - halo, 0), min(core_cols.stop + halo, block_stats.shape[1]))
+
+            window_mask = algorithm.transform(buffered_stack.window(rows, cols), *args, **kwargs)
+            mask[core_rows, core_cols] = window_mask[core_rows.start - rows.start:core_rows.stop - rows.start, core_cols.start - cols.start:core_cols.stop - cols.start]
+
+    return mask
+
+
+class CascadeAFI:
+
+    # Each stage evaluates only the blocks passed by the previous stage:
+    # 'detections' passes the blocks where the stage detected fire and 'candidates' passes the blocks the stage evaluated
+    STAGES = [
+        {'method': 'Sahm', 'gate': 'detections'},
+        {'method': 'Liangrocapart', 'gate': 'detections'},
+        {'method': 'Yongxue', 'gate': 'detections'},
+    ]
+
+    def __init__(self, stages=None, block_size=BLOCK_SIZE):
+        """Chain of methods where the cheap methods gate the expensive ones.
+        Each stage is applied (see transform_by_blocks) only to the blocks passed by the previous stage that
+        also pass its own block_prefilter. The cascade stops when there is no block to evaluate.
+        With the gate 'candidates' a stage does not restrict the next one beyond its relaxed (no-miss) block_prefilter.
+
+        Args:
+            stages (list, optional): stages with the keys method, gate ('detections' or 'candidates') and parameters (optional). Defaults to None (STAGES).
+            block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+        """
+        if stages is None:
+            stages = self.STAGES
+
+        self.stages = [stage.copy() for stage in stages]
+        for stage in self.stages:
+            stage['afi'] = ActiveFireIndex(stage['method'])
+        self.block_size = block_size
+
+    def transform(self, buffered_stack : BufferedImageStack, **kwargs):
+        """Apply the cascade.
+
+        Returns:
+            np.array: active fire mask of the last stage
+        """
+        return self.transform_stages(buffered_stack, **kwargs)[-1]['mask']
+
+    def transform_stages(self, buffered_stack : BufferedImageStack, **kwargs):
+        """Apply the cascade and keep the result of each stage.
+
+        Returns:
+            list: method, mask and number of candidate blocks of each stage
+        """
+        block_stats = buffered_stack.get_block_stats(self.block_size)
+        candidates = np.ones(block_stats.grid_shape, dtype=bool)
+
+        results = []
+        for stage in self.stages:
+            algorithm = stage['afi'].algorithm
+            parameters = dict(kwargs, **stage.get('parameters', {}))
+            if hasattr(algorithm, 'block_prefilter'):
+                candidates = candidates & algorithm.block_prefilter(block_stats, **parameters)
+
+            if not np.any(candidates):
+                # Nothing to evaluate in this stage and in the next ones
+                mask = np.zeros(block_stats.shape, dtype=bool)
+            else:
+                mask = transform_by_blocks(algorithm, buffered_stack, block_size=self.block_size, candidates=candidates, **parameters)
+
+            results.append({'method': stage['method'], 'mask': mask, 'num_candidate_blocks': int(candidates.sum())})
+
+            if stage.get('gate', 'detections') == 'detections':
+                candidates = candidates & (reduce_blocks(mask, self.block_size, np.max) > 0)
+
+        return results
+
+
+def reflect_101(index, size):
+    """Map indices outside [0, size) as the border reflect 101 of OpenCV (gfedcb|abcdefgh|gfedcba), for offsets smaller than size.
+    """
+    index = np.abs(index)
+    return np.where(index >= size, 2 * size - 2 - index, index)
+
+
+def dilate_indices(coords, radius, shape):
+    """Dilate a set of pixels with a square structuring element, returning the linear indices of the result (sorted).
+    Same as a binary dilation with a (2*radius+1)x(2*radius+1) structure and zeros outside the image.
+
+    Args:
+        coords (tuple): rows and columns of the pixels
+        radius (int): radius of the structuring element
+        shape (tuple): shape of the image
+
+    Returns:
+        np.array: linear indices of the dilated pixels
+    """
+    offsets = np.arange(-radius, radius + 1)
+    rows = np.broadcast_to(coords[0][:, None, None] + offsets[None, :, None], (len(coords[0]), len(offsets), len(offsets)))
+    cols = np.broadcast_to(coords[1][:, None, None] + offsets[None, None, :], (len(coords[1]), len(offsets), len(offsets)))
+
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    return np.unique(np.ravel_multi_index((rows[inside], cols[inside]), shape))
+
 
 def generalized_normalized_difference_index(b1, b2):
     """Compute de Generalized Normalized Difference Index, with is B1/B2
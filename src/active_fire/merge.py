@@ -0,0 +1,249 @@
+''' Merge of the detections of neighbour tiles.
+The MGRS tiles overlap by ~10 km, so the fire pixels of an overlap region are detected in every tile that covers it
+(in the UTM zone of each tile). The fire pixels of the tiles of an acquisition (same datatake timestamp) are indexed by
+their position on the Earth (earth-centered coordinates, in metres, independent of the UTM zone), the duplicates of
+different tiles are collapsed and the remaining pixels are grouped into events.
+Only one acquisition is in memory at a time, so the memory depends on the fire pixels of an acquisition and not on the
+number of tiles.
+'''
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from rasterio.warp import transform as transform_coords
+
+from image.sparse import SparseMask
+
+# Pixels of different tiles closer than this distance (metres) are the same pixel (half of the 20 m pixel). The tiles of a
+# UTM zone share the pixel grid, so their duplicates are at the same position
+DUPLICATE_DISTANCE = 10.0
+# Same for the tiles of different UTM zones (CRS): their grids are not aligned and the centres of the pixels that cover the same
+# ground can be up to ~14 m apart (the diagonal of half a pixel), so 0.75 of the 20 m pixel
+CROSS_ZONE_DUPLICATE_DISTANCE = 15.0
+# Pixels closer than this distance (metres) are in the same event (neighbours with 8-connectivity of the 20 m pixels)
+EVENT_DISTANCE = 30.0
+
+# WGS84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.0
+ECCENTRICITY_2 = 6.69437999014e-3
+
+MERGED_EVENT_COLUMNS = [
+    'timestamp', 'event_id', 'num_pixels', 'num_duplicates', 'lon_min', 'lon_max', 'lat_min', 'lat_max', 'lon', 'lat', 'tiles',
+]
+
+
+def get_acquisition(mask_file):
+    """Get the grid name and the timestamp of a mask file (<grid>_<timestamp>_...).
+
+    Returns:
+        tuple(str, str): grid name (ex: T01GEM) and timestamp (ex: 20200815T133851)
+    """
+    name_parts = os.path.basename(mask_file).split('_')
+
+    return name_parts[0], name_parts[1]
+
+
+def group_by_acquisition(mask_files):
+    """Group the mask files by the acquisition timestamp (the tiles of a datatake share the timestamp).
+
+    Returns:
+        dict: sorted mask files of each timestamp, in the timestamp order
+    """
+    acquisitions = {}
+    for mask_file in mask_files:
+        _, timestamp = get_acquisition(mask_file)
+        acquisitions.setdefault(timestamp, []).append(mask_file)
+
+    return {timestamp: sorted(acquisitions[timestamp]) for timestamp in sorted(acquisitions)}
+
+
+def to_earth_centered(lon, lat):
+    """Convert geographic coordinates to earth-centered coordinates (metres) on the WGS84 ellipsoid.
+
+    Returns:
+        np.array: (n, 3) coordinates
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    radius = SEMI_MAJOR_AXIS / np.sqrt(1.0 - ECCENTRICITY_2 * np.sin(lat) ** 2)
+
+    return np.stack([
+        radius * np.cos(lat) * np.cos(lon),
+        radius * np.cos(lat) * np.sin(lon),
+        radius * (1.0 - ECCENTRICITY_2) * np.sin(lat),
+    ], axis=-1)
+
+
+def load_fire_pixels(mask_files):
+    """Load the fire pixels of the sparse masks in geographic coordinates.
+
+    Args:
+        mask_files (list): sparse mask files (see image.sparse), with the geotransform and the CRS
+
+    Returns:
+        tuple(np.array, np.array, np.array, list): longitude, latitude and index of the tile (in mask_files) of each pixel, and
+            the CRS of each tile (None for the tiles without fire pixels)
+    """
+    lon, lat, tiles = [], [], []
+    tile_crs = [None] * len(mask_files)
+    for i, mask_file in enumerate(mask_files):
+        mask = SparseMask.load(mask_file)
+        if mask.count() == 0:
+            continue
+
+        if mask.transform is None or mask.crs is None:
+            raise Exception('Mask without geotransform or CRS: {}'.format(mask_file))
+
+        tile_crs[i] = str(mask.crs)
+
+        x, y = mask.get_xy()
+        tile_lon, tile_lat = transform_coords(mask.crs, 'EPSG:4326', x, y)
+
+        lon.append(np.asarray(tile_lon))
+        lat.append(np.asarray(tile_lat))
+        tiles.append(np.full(mask.count(), i))
+
+    if len(lon) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), tile_crs
+
+    return np.concatenate(lon), np.concatenate(lat), np.concatenate(tiles), tile_crs
+
+
+def get_components(points, distance, keep_pair=None):
+    """Connected components of the points closer than a distance.
+
+    Args:
+        points (np.array): (n, 3) coordinates
+        distance (float): maximum distance of the neighbour points
+        keep_pair (callable, optional): filter of the neighbour pairs (i, j). Defaults to None.
+
+    Returns:
+        tuple(int, np.array): number of components and the component of each point
+    """
+    tree = cKDTree(points)
+    pairs = tree.sparse_distance_matrix(tree, distance, output_type='ndarray')
+    i, j = pairs['i'], pairs['j']
+
+    if keep_pair is not None:
+        keep = keep_pair(i, j)
+        i, j = i[keep], j[keep]
+
+    graph = coo_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=(len(points), len(points)))
+
+    return connected_components(graph, directed=False)
+
+
+def deduplicate(points, tiles, distance=DUPLICATE_DISTANCE, tile_crs=None, cross_zone_distance=CROSS_ZONE_DUPLICATE_DISTANCE):
+    """Collapse the pixels of different tiles in the same position.
+    The tiles are matched in order (the lowest tile index first): each pixel of a tile is a duplicate of at most one
+    pixel kept from the previous tiles and each kept pixel absorbs at most one pixel of the tile (the closest pairs
+    first). The matches are not transitive, so the pixels of a fire are not chained into a single pixel when the
+    duplicate distance is larger than half of the pixel (different UTM zones).
+
+    Args:
+        points (np.array): (n, 3) earth-centered coordinates of the pixels
+        tiles (np.array): tile index of each pixel
+        distance (float, optional): maximum distance of the duplicates of tiles with the same CRS (metres).
+            Defaults to DUPLICATE_DISTANCE.
+        tile_crs (list, optional): CRS of each tile index. Defaults to None (the cross zone distance for all the tiles).
+        cross_zone_distance (float, optional): maximum distance of the duplicates of tiles with different CRS (metres).
+            Defaults to CROSS_ZONE_DUPLICATE_DISTANCE.
+
+    Returns:
+        tuple(np.array, np.array): indices of the unique pixels and the unique pixel (position in the indices) of each pixel
+    """
+    if tile_crs is not None:
+        tile_crs = np.array(tile_crs, dtype=object)
+
+    groups = np.full(len(points), -1, dtype=np.int64)
+    unique = np.zeros(0, dtype=np.int64)
+    for tile in np.unique(tiles):
+        tile_pixels = np.flatnonzero(tiles == tile)
+
+        if len(unique) > 0:
+            pairs = cKDTree(points[tile_pixels]).sparse_distance_matrix(
+                cKDTree(points[unique]), max(distance, cross_zone_distance), output_type='ndarray')
+            i, k, pair_distance = pairs['i'], pairs['j'], pairs['v']
+
+            # The pixels of tiles in the same UTM zone share the grid
+            if tile_crs is not None:
+                same_zone = tile_crs[tiles[unique[k]]] == tile_crs[tile]
+                keep = (pair_distance <= distance) | ~same_zone
+                i, k, pair_distance = i[keep], k[keep], pair_distance[keep]
+
+            matched_pixels, matched_unique = set(), set()
+            for pair in np.argsort(pair_distance, kind='stable'):
+                if i[pair] in matched_pixels or k[pair] in matched_unique:
+                    continue
+
+                matched_pixels.add(i[pair])
+                matched_unique.add(k[pair])
+                groups[tile_pixels[i[pair]]] = k[pair]
+
+        new_pixels = tile_pixels[groups[tile_pixels] < 0]
+        groups[new_pixels] = np.arange(len(unique), len(unique) + len(new_pixels))
+        unique = np.concatenate([unique, new_pixels])
+
+    return unique, groups
+
+
+def merge_acquisition(mask_files, timestamp=None, duplicate_distance=DUPLICATE_DISTANCE, event_distance=EVENT_DISTANCE,
+                      cross_zone_duplicate_distance=CROSS_ZONE_DUPLICATE_DISTANCE):
+    """Merge the detections of the tiles of an acquisition into a single set of events.
+
+    Args:
+        mask_files (list): sparse mask files of the tiles
+        timestamp (str, optional): timestamp of the acquisition. Defaults to None.
+        duplicate_distance (float, optional): maximum distance of the duplicates (metres). Defaults to DUPLICATE_DISTANCE.
+        event_distance (float, optional): maximum distance of the pixels of an event (metres). Defaults to EVENT_DISTANCE.
+        cross_zone_duplicate_distance (float, optional): maximum distance of the duplicates of tiles of different UTM zones
+            (metres). Defaults to CROSS_ZONE_DUPLICATE_DISTANCE.
+
+    Returns:
+        pd.DataFrame: one row per event with the number of pixels (without duplicates), the number of duplicates removed,
+            the bounding box and the centroid (lon/lat) and the tiles that detected the event
+    """
+    lon, lat, tiles, tile_crs = load_fire_pixels(mask_files)
+    if len(lon) == 0:
+        return pd.DataFrame(columns=MERGED_EVENT_COLUMNS)
+
+    points = to_earth_centered(lon, lat)
+    unique, groups = deduplicate(points, tiles, duplicate_distance, tile_crs, cross_zone_duplicate_distance)
+
+    num_events, labels = get_components(points[unique], event_distance)
+    # Event of all the pixels (the duplicates with the event of the kept pixel)
+    all_labels = labels[groups]
+
+    events = pd.DataFrame({
+        'label': labels,
+        'lon': lon[unique],
+        'lat': lat[unique],
+    }).groupby('label').agg(
+        num_pixels=('lon', 'size'), lon_min=('lon', 'min'), lon_max=('lon', 'max'), lon=('lon', 'mean'),
+        lat_min=('lat', 'min'), lat_max=('lat', 'max'), lat=('lat', 'mean'),
+    )
+    events['num_duplicates'] = np.bincount(all_labels, minlength=num_events) - events['num_pixels'].values
+
+    # Tiles that detected each event
+    grid_names = np.array([get_acquisition(mask_file)[0] for mask_file in mask_files])
+    event_tiles = pd.DataFrame({'label': all_labels, 'tile': grid_names[tiles]}).drop_duplicates()
+    events['tiles'] = event_tiles.sort_values('tile').groupby('label')['tile'].agg(';'.join)
+    events['timestamp'] = timestamp
+    events['event_id'] = np.arange(1, num_events + 1)
+
+    return events.reset_index(drop=True)[MERGED_EVENT_COLUMNS]
+
+
+def merge_detections(mask_files, **kwargs):
+    """Merge the detections of many tiles, one acquisition at a time.
+
+    Args:
+        mask_files (list): sparse mask files of the tiles (<grid>_<timestamp>_...)
+        kwargs: arguments of merge_acquisition
+
+    Yields:
+        tuple(str, pd.DataFrame): timestamp and the events of each acquisition
+    """
+    for timestamp, acquisition_files in group_by_acquisition(mask_files).items():
+        yield timestamp, merge_acquisition(acquisition_files, timestamp, **kwargs)
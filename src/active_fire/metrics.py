@@ -0,0 +1,100 @@
+import numpy as np
+
+
+def safe_divide(numerator, denominator):
+    """Element-wise division that returns 0 when the denominator is 0 (same as sklearn with zero_division=0)
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape), where=denominator != 0)
+
+
+def scores_from_counts(tp, fp, fn, tn):
+    """Compute the segmentation scores from the confusion matrix counts.
+    The counts can be scalars or arrays (ex: one value per threshold).
+
+    Args:
+        tp (int|np.array): true positives (fire pixels detected)
+        fp (int|np.array): false positives
+        fn (int|np.array): false negatives
+        tn (int|np.array): true negatives
+
+    Returns:
+        dict: precision, recall, f1 and iou of the fire class, accuracy and f1_macro (mean F1 of fire and non-fire classes, as sklearn average='macro')
+    """
+    tp = np.asarray(tp, dtype=np.float64)
+    fp = np.asarray(fp, dtype=np.float64)
+    fn = np.asarray(fn, dtype=np.float64)
+    tn = np.asarray(tn, dtype=np.float64)
+
+    f1 = safe_divide(2 * tp, 2 * tp + fp + fn)
+    f1_background = safe_divide(2 * tn, 2 * tn + fp + fn)
+
+    return {
+        'precision': safe_divide(tp, tp + fp),
+        'recall': safe_divide(tp, tp + fn),
+        'f1': f1,
+        'iou': safe_divide(tp, tp + fp + fn),
+        'accuracy': safe_divide(tp + tn, tp + fp + fn + tn),
+        'f1_macro': (f1 + f1_background) / 2.0,
+    }
+
+
+class ConfusionMatrix:
+
+    def __init__(self, tp=0, fp=0, fn=0, tn=0) -> None:
+        """Confusion matrix of a binary segmentation (fire / non-fire) accumulated over many images.
+        Only the four counts are kept, so the images are never stored or flattened together.
+        """
+        self.tp = int(tp)
+        self.fp = int(fp)
+        self.fn = int(fn)
+        self.tn = int(tn)
+
+    def update(self, prediction, ground_truth, valid_mask=None):
+        """Add the pixels of an image.
+
+        Args:
+            prediction (np.array): detected fire pixels
+            ground_truth (np.array): ground truth fire pixels
+            valid_mask (np.array, optional): pixels with valid data. The invalid pixels are never detected. Defaults to None.
+
+        Returns:
+            self
+        """
+        prediction = np.asarray(prediction, dtype=bool)
+        ground_truth = np.asarray(ground_truth, dtype=bool)
+        if valid_mask is not None:
+            prediction = prediction & valid_mask
+
+        num_fire = np.count_nonzero(ground_truth)
+        num_detected = np.count_nonzero(prediction)
+        tp = np.count_nonzero(prediction & ground_truth)
+
+        self.tp += tp
+        self.fp += num_detected - tp
+        self.fn += num_fire - tp
+        self.tn += ground_truth.size - num_fire - num_detected + tp
+
+        return self
+
+    def merge(self, other):
+        self.tp += other.tp
+        self.fp += other.fp
+        self.fn += other.fn
+        self.tn += other.tn
+
+        return self
+
+    def total(self):
+        return self.tp + self.fp + self.fn + self.tn
+
+    def get_counts(self):
+        return {'tp': self.tp, 'fp': self.fp, 'fn': self.fn, 'tn': self.tn}
+
+    def get_scores(self):
+        """Get the scores (see scores_from_counts) as floats.
+        """
+        scores = scores_from_counts(self.tp, self.fp, self.fn, self.tn)
+        return {key: float(value) for key, value in scores.items()}
@@ -0,0 +1,235 @@
+''' Overlap-aware processing plan of the tiles of an acquisition.
+The MGRS tiles (109.8 km) are spaced by 100 km, so ~17% of a tile is also covered by its neighbours.
+The tiles of an acquisition are ranked (by name) and each tile is responsible for the blocks that are not completely
+covered by the tiles ranked before it: the first tile covering a pixel always processes it, so nothing is lost.
+The responsibility is a block mask (see image.blocks), used as the candidates of transform_by_blocks, so the methods
+still read the halo of their neighbourhood around the responsible blocks.
+The skipped fraction depends on the block size: the overlap strip (~9.8 km) has ~3.8 blocks of 128 pixels and
+~1.9 blocks of 256 pixels (20 m).
+'''
+import re
+import numpy as np
+import geopandas as gpd
+from affine import Affine
+from rasterio.crs import CRS
+from shapely import wkt
+from shapely.geometry import box, Polygon, MultiPolygon
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from image.blocks import BLOCK_SIZE
+from active_fire.merge import get_acquisition, group_by_acquisition
+
+# Size of the tiles (20 m pixels)
+TILE_SIZE = 5490
+PIXEL_SIZE = 20
+# Margin (metres) removed from the coverage of the other tiles, for the differences of the projections and footprints
+COVERAGE_MARGIN = 2 * PIXEL_SIZE
+# Maximum length (metres) of the edges when a footprint is reprojected
+DENSIFY_STEP = 1000.0
+
+
+def get_utm_crs(tile_name):
+    """Get the UTM CRS of a tile from its name: the zone and the latitude band (N or S hemisphere).
+
+    Args:
+        tile_name (str): tile name. Ex: T33TWN or 33TWN
+
+    Returns:
+        CRS: UTM CRS (WGS84). Ex: EPSG:32633
+    """
+    match = re.match(r'T?(\d{1,2})([C-X])[A-Z]{2}$', tile_name.upper())
+    if match is None:
+        raise Exception('Invalid tile name: {}'.format(tile_name))
+
+    zone, band = int(match.group(1)), match.group(2)
+    # The bands C-M are in the south hemisphere
+    return CRS.from_epsg((32600 if band >= 'N' else 32700) + zone)
+
+
+def get_description_value(description, key):
+    """Get a value of the description (HTML table) of the Sentinel-2 grid KML. Ex: EPSG, UTM_WKT
+    """
+    if not isinstance(description, str):
+        return None
+
+    match = re.search(r'{}</td>\s*<td>([^<]+)</td>'.format(key), description)
+    return match.group(1).strip() if match is not None else None
+
+
+def densify(geometry, step=DENSIFY_STEP):
+    """Add vertices to the edges of a polygon, so the edges are kept when it is reprojected.
+    """
+    if isinstance(geometry, MultiPolygon):
+        return MultiPolygon([densify(polygon, step) for polygon in geometry.geoms])
+
+    coords = np.array(geometry.exterior.coords)
+    points = []
+    for start, end in zip(coords[:-1], coords[1:]):
+        num_points = max(int(np.ceil(np.hypot(*(end - start)) / step)), 1)
+        points.append(start + (end - start) * np.arange(num_points)[:, np.newaxis] / num_points)
+
+    return Polygon(np.concatenate(points))
+
+
+def reproject(geometry, src_crs, dst_crs):
+    return gpd.GeoSeries([geometry], crs=src_crs).to_crs(dst_crs).iloc[0]
+
+
+class TileGrid:
+
+    def __init__(self, grid) -> None:
+        """Footprints of the Sentinel-2 tiles in their UTM CRS.
+
+        Args:
+            grid (gpd.GeoDataFrame): Sentinel-2 grid (see utils/continents_grid.py) with the columns name, description (optional) and geometry (lon/lat)
+        """
+        self.grid = grid.drop_duplicates('name').set_index('name')
+        self.tiles = {}
+
+    @classmethod
+    def from_file(cls, grid_file):
+        """Load the grid from the GeoJSON or the GeoParquet (.parquet) file of utils/continents_grid.py
+        """
+        if grid_file.endswith('.parquet'):
+            return cls(gpd.read_parquet(grid_file))
+
+        return cls(gpd.read_file(grid_file))
+
+    def get_tile(self, tile_name):
+        """Get the CRS, the geotransform (20 m) and the footprint (in the CRS) of a tile.
+
+        Args:
+            tile_name (str): tile name. Ex: T33TWN or 33TWN
+
+        Returns:
+            dict: crs, transform, footprint (in the CRS) and geometry (lon/lat) of the tile
+        """
+        # The grid names have no 'T' (tile) notation. Ex: 33TWN
+        name = tile_name.upper()[-5:]
+        if name in self.tiles:
+            return self.tiles[name]
+
+        row = self.grid.loc[name]
+        description = row.get('description')
+
+        epsg = get_description_value(description, 'EPSG')
+        crs = CRS.from_epsg(int(epsg)) if epsg is not None else get_utm_crs(name)
+
+        utm_wkt = get_description_value(description, 'UTM_WKT')
+        if utm_wkt is not None:
+            footprint = wkt.loads(utm_wkt)
+        else:
+            footprint = reproject(densify(row.geometry, 0.01), 'EPSG:4326', crs)
+
+        # Upper left corner of the tile, in the grid of the pixels
+        min_x, _, _, max_y = footprint.bounds
+        transform = Affine(PIXEL_SIZE, 0, round(min_x / PIXEL_SIZE) * PIXEL_SIZE, 0, -PIXEL_SIZE, round(max_y / PIXEL_SIZE) * PIXEL_SIZE)
+        footprint = box(transform.c, transform.f - TILE_SIZE * PIXEL_SIZE, transform.c + TILE_SIZE * PIXEL_SIZE, transform.f)
+
+        self.tiles[name] = {'crs': crs, 'transform': transform, 'footprint': footprint, 'geometry': row.geometry}
+        return self.tiles[name]
+
+
+class OverlapPlanner:
+
+    def __init__(self, tile_grid : TileGrid, block_size=BLOCK_SIZE, shape=(TILE_SIZE, TILE_SIZE), margin=COVERAGE_MARGIN) -> None:
+        """Plan the blocks of each tile of an acquisition that are not processed by another tile.
+
+        Args:
+            tile_grid (TileGrid): footprints of the tiles
+            block_size (int, optional): size of the blocks (the same of transform_by_blocks). Defaults to BLOCK_SIZE.
+            shape (tuple, optional): shape of the tiles. Defaults to (TILE_SIZE, TILE_SIZE).
+            margin (float, optional): margin (metres) removed from the coverage of the other tiles. Defaults to COVERAGE_MARGIN.
+        """
+        self.tile_grid = tile_grid
+        self.block_size = block_size
+        self.shape = shape
+        self.margin = margin
+
+    def get_block_boxes(self, transform):
+        """Boxes of the blocks of a tile in its CRS.
+        """
+        grid_shape = (-(-self.shape[0] // self.block_size), -(-self.shape[1] // self.block_size))
+
+        boxes = []
+        for row in range(grid_shape[0]):
+            for col in range(grid_shape[1]):
+                rows = (row * self.block_size, min((row + 1) * self.block_size, self.shape[0]))
+                cols = (col * self.block_size, min((col + 1) * self.block_size, self.shape[1]))
+                min_x, max_y = transform * (cols[0], rows[0])
+                max_x, min_y = transform * (cols[1], rows[1])
+                boxes.append(box(min_x, min_y, max_x, max_y))
+
+        return grid_shape, boxes
+
+    def get_responsibility(self, tile_name, covering_tiles, footprints=None):
+        """Blocks of a tile that are not completely covered by other tiles.
+
+        Args:
+            tile_name (str): tile name
+            covering_tiles (list): tiles processed before the tile
+            footprints (dict, optional): data footprint (lon/lat) of the tiles, when smaller than the tile (ex: the edge of the swath). Defaults to None.
+
+        Returns:
+            np.array: responsible blocks (bool)
+        """
+        tile = self.tile_grid.get_tile(tile_name)
+        grid_shape, boxes = self.get_block_boxes(tile['transform'])
+
+        coverage = []
+        for covering_tile_name in covering_tiles:
+            covering_tile = self.tile_grid.get_tile(covering_tile_name)
+            if not covering_tile['geometry'].intersects(tile['geometry']):
+                continue
+
+            if footprints is not None and covering_tile_name in footprints:
+                covering = reproject(densify(footprints[covering_tile_name], 0.01), 'EPSG:4326', tile['crs'])
+            else:
+                covering = reproject(densify(covering_tile['footprint']), covering_tile['crs'], tile['crs'])
+
+            if covering.intersects(tile['footprint']):
+                coverage.append(covering)
+
+        if len(coverage) == 0:
+            return np.ones(grid_shape, dtype=bool)
+
+        coverage = prep(unary_union(coverage).buffer(-self.margin))
+        covered = np.array([coverage.contains(block_box) for block_box in boxes])
+
+        return ~covered.reshape(grid_shape)
+
+    def plan(self, tile_names, footprints=None):
+        """Plan the tiles of an acquisition: each tile is responsible for the blocks not covered by the tiles ranked before it.
+
+        Args:
+            tile_names (list): tiles of the acquisition (ex: T33TWN)
+            footprints (dict, optional): data footprint (lon/lat) of the tiles (see get_responsibility). Defaults to None.
+
+        Returns:
+            dict: responsible blocks of each tile
+        """
+        tile_names = sorted(tile_names)
+        return {tile_name: self.get_responsibility(tile_name, tile_names[:i], footprints) for i, tile_name in enumerate(tile_names)}
+
+    def plan_acquisitions(self, tile_files, footprints=None):
+        """Plan the tiles of each acquisition (tiles with the same timestamp).
+
+        Args:
+            tile_files (list): tile names or files (<grid>_<timestamp>_...)
+            footprints (dict, optional): data footprint (lon/lat) of the tile files. Defaults to None.
+
+        Returns:
+            dict: responsible blocks of each tile file
+        """
+        plans = {}
+        for timestamp, files in group_by_acquisition(tile_files).items():
+            grid_names = {get_acquisition(tile_file)[0]: tile_file for tile_file in files}
+            grid_footprints = None
+            if footprints is not None:
+                grid_footprints = {grid_name: footprints[tile_file] for grid_name, tile_file in grid_names.items() if tile_file in footprints}
+
+            for grid_name, responsibility in self.plan(list(grid_names), grid_footprints).items():
+                plans[grid_names[grid_name]] = responsibility
+
+        return plans
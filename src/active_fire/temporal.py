@@ -0,0 +1,206 @@
+''' Temporal store of the tiles and incremental (change-only) detection.
+A tile is revisited every ~5 days. The store keeps the compact products of the last acquisition of each tile:
+the block statistics (with the background mean of the bands, see image.blocks) and the fire mask (see image.sparse).
+A new acquisition is compared with the previous one block by block and the method is applied only to the blocks that
+changed materially (the max or the mean of the bands, or the number of pixels above the thresholds of the methods), to the blocks with fire in the previous acquisition (to confirm the persisting and the
+extinguished fires) and to their neighbour blocks (for the methods that use the neighbourhood).
+The fire pixels are reported as new, persisting and extinguished.
+'''
+import os
+import json
+import numpy as np
+from scipy import ndimage
+
+from image.sentinel import BufferedImageStack
+from image.blocks import BlockStats
+from image.sparse import SparseMask
+from image.cache import save_atomic
+from active_fire.general import ActiveFireIndex
+
+# Change of the block max or mean (reflectance) that triggers the detection in the block
+CHANGE_THRESHOLD = 0.05
+# Bands compared between the acquisitions
+CHANGE_BANDS = (12, 11, '8A')
+# B12 thresholds of the block prefilters of the methods (ex: Murphy B12 > 0.15, Liangrocapart B12 > 1.0).
+# A new hotspot below the max of a bright block (ex: a roof) changes the number of pixels above them, not the max
+CHANGE_COUNT_THRESHOLDS = (0.15, 0.355, 0.8, 1.0)
+# Relative change of a count (of the largest of the two counts) that triggers the detection in the block. The pixels close
+# to a threshold (ex: bright soil at B12 ~0.15) cross it in every revisit, a new hotspot is a large change of a small count
+# (ex: 0 -> 1 pixels above 0.8)
+CHANGE_COUNT_TOLERANCE = 0.25
+
+
+class TemporalTileStore:
+
+    def __init__(self, store_dir) -> None:
+        """Products of the last acquisition of each tile: <store_dir>/<grid>_state.json, _block_stats.npz and _mask.npz
+
+        Args:
+            store_dir (str): directory of the store
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def get_files(self, grid_name):
+        prefix = os.path.join(self.store_dir, grid_name)
+        return prefix + '_state.json', prefix + '_block_stats.npz', prefix + '_mask.npz'
+
+    def load(self, grid_name):
+        """Load the products of the last acquisition of a tile.
+
+        Args:
+            grid_name (str): grid name. Ex: T33TWN
+
+        Returns:
+            dict: timestamp, block_stats and mask (SparseMask) or None if the tile is not in the store
+        """
+        state_file, block_stats_file, mask_file = self.get_files(grid_name)
+        if not os.path.exists(state_file):
+            return None
+
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+
+        state['block_stats'] = BlockStats.load(block_stats_file)
+        state['mask'] = SparseMask.load(mask_file)
+
+        return state
+
+    def save(self, grid_name, timestamp, block_stats : BlockStats, mask : SparseMask):
+        """Save the products of an acquisition. The state is written last, so a partial update is never loaded.
+        """
+        state_file, block_stats_file, mask_file = self.get_files(grid_name)
+
+        save_atomic(block_stats_file, lambda f: block_stats.save(f))
+        save_atomic(mask_file, lambda f: mask.save(f))
+        save_atomic(state_file, lambda f: f.write(json.dumps({'timestamp': timestamp}).encode()))
+
+
+def compute_change_counts(block_stats : BlockStats, buffered_stack : BufferedImageStack, thresholds=CHANGE_COUNT_THRESHOLDS):
+    """Count the valid pixels of each block with B12 above each threshold and with B12 > B11 above the lowest threshold
+    (the fire signature, the dark pixels as water have B12 ~ B11).
+
+    Returns:
+        BlockStats: statistics with the counts
+    """
+    valid = buffered_stack.read_mask()
+    b12 = buffered_stack.read(12)
+    for threshold in thresholds:
+        block_stats.compute_counts('b12_{}'.format(threshold), valid & (b12 > threshold))
+
+    b11 = buffered_stack.read(11)
+    if b11 is not None:
+        block_stats.compute_counts('b12_gt_b11', valid & (b12 > b11) & (b12 > min(thresholds)))
+
+    return block_stats
+
+
+def is_comparable(previous_stats : BlockStats, current_stats : BlockStats, bands=CHANGE_BANDS):
+    """Check if the statistics of two acquisitions have the same blocks, bands and counts.
+    """
+    return previous_stats.shape == current_stats.shape and previous_stats.block_size == current_stats.block_size and \
+        set(previous_stats.counts) == set(current_stats.counts) and \
+        all((band in previous_stats.mean) == (band in current_stats.mean) for band in bands)
+
+
+def get_changed_blocks(previous_stats : BlockStats, current_stats : BlockStats, threshold=CHANGE_THRESHOLD, bands=CHANGE_BANDS,
+                       count_tolerance=CHANGE_COUNT_TOLERANCE):
+    """Blocks where the max or the mean of the bands, the number of valid pixels or the counts of pixels changed.
+    A count changes when the difference is larger than the tolerance of the largest count (any change of a zero count).
+
+    Returns:
+        np.array: changed blocks (bool)
+    """
+    changed = previous_stats.valid != current_stats.valid
+    for band in bands:
+        if band not in current_stats.mean:
+            continue
+
+        changed |= np.abs(current_stats.maximum[band] - previous_stats.maximum[band]) > threshold
+        changed |= np.abs(current_stats.mean[band] - previous_stats.mean[band]) > threshold
+
+    for name in current_stats.counts:
+        previous_count, current_count = previous_stats.counts[name], current_stats.counts[name]
+        changed |= np.abs(current_count - previous_count) > count_tolerance * np.maximum(current_count, previous_count)
+
+    return changed
+
+
+def get_fire_blocks(mask : SparseMask, block_size):
+    """Blocks with fire pixels.
+    """
+    rows, cols = mask.get_coords()
+    fire_blocks = np.zeros((-(-mask.shape[0] // block_size), -(-mask.shape[1] // block_size)), dtype=bool)
+    fire_blocks[rows // block_size, cols // block_size] = True
+
+    return fire_blocks
+
+
+def compare_masks(previous_mask : SparseMask, current_mask : SparseMask):
+    """Compare the fire pixels of two acquisitions of a tile.
+
+    Returns:
+        dict: new, persisting and extinguished fire pixels (SparseMask)
+    """
+    kwargs = {'shape': current_mask.shape, 'transform': current_mask.transform, 'crs': current_mask.crs}
+
+    return {
+        'new': SparseMask(np.setdiff1d(current_mask.indices, previous_mask.indices, assume_unique=True), **kwargs),
+        'persisting': SparseMask(np.intersect1d(current_mask.indices, previous_mask.indices, assume_unique=True), **kwargs),
+        'extinguished': SparseMask(np.setdiff1d(previous_mask.indices, current_mask.indices, assume_unique=True), **kwargs),
+    }
+
+
+def detect_changes(afi : ActiveFireIndex, buffered_stack : BufferedImageStack, grid_name, timestamp, store : TemporalTileStore, threshold=CHANGE_THRESHOLD, candidates=None, **kwargs):
+    """Detect the fire of an acquisition only in the blocks that changed since the previous acquisition of the tile.
+    The whole tile is processed if the tile is not in the store (or the previous acquisition is not comparable).
+
+    Args:
+        afi (ActiveFireIndex): active fire method
+        buffered_stack (BufferedImageStack): stack of the acquisition
+        grid_name (str): grid name of the tile. Ex: T33TWN
+        timestamp (str): timestamp of the acquisition (ex: 20200815T133851), the acquisitions must be processed in order
+        store (TemporalTileStore): store of the tiles (of the method)
+        threshold (float, optional): change of the block statistics that triggers the detection. Defaults to CHANGE_THRESHOLD.
+        candidates (np.array, optional): blocks to evaluate (ex: see active_fire.overlap). Defaults to None (all blocks).
+        kwargs: arguments of the method (ex: metadata)
+
+    Returns:
+        dict: mask (np.array), new, persisting and extinguished fire pixels (SparseMask), number of blocks and of blocks evaluated
+    """
+    current_stats = buffered_stack.get_block_stats(afi.block_size)
+    if len(current_stats.mean) == 0:
+        current_stats.compute_mean(buffered_stack)
+    if len(current_stats.counts) == 0:
+        compute_change_counts(current_stats, buffered_stack)
+
+    previous = store.load(grid_name)
+    comparable = previous is not None and previous['timestamp'] < timestamp and is_comparable(previous['block_stats'], current_stats)
+
+    evaluated = np.ones(current_stats.grid_shape, dtype=bool)
+    if comparable:
+        evaluated = get_changed_blocks(previous['block_stats'], current_stats, threshold)
+        evaluated |= get_fire_blocks(previous['mask'], current_stats.block_size)
+
+        # A change in a block can change the detections of the neighbour blocks (methods with halo)
+        if getattr(afi.algorithm, 'halo', 0) > 0:
+            evaluated = ndimage.binary_dilation(evaluated, structure=np.ones((3, 3), dtype=bool))
+
+    if candidates is not None:
+        evaluated &= candidates
+
+    mask = afi.transform(buffered_stack, candidates=evaluated, **kwargs)
+    current_mask = SparseMask.from_buffered_stack(mask, buffered_stack)
+
+    if comparable:
+        result = compare_masks(previous['mask'], current_mask)
+    else:
+        result = compare_masks(SparseMask(np.zeros(0), current_mask.shape), current_mask)
+
+    result.update(mask=mask, num_blocks=int(evaluated.size), num_evaluated_blocks=int(evaluated.sum()))
+
+    # The store keeps the last acquisition (an older acquisition processed later does not replace it)
+    if previous is None or previous['timestamp'] <= timestamp:
+        store.save(grid_name, timestamp, current_stats, current_mask)
+
+    return result
@@ -0,0 +1,182 @@
+''' Coarse-to-fine triage: decide if a tile has any fire without running the methods on the whole tile.
+1. The bands are read in strips and reduced to the min/max of each block (a decimation that keeps the hot pixels).
+   The overviews and decimated reads of GDAL resample the pixels (nearest, average...), so a single hot pixel can be lost.
+2. The blocks are ruled out by the block_prefilter of each method (see image.blocks).
+   A block without prefilter is always a candidate, so no fire detectable by the methods is missed.
+3. The methods are applied at full resolution to the candidate blocks (with the halo of the method),
+   the hottest blocks first, and the triage stops at the first confirmed fire.
+The JP2 bands are triaged without the conversion to TIFF: the strips and the windows of the candidate blocks are
+decoded directly (only the JP2 tiles of a window are decoded).
+'''
+import os
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from glob import glob
+
+from image.sentinel import BufferedImageStack, QUANTIFICATION_VALUE, SATURATION_VALUE, NO_DATA_VALUE, GDAL_NUM_THREADS
+from image.blocks import BlockStats, BLOCK_SIZE, reduce_blocks
+
+
+def get_band_files(tiff_path, extension='tif'):
+    """Get the band files of a tile converted to TIFF (<grid>_<timestamp>_<band>.tif) or downloaded (JP2).
+
+    Args:
+        tiff_path (str): directory of the band files
+        extension (str, optional): extension of the band files (tif or jp2). Defaults to 'tif'.
+
+    Returns:
+        dict: file of each band (12, 11, '8A')
+    """
+    band_files = {}
+    for band_file in glob(os.path.join(tiff_path, '*.{}'.format(extension))):
+        band = 12
+        if band_file.endswith('_B11.{}'.format(extension)):
+            band = 11
+        elif band_file.endswith('_B8A.{}'.format(extension)):
+            band = '8A'
+
+        band_files[band] = band_file
+
+    return band_files
+
+
+def read_valid_mask(src, data, window=None):
+    if src.nodata is None:
+        return data != NO_DATA_VALUE
+
+    return src.read_masks(1, window=window) > 0
+
+
+def read_block_stats(band_files, block_size=BLOCK_SIZE):
+    """Compute the block statistics of the band files, reading one strip of blocks at a time.
+
+    Args:
+        band_files (dict): file of each band
+        block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+
+    Returns:
+        BlockStats: statistics of the blocks (reflectance)
+    """
+    block_stats = None
+    for band, band_file in band_files.items():
+        with rasterio.Env(GDAL_NUM_THREADS=GDAL_NUM_THREADS), rasterio.open(band_file) as src:
+            if block_stats is None:
+                block_stats = BlockStats((src.height, src.width), block_size)
+                block_stats.valid = np.zeros(block_stats.grid_shape, dtype=np.int64)
+                valid = np.ones((src.height, src.width), dtype=bool) if len(band_files) > 1 else None
+            elif (src.height, src.width) != block_stats.shape:
+                raise Exception('Images with different shapes: {}'.format(band_file))
+
+            minimum, maximum, saturated = [], [], []
+            for row in range(block_stats.grid_shape[0]):
+                window = Window(0, row * block_size, src.width, min(block_size, src.height - row * block_size))
+                data = src.read(1, window=window)
+
+                minimum.append(reduce_blocks(data, block_size, np.min))
+                maximum.append(reduce_blocks(data, block_size, np.max))
+                saturated.append(reduce_blocks(data == SATURATION_VALUE, block_size, np.sum))
+
+                valid_strip = read_valid_mask(src, data, window)
+                if valid is not None:
+                    valid[row * block_size:(row + 1) * block_size] &= valid_strip
+                else:
+                    block_stats.valid[row] = reduce_blocks(valid_strip, block_size, np.sum)
+
+            block_stats.minimum[band] = np.concatenate(minimum) / QUANTIFICATION_VALUE
+            block_stats.maximum[band] = np.concatenate(maximum) / QUANTIFICATION_VALUE
+            block_stats.saturated[band] = np.concatenate(saturated)
+
+    if valid is not None:
+        block_stats.valid = reduce_blocks(valid, block_size, np.sum)
+
+    return block_stats
+
+
+def read_window_stack(band_files, rows, cols):
+    """Load a window of the band files as a stack (see BufferedImageStack.load_file_as_band).
+
+    Args:
+        band_files (dict): file of each band
+        rows (slice): rows of the window
+        cols (slice): columns of the window
+
+    Returns:
+        BufferedImageStack: stack with the window of each band
+    """
+    buffered_stack = BufferedImageStack()
+    window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+
+    for band, band_file in band_files.items():
+        buffered_stack.load_file_as_band(band_file, band, window=window)
+        buffered_stack.transform = buffered_stack.metas[band]['transform']
+
+    return buffered_stack
+
+
+def get_candidate_blocks(algorithms, block_stats, **kwargs):
+    """Blocks that can have detections of any method (methods without block_prefilter: all blocks).
+
+    Args:
+        algorithms (list): active fire methods (ex: YongxueAFI())
+        block_stats (BlockStats): statistics of the blocks
+
+    Returns:
+        np.array: candidate blocks (bool)
+    """
+    candidates = np.zeros(block_stats.grid_shape, dtype=bool)
+    for algorithm in algorithms:
+        if not hasattr(algorithm, 'block_prefilter'):
+            return np.ones(block_stats.grid_shape, dtype=bool)
+
+        candidates |= algorithm.block_prefilter(block_stats, **kwargs)
+
+    return candidates
+
+
+def triage_tile(band_files, algorithms, block_size=BLOCK_SIZE, **kwargs):
+    """Check if a tile has fire: the methods are applied only to the candidate blocks, until the first fire is confirmed.
+
+    Args:
+        band_files (dict): file of each band (see get_band_files)
+        algorithms (dict): active fire methods by name (ex: {'Yongxue': YongxueAFI()})
+        block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+        kwargs: arguments of the methods (ex: metadata)
+
+    Returns:
+        dict: has_fire, method and num_fire_pixels of the first confirmed fire (in its block), and the number of
+            blocks, candidate blocks and evaluated blocks
+    """
+    block_stats = read_block_stats(band_files, block_size)
+    candidates = get_candidate_blocks(algorithms.values(), block_stats, **kwargs)
+
+    result = {
+        'has_fire': False,
+        'method': None,
+        'num_fire_pixels': 0,
+        'num_blocks': int(candidates.size),
+        'num_candidate_blocks': int(candidates.sum()),
+        'num_evaluated_blocks': 0,
+    }
+
+    # The hottest blocks first
+    candidate_rows, candidate_cols = np.nonzero(candidates)
+    order = np.argsort(-block_stats.maximum[12][candidate_rows, candidate_cols], kind='stable')
+    halo = max(getattr(algorithm, 'halo', 0) for algorithm in algorithms.values())
+
+    for row, col in zip(candidate_rows[order], candidate_cols[order]):
+        core_rows, core_cols = block_stats.get_block_window(row, col)
+        rows, cols = block_stats.get_block_window(row, col, halo)
+        buffered_stack = read_window_stack(band_files, rows, cols)
+        result['num_evaluated_blocks'] += 1
+
+        for method, algorithm in algorithms.items():
+            mask = algorithm.transform(buffered_stack, **kwargs)
+            core_mask = mask[core_rows.start - rows.start:core_rows.stop - rows.start, core_cols.start - cols.start:core_cols.stop - cols.start]
+
+            num_fire_pixels = int(np.count_nonzero(core_mask))
+            if num_fire_pixels > 0:
+                result.update(has_fire=True, method=method, num_fire_pixels=num_fire_pixels)
+                return result
+
+    return result
@@ -0,0 +1,101 @@
+import numpy as np
+from active_fire.metrics import scores_from_counts
+
+
+class ThresholdSweep:
+
+    def __init__(self, thresholds) -> None:
+        """Evaluate a threshold detector (index > threshold) for many thresholds at once.
+        The index values are accumulated in histograms of fire and non-fire ground truth pixels, with the thresholds as bin edges.
+        The confusion matrix of every threshold is derived from the cumulative sums of the histograms,
+        so a sweep costs about one index computation, independently of the number of thresholds.
+        The counts are exact for the thresholds informed (there is no binning error).
+
+        Args:
+            thresholds (np.array): thresholds to evaluate (sorted in ascending order)
+        """
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        assert np.all(np.diff(self.thresholds) > 0), 'The thresholds must be sorted in ascending order'
+
+        # Bin 0: index <= thresholds[0] (or invalid pixels), bin i: thresholds[i-1] < index <= thresholds[i], last bin: index > thresholds[-1]
+        self.fire_hist = np.zeros(len(self.thresholds) + 1, dtype=np.int64)
+        self.background_hist = np.zeros(len(self.thresholds) + 1, dtype=np.int64)
+
+    def update(self, index, ground_truth, valid_mask=None):
+        """Accumulate the index values of an image.
+
+        Args:
+            index (np.array): continuous index
+            ground_truth (np.array): ground truth fire mask (bool)
+            valid_mask (np.array, optional): pixels with valid data. The invalid pixels are never detected. Defaults to None.
+
+        Returns:
+            self
+        """
+        # side='left' makes the bins right-closed, matching the strict comparison index > threshold
+        bins = np.searchsorted(self.thresholds, index.ravel(), side='left')
+        if valid_mask is not None:
+            bins[~valid_mask.ravel()] = 0
+
+        ground_truth = ground_truth.ravel().astype(bool)
+        num_bins = len(self.fire_hist)
+        self.fire_hist += np.bincount(bins[ground_truth], minlength=num_bins)
+        self.background_hist += np.bincount(bins[~ground_truth], minlength=num_bins)
+
+        return self
+
+    def merge(self, other):
+        """Add the histograms of another sweep with the same thresholds (ex: computed by another worker).
+        """
+        assert np.array_equal(self.thresholds, other.thresholds)
+        self.fire_hist += other.fire_hist
+        self.background_hist += other.background_hist
+
+        return self
+
+    def get_counts(self):
+        """Get the confusion matrix of each threshold.
+
+        Returns:
+            dict: tp, fp, fn and tn arrays (one value per threshold)
+        """
+        # Number of pixels with index > thresholds[i] is the sum of the bins i+1..end
+        fire_above = np.cumsum(self.fire_hist[::-1])[::-1][1:]
+        background_above = np.cumsum(self.background_hist[::-1])[::-1][1:]
+
+        total_fire = self.fire_hist.sum()
+        total_background = self.background_hist.sum()
+
+        return {
+            'tp': fire_above,
+            'fp': background_above,
+            'fn': total_fire - fire_above,
+            'tn': total_background - background_above,
+        }
+
+    def get_scores(self):
+        """Get the scores of each threshold.
+
+        Returns:
+            dict: threshold and the scores (see metrics.scores_from_counts), one value per threshold
+        """
+        counts = self.get_counts()
+        scores = scores_from_counts(counts['tp'], counts['fp'], counts['fn'], counts['tn'])
+        scores['threshold'] = self.thresholds
+        scores.update(counts)
+
+        return scores
+
+    def best(self, metric='f1'):
+        """Get the threshold with the best score.
+
+        Args:
+            metric (str, optional): score to maximize. Defaults to 'f1'.
+
+        Returns:
+            tuple(float, dict): the best threshold and its scores
+        """
+        scores = self.get_scores()
+        best_index = int(np.argmax(scores[metric]))
+
+        return self.thresholds[best_index], {key: value[best_index] for key, value in scores.items()}
@@ -0,0 +1,172 @@
+''' Summary statistics of the image blocks.
+Most of a tile has no fire. The cheapest conditions of the active fire methods (ex: B12 > 0.15) can be ruled out
+for a whole block using only the minimum and maximum of the bands in the block, so the methods are applied only
+to the blocks that can have detections (see active_fire.general.transform_by_blocks).
+'''
+import numpy as np
+
+BLOCK_SIZE = 256
+
+
+def reduce_blocks(data, block_size, reduce_function):
+    """Reduce each block of an image (ex: np.max). The blocks in the right and bottom borders can be smaller.
+
+    Args:
+        data (np.array): 2-D image
+        block_size (int): size of the blocks
+        reduce_function (callable): numpy reduction with the axis argument (np.min, np.max, np.sum...)
+
+    Returns:
+        np.array: one value per block
+    """
+    height, width = data.shape
+    num_rows = -(-height // block_size)
+    num_cols = -(-width // block_size)
+    full_width = (width // block_size) * block_size
+
+    result = []
+    for row in range(num_rows):
+        strip = data[row * block_size:(row + 1) * block_size]
+        values = []
+        if full_width > 0:
+            # The full blocks of the strip are reduced at once
+            values.append(reduce_function(strip[:, :full_width].reshape(strip.shape[0], -1, block_size), axis=(0, 2)))
+        if full_width < width:
+            values.append(np.atleast_1d(reduce_function(strip[:, full_width:])))
+        result.append(np.concatenate(values))
+
+    return np.array(result).reshape(num_rows, num_cols)
+
+
+def fit_grid(values, grid_shape):
+    """Crop or pad (repeating the border) the values of the blocks to a grid shape.
+    """
+    values = values[:grid_shape[0], :grid_shape[1]]
+    pad = ((0, grid_shape[0] - values.shape[0]), (0, grid_shape[1] - values.shape[1]))
+
+    return np.pad(values, pad, mode='edge')
+
+
+class BlockStats:
+
+    def __init__(self, shape, block_size=BLOCK_SIZE) -> None:
+        """Statistics of each block of an image stack: min, max and number of saturated pixels of each band,
+        and the number of valid pixels (valid in all bands). The mean of the bands and the counts of pixels are optional
+        (see compute_mean and compute_counts).
+
+        Args:
+            shape (tuple): shape of the bands
+            block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+        """
+        self.shape = tuple(shape)
+        self.block_size = block_size
+        self.grid_shape = (-(-self.shape[0] // block_size), -(-self.shape[1] // block_size))
+
+        self.minimum = {}
+        self.maximum = {}
+        self.mean = {}
+        # Number of pixels of a condition in each block, by name (see compute_counts)
+        self.counts = {}
+        self.saturated = {}
+        self.valid = None
+
+    @classmethod
+    def compute(cls, buffered_stack, block_size=BLOCK_SIZE):
+        """Compute the statistics of the bands loaded in a stack.
+        The min and max include the invalid pixels (nodata), so they are bounds of any value the methods can read.
+
+        Args:
+            buffered_stack (BufferedImageStack): stack with the bands loaded
+            block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+
+        Returns:
+            BlockStats: statistics of the blocks
+        """
+        first_band = next(iter(buffered_stack.buffer))
+        block_stats = cls(buffered_stack.read(first_band).shape, block_size)
+
+        for band in buffered_stack.buffer:
+            data = buffered_stack.read(band)
+            block_stats.minimum[band] = reduce_blocks(data, block_size, np.min)
+            block_stats.maximum[band] = reduce_blocks(data, block_size, np.max)
+            block_stats.saturated[band] = reduce_blocks(buffered_stack.get_saturated_mask(band), block_size, np.sum)
+
+        block_stats.valid = reduce_blocks(buffered_stack.read_mask(), block_size, np.sum)
+
+        return block_stats
+
+    def compute_mean(self, buffered_stack):
+        """Compute the mean of the valid pixels of each block (the background), not computed by default.
+
+        Args:
+            buffered_stack (BufferedImageStack): stack used to compute the statistics
+
+        Returns:
+            self: statistics with the mean of the bands
+        """
+        valid = buffered_stack.read_mask()
+        for band in buffered_stack.buffer:
+            band_sum = reduce_blocks(np.where(valid, buffered_stack.read(band), 0), self.block_size, np.sum)
+            self.mean[band] = band_sum / np.maximum(self.valid, 1)
+
+        return self
+
+    def compute_counts(self, name, mask):
+        """Count the pixels of a mask in each block (ex: the pixels above a threshold), kept in self.counts[name].
+
+        Args:
+            name (str): name of the count
+            mask (np.array): pixels to count (bool)
+
+        Returns:
+            self: statistics with the count
+        """
+        self.counts[name] = reduce_blocks(mask, self.block_size, np.sum)
+
+        return self
+
+    def get_block_window(self, row, col, halo=0):
+        """Get the pixel window of a block, with a margin of halo pixels (limited by the image borders).
+
+        Returns:
+            tuple(slice, slice): rows and columns of the window
+        """
+        return (
+            slice(max(row * self.block_size - halo, 0), min((row + 1) * self.block_size + halo, self.shape[0])),
+            slice(max(col * self.block_size - halo, 0), min((col + 1) * self.block_size + halo, self.shape[1])),
+        )
+
+    def save(self, file_path):
+        arrays = {'shape': np.array(self.shape), 'block_size': np.array(self.block_size), 'valid': self.valid}
+        for band in self.minimum:
+            arrays['min_{}'.format(band)] = self.minimum[band]
+            arrays['max_{}'.format(band)] = self.maximum[band]
+            arrays['saturated_{}'.format(band)] = self.saturated[band]
+            if band in self.mean:
+                arrays['mean_{}'.format(band)] = self.mean[band]
+        for name in self.counts:
+            arrays['count_{}'.format(name)] = self.counts[name]
+
+        np.savez_compressed(file_path, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            block_stats = cls(tuple(data['shape']), int(data['block_size']))
+            block_stats.valid = data['valid']
+            for key in data.files:
+                if key.startswith('count_'):
+                    block_stats.counts[key.replace('count_', '', 1)] = data[key]
+                if not key.startswith('min_'):
+                    continue
+
+                name = key.replace('min_', '')
+                # The band identifiers are numbers, except 8A
+                band = int(name) if name.isdigit() else name
+                block_stats.minimum[band] = data['min_{}'.format(name)]
+                block_stats.maximum[band] = data['max_{}'.format(name)]
+                block_stats.saturated[band] = data['saturated_{}'.format(name)]
+                if 'mean_{}'.format(name) in data.files:
+                    block_stats.mean[band] = data['mean_{}'.format(name)]
+
+        return block_stats
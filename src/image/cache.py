@@ -0,0 +1,148 @@
+''' Cache of preprocessed bands.
+Each band is stored once, already resampled and in the working dtype, as a .npy file with its valid data mask and meta.
+The cached bands are loaded as memory-mapped arrays, so the load is a page-in and the memory is shared by the processes
+that read the same stack.
+The entries are keyed by the stack name and the (hashed) path of the image directory, and keep the modification time and
+the size of the source stack: a band is loaded again when its stack changes.
+The scripts set the cache directory in BAND_CACHE_DIR. With None the bands are read from the stacks every run
+(see load_cached_stack_bands).
+'''
+import os
+import pickle
+import hashlib
+import numpy as np
+from image.sentinel import BufferedImageStack, load_buffered_stack_bands, get_band_stack_file
+
+
+class BandCache:
+
+    def __init__(self, cache_dir, dtype=None) -> None:
+        """Cache of the bands loaded from the image stacks.
+
+        Args:
+            cache_dir (str): directory where the bands are stored
+            dtype (np.dtype, optional): dtype of the cached bands. Defaults to None (keeps the dtype of the loaded bands, float64).
+        """
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+
+    def get_stack_dir(self, image_dir, stack_partial_name, spatial_resolution):
+        stack_partial_name = stack_partial_name.replace('.tif', '')
+        # Stacks with the same name in different directories are different entries
+        image_dir_hash = hashlib.sha1(os.path.abspath(image_dir).encode('utf-8')).hexdigest()[:12]
+
+        return os.path.join(self.cache_dir, '{}_{}m_{}'.format(stack_partial_name, spatial_resolution, image_dir_hash))
+
+    def get_band_files(self, stack_dir, band):
+        return (
+            os.path.join(stack_dir, 'band_{}.npy'.format(band)),
+            os.path.join(stack_dir, 'mask_{}.npy'.format(band)),
+            os.path.join(stack_dir, 'meta_{}.pkl'.format(band)),
+        )
+
+    def contains(self, image_dir, stack_partial_name, band, spatial_resolution=20):
+        """Check if a band is cached and its source stack did not change (same modification time and size).
+        """
+        stack_dir = self.get_stack_dir(image_dir, stack_partial_name, spatial_resolution)
+        band_files = self.get_band_files(stack_dir, band)
+        if not all(os.path.exists(f) for f in band_files):
+            return False
+
+        with open(band_files[2], 'rb') as f:
+            band_meta = pickle.load(f)
+
+        return band_meta.get('source') == get_source_signature(image_dir, stack_partial_name, band)
+
+    def load(self, image_dir, stack_partial_name, bands, spatial_resolution=20):
+        """Load the bands from the cache. The bands not cached yet are loaded from the image stacks and stored.
+
+        Args:
+            image_dir (str): Base path to the image stacks
+            stack_partial_name (str): Partial name of the stack, without the spacial resolution sufix
+            bands (tuple): bands to load.
+            spatial_resolution (int, optional): spacial resolution to resample the bands. Defaults to 20.
+
+        Returns:
+            BufferedImageStack: bands loaded (read-only memory-mapped arrays)
+        """
+        stack_dir = self.get_stack_dir(image_dir, stack_partial_name, spatial_resolution)
+
+        missing_bands = tuple(band for band in bands if not self.contains(image_dir, stack_partial_name, band, spatial_resolution))
+        if len(missing_bands) > 0:
+            # The signatures are taken before the read, a stack changed during the read is loaded again next time
+            sources = {band: get_source_signature(image_dir, stack_partial_name, band) for band in missing_bands}
+            buffered_stack = load_buffered_stack_bands(image_dir, stack_partial_name, missing_bands, spatial_resolution)
+            self.store(stack_dir, buffered_stack, sources)
+
+        buffered_stack = BufferedImageStack()
+        for band in bands:
+            band_file, mask_file, meta_file = self.get_band_files(stack_dir, band)
+            with open(meta_file, 'rb') as f:
+                band_meta = pickle.load(f)
+
+            buffered_stack.buffer[band] = np.load(band_file, mmap_mode='r')
+            buffered_stack.masks[band] = np.load(mask_file, mmap_mode='r')
+            buffered_stack.metas[band] = band_meta['meta']
+            buffered_stack.transform = band_meta['transform']
+
+        return buffered_stack
+
+    def store(self, stack_dir, buffered_stack : BufferedImageStack, sources=None):
+        """Store the bands of a stack. The files are written with a temporary name and renamed, so concurrent readers never see partial files.
+        The signature of the source of each band (see get_source_signature) is kept in the meta file.
+        """
+        if sources is None:
+            sources = {}
+
+        os.makedirs(stack_dir, exist_ok=True)
+
+        for band in buffered_stack.buffer:
+            band_file, mask_file, meta_file = self.get_band_files(stack_dir, band)
+
+            data = buffered_stack.read(band)
+            if self.dtype is not None:
+                data = data.astype(self.dtype)
+
+            save_atomic(band_file, lambda f: np.save(f, data))
+            save_atomic(mask_file, lambda f: np.save(f, buffered_stack.read_mask(band)))
+            save_atomic(meta_file, lambda f: pickle.dump({
+                'meta': buffered_stack.metas[band], 'transform': buffered_stack.transform, 'source': sources.get(band),
+            }, f))
+
+
+def get_source_signature(image_dir, stack_partial_name, band):
+    """Path, modification time and size of the stack with a band (None if it does not exist).
+    """
+    image_path, _ = get_band_stack_file(image_dir, stack_partial_name, band)
+    if not os.path.exists(image_path):
+        return None
+
+    stat = os.stat(image_path)
+
+    return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+
+def save_atomic(file_path, save_function):
+    tmp_file = '{}.{}.tmp'.format(file_path, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        save_function(f)
+    os.replace(tmp_file, file_path)
+
+
+def load_cached_stack_bands(cache_dir, image_dir, stack_partial_name, bands, spatial_resolution=20):
+    """Same as load_buffered_stack_bands, but the bands are read from the cache (and stored in it on the first load).
+
+    Args:
+        cache_dir (str): directory of the band cache. If None the bands are loaded from the stacks without cache
+        image_dir (str): Base path to the image stacks
+        stack_partial_name (str): Partial name of the stack, without the spacial resolution sufix
+        bands (tuple): bands to load.
+        spatial_resolution (int, optional): spacial resolution to resample the bands. Defaults to 20.
+
+    Returns:
+        BufferedImageStack: bands loaded
+    """
+    if cache_dir is None:
+        return load_buffered_stack_bands(image_dir, stack_partial_name, bands, spatial_resolution)
+
+    return BandCache(cache_dir).load(image_dir, stack_partial_name, bands, spatial_resolution)
@@ -0,0 +1,237 @@
+''' Local catalog of Sentinel-2 granules.
+The catalog is a SQLite file keyed by MGRS tile, sensing time and product id.
+It is populated in bulk (from the Google Cloud index.csv or from Earth Engine results) and queried offline
+with the same interface of the EarthEngineCollectionSearch (search_tile_name, search_dates, search_point).
+'''
+import sqlite3
+import csv
+import gzip
+from datetime import datetime
+
+
+CATALOG_COLUMNS = ('granule_id', 'product_id', 'id', 'mgrs_tile', 'sensing_time', 'cloud_cover', 'north_lat', 'south_lat', 'west_lon', 'east_lon', 'base_url')
+
+
+class GranuleCatalog:
+
+    def __init__(self, catalog_file=':memory:') -> None:
+        self.catalog_file = catalog_file
+        self.connection = sqlite3.connect(catalog_file)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+        self.clear_search()
+
+    def create_tables(self):
+        """Create the granule table and the indexes used by the searches
+        """
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS granules (
+                granule_id TEXT PRIMARY KEY,
+                product_id TEXT NOT NULL,
+                id TEXT,
+                mgrs_tile TEXT NOT NULL,
+                sensing_time TEXT NOT NULL,
+                cloud_cover REAL,
+                north_lat REAL,
+                south_lat REAL,
+                west_lon REAL,
+                east_lon REAL,
+                base_url TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_granules_tile_time ON granules (mgrs_tile, sensing_time);
+            CREATE INDEX IF NOT EXISTS idx_granules_time ON granules (sensing_time);
+            CREATE INDEX IF NOT EXISTS idx_granules_product ON granules (product_id);
+        ''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def search_tile_name(self, tile_name : str):
+        """Filter a specific MGRS tile. The 'T' (tile) notation is optional.
+
+        Args:
+            tile_name (str): tile name. Ex: T53SNA or 53SNA
+
+        Returns:
+            self: Catalog filtered
+        """
+        tile_name = tile_name.upper()
+        # remove the 'T' (tile) notation
+        if tile_name.startswith('T'):
+            tile_name = tile_name[1:]
+
+        self.filters.append(('mgrs_tile = ?', (tile_name,)))
+
+        return self
+
+    def search_dates(self, start_date, end_date):
+        """Filter a date range. The start date is included and the end date is NOT included, as in Earth Engine.
+        The dates can be datetime objects or strings in the format 'Y-m-d'
+
+        Args:
+            start_date (str|datetime): initial date
+            end_date (str|datetime): final date
+
+        Returns:
+            self: Catalog filtered by date
+        """
+        self.filters.append(('sensing_time >= ? AND sensing_time < ?', (to_iso_date(start_date), to_iso_date(end_date))))
+
+        return self
+
+    def search_point(self, point):
+        """Filter the granules whose footprint bounding box contains a point.
+
+        Args:
+            point (tuple): Long-Lat point
+
+        Returns:
+            self: Catalog filtered
+        """
+        lon, lat = point[0], point[1]
+        self.filters.append(('south_lat <= ? AND north_lat >= ? AND west_lon <= ? AND east_lon >= ?', (lat, lat, lon, lon)))
+
+        return self
+
+    def search_granule_id(self, granule_id : str):
+        self.filters.append(('granule_id = ?', (granule_id,)))
+
+        return self
+
+    def clear_search(self):
+        """Remove all filters from the catalog
+        """
+        self.filters = []
+
+    def get_granule_info(self):
+        """Get the granules that match the current filters.
+
+        Returns:
+            list: granules information, with the same keys returned by SentinelDownloader.get_granule_info
+        """
+        query = 'SELECT * FROM granules'
+        params = []
+        if len(self.filters) > 0:
+            query += ' WHERE ' + ' AND '.join('({})'.format(condition) for condition, _ in self.filters)
+            for _, values in self.filters:
+                params.extend(values)
+        query += ' ORDER BY mgrs_tile, sensing_time'
+
+        self.granule_info = [dict(row) for row in self.connection.execute(query, params)]
+
+        return self.granule_info
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM granules').fetchone()[0]
+
+    def insert_granules(self, granules):
+        """Insert (or replace) granules in the catalog.
+        Each granule must have at least the granule_id, product_id, mgrs_tile and sensing_time keys.
+
+        Args:
+            granules (iterable): granules information (dict)
+
+        Returns:
+            int: number of granules inserted
+        """
+        query = 'INSERT OR REPLACE INTO granules ({}) VALUES ({})'.format(', '.join(CATALOG_COLUMNS), ', '.join('?' * len(CATALOG_COLUMNS)))
+        rows = (tuple(granule.get(column) for column in CATALOG_COLUMNS) for granule in granules)
+
+        with self.connection:
+            cursor = self.connection.executemany(query, rows)
+
+        return cursor.rowcount
+
+    def load_index_csv(self, index_file, tiles=None, start_date=None, end_date=None, chunk_size=100000):
+        """Populate the catalog from the Sentinel-2 index of the Google Cloud public bucket (index.csv or index.csv.gz).
+        Only the L1C granules are stored. The index can be restricted to some tiles and to a date range.
+
+        Args:
+            index_file (str): path to the index.csv(.gz) file
+            tiles (iterable, optional): tiles to keep. Defaults to None (all tiles).
+            start_date (str|datetime, optional): initial date (included). Defaults to None.
+            end_date (str|datetime, optional): final date (NOT included). Defaults to None.
+            chunk_size (int, optional): number of rows inserted per transaction. Defaults to 100000.
+
+        Returns:
+            int: number of granules inserted
+        """
+        if tiles is not None:
+            tiles = set(tile.upper()[1:] if tile.upper().startswith('T') else tile.upper() for tile in tiles)
+
+        start_date = to_iso_date(start_date) if start_date is not None else None
+        end_date = to_iso_date(end_date) if end_date is not None else None
+
+        open_function = gzip.open if index_file.endswith('.gz') else open
+
+        num_granules = 0
+        with open_function(index_file, 'rt') as f:
+            chunk = []
+            for row in csv.DictReader(f):
+                granule = parse_index_row(row)
+                if granule is None:
+                    continue
+
+                if tiles is not None and granule['mgrs_tile'] not in tiles:
+                    continue
+                if start_date is not None and granule['sensing_time'] < start_date:
+                    continue
+                if end_date is not None and granule['sensing_time'] >= end_date:
+                    continue
+
+                chunk.append(granule)
+                if len(chunk) >= chunk_size:
+                    self.insert_granules(chunk)
+                    num_granules += len(chunk)
+                    chunk = []
+
+            if len(chunk) > 0:
+                self.insert_granules(chunk)
+                num_granules += len(chunk)
+
+        return num_granules
+
+
+def parse_index_row(row):
+    """Convert a row of the Google Cloud index.csv to the catalog format.
+
+    Args:
+        row (dict): row of the index
+
+    Returns:
+        dict: granule information or None if it is not a L1C granule
+    """
+    product_id = row['PRODUCT_ID']
+    if '_MSIL1C_' not in product_id:
+        return None
+
+    return {
+        'granule_id': row['GRANULE_ID'],
+        'product_id': product_id,
+        'id': None,
+        'mgrs_tile': row['MGRS_TILE'],
+        'sensing_time': row['SENSING_TIME'][:19],
+        'cloud_cover': to_float(row.get('CLOUD_COVER')),
+        'north_lat': to_float(row.get('NORTH_LAT')),
+        'south_lat': to_float(row.get('SOUTH_LAT')),
+        'west_lon': to_float(row.get('WEST_LON')),
+        'east_lon': to_float(row.get('EAST_LON')),
+        'base_url': row.get('BASE_URL'),
+    }
+
+
+def to_iso_date(date):
+    """Convert a date (datetime or 'Y-m-d' string) to the ISO format used by the catalog
+    """
+    if isinstance(date, datetime):
+        return date.strftime('%Y-%m-%dT%H:%M:%S')
+
+    return datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def to_float(value):
+    if value is None or value == '':
+        return None
+
+    return float(value)
@@ -105,11 +105,28 @@ class SentinelDownloader(EarthEngineCollectionSearch):
         collection_info = self.collection.getInfo()
 
         for feature in collection_info['features']:
-            self.granule_info.append({
+            properties = feature['properties']
+            granule = {
                 'id': feature['id'],
-                'granule_id': feature['properties']['GRANULE_ID'], 
-                'product_id': feature['properties']['PRODUCT_ID'], 
-            })
+                'granule_id': properties['GRANULE_ID'], 
+                'product_id': properties['PRODUCT_ID'], 
+                'mgrs_tile': properties.get('MGRS_TILE'),
+                'cloud_cover': properties.get('CLOUDY_PIXEL_PERCENTAGE'),
+            }
+
+            if 'system:time_start' in properties:
+                sensing_time = datetime.utcfromtimestamp(properties['system:time_start'] / 1000.0)
+                granule['sensing_time'] = sensing_time.strftime('%Y-%m-%dT%H:%M:%S')
+
+            # Bounding box of the footprint, used by the offline catalog
+            if 'system:footprint' in properties:
+                coordinates = properties['system:footprint']['coordinates']
+                granule['west_lon'] = min(c[0] for c in coordinates)
+                granule['east_lon'] = max(c[0] for c in coordinates)
+                granule['south_lat'] = min(c[1] for c in coordinates)
+                granule['north_lat'] = max(c[1] for c in coordinates)
+
+            self.granule_info.append(granule)
 
         return self.granule_info
 
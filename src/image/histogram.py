@@ -0,0 +1,214 @@
+import os
+import numpy as np
+from image.sentinel import BufferedImageStack, load_buffered_stack_bands
+
+# Bands used by the pixel-wise methods (Sahm, PierreMarkuse, Liangrocapart and the biome methods)
+BAND_HISTOGRAM_BANDS = (4, '8A', 11, 12)
+BAND_HISTOGRAM_SUFIX = '_band_histogram.npz'
+# Quantization step of the reflectance, the resolution of the thresholds evaluated with the histograms
+HISTOGRAM_STEP = 0.005
+# Maximum reflectance quantized, the bigger values (and the saturated pixels) share the bin after it
+HISTOGRAM_MAX_VALUE = 1.0
+
+
+class JointHistogram:
+
+    def __init__(self, dimensions, scales=None, max_codes=None) -> None:
+        """Sparse joint histogram of quantized values (ex: the bands of the pixels).
+        Each value is quantized as round(value * scale). Only the non-empty cells are stored (codes as uint16 and counts
+        as uint32).
+        The default quantization is coarse: steps of HISTOGRAM_STEP (0.005) of reflectance up to HISTOGRAM_MAX_VALUE (1.0)
+        and one saturation bin for the bigger values. The counts of a threshold are exact only for thresholds on the
+        steps (ex: 0.15 or 0.355), other thresholds are rounded to the nearest step. Use scale=QUANTIFICATION_VALUE and
+        max_code=SATURATION_VALUE (image.sentinel) to keep the reflectance of the L1C products without loss.
+
+        Args:
+            dimensions (tuple): name of each dimension (ex: band identifiers)
+            scales (tuple, optional): quantization scale of each dimension (None uses the default). Defaults to None (1 / HISTOGRAM_STEP).
+            max_codes (tuple, optional): maximum code of each dimension, bigger values are clipped (None uses the default).
+                Defaults to None (the code of HISTOGRAM_MAX_VALUE plus the saturation bin).
+        """
+        self.dimensions = tuple(dimensions)
+        if scales is None:
+            scales = (None,) * len(self.dimensions)
+        if max_codes is None:
+            max_codes = (None,) * len(self.dimensions)
+
+        default_scale = 1.0 / HISTOGRAM_STEP
+        self.scales = tuple(float(default_scale if scale is None else scale) for scale in scales)
+        self.max_codes = tuple(
+            int(round(HISTOGRAM_MAX_VALUE * scale) + 1 if max_code is None else max_code) for scale, max_code in zip(self.scales, max_codes)
+        )
+        self.shape = tuple(max_code + 1 for max_code in self.max_codes)
+        self.cells_dtype = np.uint16 if max(self.max_codes, default=0) <= np.iinfo(np.uint16).max else np.int64
+
+        # One row of codes per non-empty cell
+        self.cells = np.zeros((0, len(self.dimensions)), dtype=self.cells_dtype)
+        self.counts = np.zeros(0, dtype=np.uint32)
+
+    def quantize(self, dimension_index, values):
+        codes = np.rint(np.asarray(values, dtype=np.float64) * self.scales[dimension_index])
+        return np.clip(codes, 0, self.max_codes[dimension_index]).astype(np.int64)
+
+    def update(self, values, mask=None):
+        """Add the values of some pixels.
+
+        Args:
+            values (list): array of values of each dimension (all with the same shape)
+            mask (np.array, optional): pixels to add. Defaults to None (all pixels).
+
+        Returns:
+            self
+        """
+        assert len(values) == len(self.dimensions)
+
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool).ravel()
+            values = [np.asarray(value).ravel()[mask] for value in values]
+        else:
+            values = [np.asarray(value).ravel() for value in values]
+
+        cells = np.stack([self.quantize(index, value) for index, value in enumerate(values)], axis=-1)
+
+        return self.add_cells(cells, np.ones(len(cells), dtype=np.uint32))
+
+    def add_cells(self, cells, counts):
+        cells = np.concatenate([self.cells, cells])
+        counts = np.concatenate([self.counts, counts])
+
+        # Only the range of codes present is indexed, it usually fits in one integer even with many dimensions
+        shape = tuple(int(max_code) + 1 for max_code in cells.max(axis=0)) if len(cells) > 0 else self.shape
+        if np.prod(shape, dtype=np.float64) < 2**63:
+            # Fast path: each cell is identified by a single integer
+            codes, inverse = np.unique(np.ravel_multi_index(cells.T.astype(np.int64), shape), return_inverse=True)
+            self.cells = np.stack(np.unravel_index(codes, shape), axis=-1).astype(self.cells_dtype)
+        else:
+            cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+            self.cells = cells.astype(self.cells_dtype)
+
+        counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(self.cells))
+        # The merged histograms of many images can exceed the uint32 counts
+        self.counts = counts.astype(np.uint32 if len(counts) == 0 or counts.max() <= np.iinfo(np.uint32).max else np.uint64)
+
+        return self
+
+    def merge(self, other):
+        """Add the cells of another histogram with the same dimensions (ex: computed by another worker).
+        """
+        assert self.dimensions == other.dimensions and self.scales == other.scales and self.max_codes == other.max_codes
+        return self.add_cells(other.cells, other.counts)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def get_codes(self, dimension):
+        return self.cells[:, self.dimensions.index(dimension)]
+
+    def get_values(self, dimension):
+        """Get the representative value of each cell in a dimension (code / scale).
+        """
+        index = self.dimensions.index(dimension)
+        return self.get_codes(dimension) / self.scales[index]
+
+    def select(self, cells_mask):
+        """Get a histogram with only some cells.
+
+        Args:
+            cells_mask (np.array): cells to keep (bool, one value per cell)
+
+        Returns:
+            JointHistogram: histogram with the cells selected
+        """
+        histogram = JointHistogram(self.dimensions, self.scales, self.max_codes)
+        histogram.cells = self.cells[cells_mask]
+        histogram.counts = self.counts[cells_mask]
+
+        return histogram
+
+    def to_stack(self, dimensions=None):
+        """Build a stack where each "pixel" is a cell of the histogram (1-D bands with the representative values).
+        The active fire methods that work pixel by pixel can be applied to the stack to know which cells are detected.
+
+        Args:
+            dimensions (tuple, optional): dimensions loaded as bands. Defaults to None (all dimensions).
+
+        Returns:
+            BufferedImageStack: stack with one band per dimension and all pixels valid
+        """
+        if dimensions is None:
+            dimensions = self.dimensions
+
+        buffered_stack = BufferedImageStack()
+        for dimension in dimensions:
+            buffered_stack.buffer[dimension] = self.get_values(dimension)
+            buffered_stack.masks[dimension] = np.ones(len(self.cells), dtype=bool)
+            buffered_stack.metas[dimension] = {'count': 1, 'width': len(self.cells), 'height': 1}
+
+        return buffered_stack
+
+    def count(self, predicate, **parameters):
+        """Count the pixels detected by a pixel-wise method, without the image.
+
+        Args:
+            predicate (callable): function(buffered_stack, **parameters) returning the detected pixels (ex: an AFI transform).
+                Only pixel-wise methods can be evaluated, the cells have no neighbourhood
+            parameters: parameters of the predicate
+
+        Returns:
+            int: number of pixels detected
+        """
+        detected = predicate(self.to_stack(), **parameters)
+        return int(self.counts[np.asarray(detected, dtype=bool)].sum())
+
+    def save(self, file_path):
+        np.savez_compressed(
+            file_path,
+            cells=self.cells,
+            counts=self.counts,
+            dimensions=np.array([str(dimension) for dimension in self.dimensions]),
+            scales=np.array(self.scales),
+            max_codes=np.array(self.max_codes),
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            # The band identifiers are numbers, except 8A
+            dimensions = [int(dimension) if dimension.isdigit() else str(dimension) for dimension in data['dimensions']]
+            histogram = cls(dimensions, data['scales'], data['max_codes'])
+            histogram.cells = data['cells']
+            histogram.counts = data['counts']
+
+        return histogram
+
+
+def get_band_histogram_file(directory, stack_partial_name):
+    return os.path.join(directory, '{}{}'.format(stack_partial_name.replace('.tif', ''), BAND_HISTOGRAM_SUFIX))
+
+
+def build_band_histogram(image_dir, stack_partial_name, output_dir, bands=BAND_HISTOGRAM_BANDS, buffered_stack=None):
+    """Build the band histogram of an image and save it as a sidecar file (<stack>_band_histogram.npz).
+    Only the valid pixels are counted. The sidecar answers how many pixels a pixel-wise method would detect
+    with other parameters, without reading the image again.
+
+    Args:
+        image_dir (str): Base path to the image stacks
+        stack_partial_name (str): Partial name of the stack, without the spacial resolution sufix
+        output_dir (str): directory of the sidecar files
+        bands (tuple, optional): bands of the histogram. Defaults to BAND_HISTOGRAM_BANDS.
+        buffered_stack (BufferedImageStack, optional): bands already loaded. Defaults to None (loaded from the stacks).
+
+    Returns:
+        str: path to the sidecar file
+    """
+    if buffered_stack is None:
+        buffered_stack = load_buffered_stack_bands(image_dir, stack_partial_name, bands)
+
+    histogram = JointHistogram(bands)
+    histogram.update([buffered_stack.read(band) for band in bands], mask=buffered_stack.read_mask())
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = get_band_histogram_file(output_dir, stack_partial_name)
+    histogram.save(output_file)
+
+    return output_file
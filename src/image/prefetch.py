@@ -0,0 +1,139 @@
+''' Prefetching of the image stacks.
+The batch scripts load the bands of a tile and then apply the methods, so the CPU is idle while the bands are read.
+The loader reads the next tiles in a pool of background threads while the current tile is processed (the rasterio/GDAL
+reads release the GIL). The tiles read ahead are limited by the depth and by a memory budget: the bytes of the
+tiles loaded and not consumed yet. The tile being processed is not counted, it belongs to the consumer.
+The memory-mapped bands (ex: the band cache, see image.cache) are not counted, they are paged in on demand.
+The scripts set the depth and the budget in PREFETCH_DEPTH and PREFETCH_MEMORY_BUDGET (the defaults below).
+'''
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from image.sentinel import BufferedImageStack
+
+# Number of tiles loaded ahead of the tile being processed
+PREFETCH_DEPTH = 2
+# Maximum bytes of the tiles loaded ahead (a 20 m band of a tile in float64 has ~240 MB)
+PREFETCH_MEMORY_BUDGET = 2 * 1024 ** 3
+# Number of threads reading the tiles
+PREFETCH_WORKERS = 2
+
+
+def get_loaded_size(value):
+    """Bytes of the arrays of a loaded value (BufferedImageStack, np.array or a tuple/list of them).
+    The memory-mapped arrays are not counted.
+    """
+    if isinstance(value, BufferedImageStack):
+        return get_loaded_size(list(value.buffer.values()) + list(value.masks.values()))
+
+    if isinstance(value, np.ndarray):
+        return 0 if isinstance(value, np.memmap) else value.nbytes
+
+    if isinstance(value, (tuple, list)):
+        return sum(get_loaded_size(v) for v in value)
+
+    return 0
+
+
+class PrefetchLoader:
+
+    def __init__(self, items, load_function, depth=PREFETCH_DEPTH, memory_budget=PREFETCH_MEMORY_BUDGET, num_workers=PREFETCH_WORKERS) -> None:
+        """Iterate over the items and their loaded values, loading the next items in background threads.
+
+        Args:
+            items (iterable): items to load (ex: stack names)
+            load_function (callable): function that loads an item (ex: returns a BufferedImageStack), called in the threads
+            depth (int, optional): maximum number of items loaded ahead. Defaults to PREFETCH_DEPTH.
+            memory_budget (int, optional): maximum bytes of the items loaded ahead (see get_loaded_size). The next item is
+                always loaded, even if it exceeds the budget. Defaults to PREFETCH_MEMORY_BUDGET (None for no limit).
+            num_workers (int, optional): number of threads. Defaults to PREFETCH_WORKERS.
+        """
+        self.items = items
+        self.load_function = load_function
+        self.depth = max(depth, 1)
+        self.memory_budget = memory_budget
+        self.num_workers = num_workers
+
+        self.lock = threading.Lock()
+        # Size of the largest item loaded, used as the size of the items still loading
+        self.max_item_size = 0
+        self.num_loaded = 0
+        # Items that failed to load, with the error
+        self.errors = []
+
+    def load(self, item):
+        try:
+            value = self.load_function(item)
+        except Exception as e:
+            print('[ERROR] Loading: {} - {}'.format(item, e))
+            return None, 0, e
+
+        size = get_loaded_size(value)
+        with self.lock:
+            self.max_item_size = max(self.max_item_size, size)
+            self.num_loaded += 1
+
+        return value, size, None
+
+    def get_pending_size(self, pending):
+        size = 0
+        for _, future in pending:
+            size += future.result()[1] if future.done() else self.max_item_size
+
+        return size
+
+    def can_prefetch(self, pending):
+        if len(pending) == 0:
+            return True
+
+        if len(pending) >= self.depth:
+            return False
+
+        if self.memory_budget is None:
+            return True
+
+        # The size of the items is unknown until the first one is loaded
+        if self.num_loaded == 0:
+            return False
+
+        return self.get_pending_size(pending) + self.max_item_size <= self.memory_budget
+
+    def __iter__(self):
+        """Yield each item with its loaded value, in the order of the items.
+        The value is None if the load failed (the error is kept in self.errors).
+
+        Yields:
+            tuple: item and loaded value
+        """
+        items = iter(self.items)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+        def fill():
+            while self.can_prefetch(pending):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append((item, executor.submit(self.load, item)))
+
+        try:
+            while True:
+                fill()
+                if len(pending) == 0:
+                    return
+
+                item, future = pending.popleft()
+                value, _, error = future.result()
+                if error is not None:
+                    self.errors.append((item, error))
+
+                # The next items are loaded while the consumer processes this one
+                fill()
+                yield item, value
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
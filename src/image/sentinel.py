@@ -1,9 +1,13 @@
 import rasterio
 from rasterio.enums import Resampling
+from affine import Affine
 import numpy as np
 import os
 import sys
+import shutil
+import tempfile
 from utils.reflectance_conversion import get_image_metadata, get_radiance
+from image.blocks import BlockStats, BLOCK_SIZE
 
 STACK_10M_BANDS_MAP = {
     2: 1,
@@ -35,6 +39,15 @@ QUANTIFICATION_VALUE = 10000.0
 SATURATION_VALUE = 65535
 NO_DATA_VALUE = 0
 
+# Threads of the GDAL decoders (ex: JP2OpenJPEG). 'ALL_CPUS' or the number of threads
+GDAL_NUM_THREADS = 'ALL_CPUS'
+# Drivers that can not update the files (the bands are opened read-only)
+READ_ONLY_EXTENSIONS = ('.jp2',)
+
+# Directory of the shared stacks. On Linux /dev/shm is backed by memory, so the files are never written to disk.
+# It can be small (ex: 64 MB in Docker), the stacks that do not fit are written to the temporary directory
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 class ImageStack:
 
     def __init__(self, dataset, mtd_tl_xml = None, mtd_msil_xml = None):
@@ -119,6 +132,8 @@ class BufferedImageStack:
         self.metas = {}
         self.transform = None
         self.masks = {}
+        # Block statistics by block size, computed on demand (see get_block_stats)
+        self.block_stats = {}
 
     def load_band_from_stack(self, img_stack : ImageStack, band, scale = 1.0):
         """Load a specific band to memory. 
@@ -129,6 +144,7 @@ class BufferedImageStack:
             scale (float, optional): [description]. Defaults to 1.0.
         """
         self.transform = img_stack.transform
+        self.block_stats = {}
         if scale == 1.0:
             data = img_stack.read(band)
         else:
@@ -140,19 +156,38 @@ class BufferedImageStack:
         # store the valid pixel max as boolean
         self.masks[band] = (img_stack.masks[band] > 0)
 
-    def load_file_as_band(self, image_path, band, use_raw=False):
-        
-        with rasterio.open(image_path, 'r+') as src:
-            data = src.read(1)
+    def load_file_as_band(self, image_path, band, use_raw=False, window=None, num_threads=GDAL_NUM_THREADS, read_only=True):
+        """Load a band file (GeoTIFF or JP2) to memory.
+        The files without nodata use NO_DATA_VALUE. By default the nodata is set only in memory, so the files are
+        opened read-only and many workers can read the same files concurrently (ex: from a shared mount).
+
+        Args:
+            image_path (str): band file
+            band (mixed): band identifier
+            use_raw (bool, optional): keep the digital numbers instead of the reflectance. Defaults to False.
+            window (Window, optional): read only a window of the band (only the JP2 tiles of the window are decoded). Defaults to None.
+            num_threads (mixed, optional): threads of the GDAL decoder. Defaults to GDAL_NUM_THREADS.
+            read_only (bool, optional): open the file read-only. If False, the nodata is also written to the GeoTIFF files
+                without it (the file is opened for update). Defaults to True.
+        """
+        self.block_stats = {}
+
+        # The JP2 files can not be updated
+        read_only = read_only or image_path.lower().endswith(READ_ONLY_EXTENSIONS)
+        with rasterio.Env(GDAL_NUM_THREADS=num_threads), rasterio.open(image_path, 'r' if read_only else 'r+') as src:
+            data = src.read(1, window=window)
             meta = src.meta
+            if window is not None:
+                meta.update(width=data.shape[1], height=data.shape[0], transform=src.window_transform(window))
+
             if meta['nodata'] is None:
-                src.nodata = NO_DATA_VALUE
-                src.meta.update(nodata=NO_DATA_VALUE)
+                if not read_only:
+                    src.nodata = NO_DATA_VALUE
                 meta.update(nodata=NO_DATA_VALUE)
                 
                 self.masks[band] = (data != NO_DATA_VALUE)
             else:
-                self.masks[band] = src.read_masks(1)
+                self.masks[band] = src.read_masks(1, window=window) > 0
             
         self.metas[band] = meta
         self.buffer[band] = data
@@ -193,6 +228,51 @@ class BufferedImageStack:
 
     def set_band(self, band_number, band_value):
         self.buffer[band_number] = band_value
+        self.block_stats = {}
+
+    def get_block_stats(self, block_size=BLOCK_SIZE):
+        """Get the statistics of the blocks of the bands loaded (see image.blocks.BlockStats).
+        The statistics are computed once and kept until a band changes.
+
+        Args:
+            block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+
+        Returns:
+            BlockStats: statistics of the blocks
+        """
+        if block_size not in self.block_stats:
+            self.block_stats[block_size] = BlockStats.compute(self, block_size)
+
+        return self.block_stats[block_size]
+
+    def window(self, rows, cols):
+        """Get a view of a window of the stack. The arrays are not copied.
+
+        Args:
+            rows (slice): rows of the window
+            cols (slice): columns of the window
+
+        Returns:
+            BufferedImageStack: stack with the window of each band
+        """
+        window_stack = BufferedImageStack()
+        offset = Affine.translation(cols.start or 0, rows.start or 0)
+        if self.transform is not None:
+            window_stack.transform = self.transform * offset
+
+        for band in self.buffer:
+            window_stack.buffer[band] = self.buffer[band][rows, cols]
+            if band in self.masks:
+                window_stack.masks[band] = self.masks[band][rows, cols]
+            if band in self.metas:
+                meta = self.metas[band].copy()
+                height, width = window_stack.buffer[band].shape
+                meta.update(width=width, height=height)
+                if meta.get('transform') is not None:
+                    meta.update(transform=meta['transform'] * offset)
+                window_stack.metas[band] = meta
+
+        return window_stack
 
     def apply_valid_data_mask_to_stack(self):
         msk = self.read_mask()    
@@ -226,6 +306,114 @@ class BufferedImageStack:
 
         return mask
 
+    def to_shared(self, directory=None):
+        """Copy the bands and masks to memory-mapped files that can be shared by many processes.
+        The workers receive only the handle (a few bytes when pickled) and attach to the files without copying the arrays.
+        The files must be removed with SharedStackHandle.release (or using the handle as a context manager).
+
+        Args:
+            directory (str, optional): directory where the files are created. Defaults to None (SHARED_MEMORY_DIR if
+                the stack fits in its free space, otherwise the temporary directory on disk).
+
+        Returns:
+            SharedStackHandle: handle to attach to the shared stack
+        """
+        if directory is None:
+            num_bytes = sum(self.buffer[band].nbytes for band in self.buffer) + sum(self.masks[band].nbytes for band in self.masks)
+            directory = get_shared_dir(num_bytes)
+        shared_dir = tempfile.mkdtemp(prefix='buffered_stack_', dir=directory)
+
+        try:
+            for index, band in enumerate(self.buffer):
+                np.save(os.path.join(shared_dir, 'band_{}.npy'.format(index)), self.buffer[band])
+                if band in self.masks:
+                    np.save(os.path.join(shared_dir, 'mask_{}.npy'.format(index)), self.masks[band])
+        except:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+            raise
+
+        return SharedStackHandle(shared_dir, list(self.buffer.keys()), [band in self.masks for band in self.buffer], self.metas, self.transform)
+
+
+def get_shared_dir(num_bytes):
+    """Directory for a shared stack: SHARED_MEMORY_DIR if it has free space for the stack, else None (the temporary
+    directory of tempfile, on disk).
+    """
+    if SHARED_MEMORY_DIR is None:
+        return None
+
+    # Space for the headers of the npy files
+    if shutil.disk_usage(SHARED_MEMORY_DIR).free < num_bytes + 1024 ** 2:
+        print('[INFO] Not enough space in {} for the shared stack ({} MB), using the temporary directory'.format(SHARED_MEMORY_DIR, num_bytes // 1024 ** 2))
+        return None
+
+    return SHARED_MEMORY_DIR
+
+
+class SharedStackHandle:
+
+    def __init__(self, directory, bands, has_masks, metas, transform) -> None:
+        """Reference to a BufferedImageStack stored as memory-mapped files (see BufferedImageStack.to_shared).
+
+        Args:
+            directory (str): directory with the band and mask files
+            bands (list): band identifiers, in the order of the files
+            has_masks (list): if each band has a mask file
+            metas (dict): meta of each band
+            transform (Affine): transform of the stack
+        """
+        self.directory = directory
+        self.bands = bands
+        self.has_masks = has_masks
+        self.metas = metas
+        self.transform = transform
+
+    def attach(self):
+        """Load the stack without copying the arrays. The arrays are read-only.
+
+        Returns:
+            BufferedImageStack: stack backed by the shared files
+        """
+        buffered_stack = BufferedImageStack()
+        buffered_stack.transform = self.transform
+
+        for index, band in enumerate(self.bands):
+            buffered_stack.buffer[band] = np.load(os.path.join(self.directory, 'band_{}.npy'.format(index)), mmap_mode='r')
+            if self.has_masks[index]:
+                buffered_stack.masks[band] = np.load(os.path.join(self.directory, 'mask_{}.npy'.format(index)), mmap_mode='r')
+            if band in self.metas:
+                buffered_stack.metas[band] = self.metas[band].copy()
+
+        return buffered_stack
+
+    def release(self):
+        """Remove the shared files. The stacks already attached remain valid until they are closed (POSIX).
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+def get_band_stack_file(image_dir, stack_partial_name, band):
+    """Get the stack file (10, 20 or 60 m) with a band.
+
+    Returns:
+        tuple(str, int): path to the stack and its spacial resolution
+    """
+    stack_partial_name = stack_partial_name.replace('.tif', '')
+    stack_resolution = 20
+    if band in STACK_10M_BANDS_MAP:
+        stack_resolution = 10
+    elif band in STACK_60M_BANDS_MAP:
+        stack_resolution = 60
+
+    return os.path.join(image_dir, '{}_{}m_stack.tif'.format(stack_partial_name, stack_resolution)), stack_resolution
+
+
 def load_buffered_stack_bands(image_dir, stack_partial_name, bands, spatial_resolution=20):
     """Load the bands from the image stacks. Each stack has all bands of a spacial resolution.
     The loaded bands will be resampled to a specified spacial resolution.
@@ -244,22 +432,11 @@ def load_buffered_stack_bands(image_dir, stack_partial_name, bands, spatial_reso
     
     buffered_stack = BufferedImageStack()
 
-    stack_partial_name = stack_partial_name.replace('.tif', '')
-    stack_10m = os.path.join(image_dir, '{}_10m_stack.tif'.format(stack_partial_name))            
-    stack_20m = os.path.join(image_dir, '{}_20m_stack.tif'.format(stack_partial_name))            
-    stack_60m = os.path.join(image_dir, '{}_60m_stack.tif'.format(stack_partial_name))            
-
     for band in bands:
-        scale = 1.0
-        image_path = stack_20m
-        if band in STACK_10M_BANDS_MAP:
-            scale = 10/spatial_resolution
-            image_path = stack_10m
-
-        elif band in STACK_60M_BANDS_MAP:
-            scale = 60/spatial_resolution
-            image_path = stack_60m
-        
+        image_path, stack_resolution = get_band_stack_file(image_dir, stack_partial_name, band)
+        # The 20 m bands are not resampled
+        scale = 1.0 if stack_resolution == 20 else stack_resolution / spatial_resolution
+
         with rasterio.open(image_path) as src:
             img_stack = ImageStack(src)
             buffered_stack.load_band_from_stack(img_stack, band, scale=scale)
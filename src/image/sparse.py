@@ -0,0 +1,130 @@
+''' Sparse storage of the active fire masks.
+The fire pixels are a tiny fraction of a tile, so a mask is stored as the linear indices of the fire pixels
+(or as runs of consecutive pixels when they are fewer) with the geotransform and the CRS of the tile.
+The size of the file and the time to write it depend on the number of fire pixels, not on the tile area.
+'''
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+SPARSE_MASK_SUFIX = '_mask.npz'
+
+
+class SparseMask:
+
+    def __init__(self, indices, shape, transform=None, crs=None) -> None:
+        """Binary mask stored as the sorted linear indices (row-major) of the True pixels.
+
+        Args:
+            indices (np.array): linear indices of the True pixels
+            shape (tuple): shape of the mask (height, width)
+            transform (Affine, optional): geotransform of the mask. Defaults to None.
+            crs (CRS, optional): coordinate reference system of the mask. Defaults to None.
+        """
+        self.shape = tuple(int(size) for size in shape)
+        self.indices = np.asarray(indices, dtype=self.get_index_dtype())
+        self.transform = transform
+        self.crs = crs
+
+    def get_index_dtype(self):
+        return np.uint32 if np.prod(self.shape, dtype=np.float64) < 2**32 else np.uint64
+
+    @classmethod
+    def from_dense(cls, mask, transform=None, crs=None):
+        return cls(np.flatnonzero(mask), np.shape(mask), transform, crs)
+
+    @classmethod
+    def from_buffered_stack(cls, mask, buffered_stack, band=12):
+        """Create the sparse mask with the geotransform and CRS of a band of the stack.
+        """
+        meta = buffered_stack.metas[band]
+        return cls.from_dense(mask, meta.get('transform'), meta.get('crs'))
+
+    @classmethod
+    def from_runs(cls, starts, lengths, shape, transform=None, crs=None):
+        """Create the mask from runs of consecutive pixels (row-major).
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(starts) == 0:
+            return cls(np.zeros(0), shape, transform, crs)
+
+        # Index of each pixel: start of its run + position in the run
+        run_offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        indices = np.arange(lengths.sum(), dtype=np.int64) + run_offsets
+
+        return cls(indices, shape, transform, crs)
+
+    def get_runs(self):
+        """Get the runs of consecutive pixels (row-major).
+
+        Returns:
+            tuple(np.array, np.array): start and length of each run
+        """
+        if len(self.indices) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        indices = self.indices.astype(np.int64)
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = indices[np.concatenate([[0], breaks])]
+        lengths = np.diff(np.concatenate([[0], breaks, [len(indices)]]))
+
+        return starts, lengths
+
+    def count(self):
+        return len(self.indices)
+
+    def get_coords(self):
+        """Get the rows and columns of the True pixels.
+        """
+        return np.unravel_index(self.indices, self.shape)
+
+    def get_xy(self):
+        """Get the map coordinates (center of the pixels) of the True pixels, in the CRS of the mask.
+        """
+        rows, cols = self.get_coords()
+        return self.transform * (cols + 0.5, rows + 0.5)
+
+    def to_dense(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.ravel()[self.indices] = True
+
+        return mask
+
+    def save(self, file_path, encoding='auto'):
+        """Save the mask as a compressed npz.
+
+        Args:
+            file_path (str): output file
+            encoding (str, optional): 'indices', 'runs' or 'auto' (the smaller one). Defaults to 'auto'.
+        """
+        arrays = {'shape': np.array(self.shape)}
+
+        if self.transform is not None:
+            arrays['transform'] = np.array(tuple(self.transform)[:6])
+        if self.crs is not None:
+            arrays['crs'] = np.array(self.crs.to_wkt() if hasattr(self.crs, 'to_wkt') else str(self.crs))
+
+        starts, lengths = self.get_runs()
+        if encoding == 'auto':
+            encoding = 'runs' if 2 * len(starts) < len(self.indices) else 'indices'
+
+        if encoding == 'runs':
+            arrays['starts'] = starts.astype(self.get_index_dtype())
+            arrays['lengths'] = lengths.astype(self.get_index_dtype())
+        else:
+            arrays['indices'] = self.indices
+
+        np.savez_compressed(file_path, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            shape = tuple(data['shape'])
+            transform = Affine(*data['transform']) if 'transform' in data.files else None
+            crs = CRS.from_user_input(str(data['crs'])) if 'crs' in data.files else None
+
+            if 'indices' in data.files:
+                return cls(data['indices'], shape, transform, crs)
+
+            return cls.from_runs(data['starts'], data['lengths'], shape, transform, crs)
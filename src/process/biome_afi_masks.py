@@ -4,7 +4,9 @@ sys.path.append('../')
 
 from image.sentinel import ImageStack, BufferedImageStack, load_buffered_stack_bands
 from image.converter import get_gml_geometry
-from active_fire.biome import resolve_biome_and_apply_afd, apply_biome_afd
+from active_fire.biome import resolve_biome_and_apply_afd, apply_biome_afd, load_biome_bands
+from image.sparse import SparseMask, SPARSE_MASK_SUFIX
+from image.prefetch import PrefetchLoader
 
 
 import os
@@ -15,6 +17,12 @@ import cv2
 IMAGES_PATH = '../../images/stack'
 BIOMES_SHAPE_FILE = '../../resources/ecoregions/Ecoregions2017.shp'
 OUTPUT_PATH = '../../images/output'
+# Save the masks as sparse files (fire pixel indices, see image.sparse) instead of PNG.
+# The masks are read as PNG (<image>_mask.png) by the calibration and the evaluation scripts, so the PNG is the default
+SAVE_AS_SPARSE = False
+# Prefetch (see image.prefetch)
+PREFETCH_DEPTH = 2
+PREFETCH_MEMORY_BUDGET = 2 * 1024 ** 3
 
 
 
@@ -25,9 +33,13 @@ if __name__ == '__main__':
     images = list(set(images))
 
     print('Num. Images:', len(images))
-    for image in images:
+    loader = PrefetchLoader(images, lambda image: load_biome_bands(IMAGES_PATH, image), PREFETCH_DEPTH, PREFETCH_MEMORY_BUDGET)
+    for image, buffered_stack in loader:
         try:
-            mask, image_stack = resolve_biome_and_apply_afd(BIOMES_SHAPE_FILE, IMAGES_PATH, image)
+            if buffered_stack is None:
+                raise Exception('The bands could not be loaded')
+
+            mask, image_stack = resolve_biome_and_apply_afd(BIOMES_SHAPE_FILE, IMAGES_PATH, image, buffered_stack=buffered_stack)
         except Exception as e:
             print('Error processing: {} - Skiping image.'.format(image))
             print(e)
@@ -37,7 +49,10 @@ if __name__ == '__main__':
         # print(mask.shape)
         # im = Image.fromarray(mask * 255)
         # im.save(os.path.join(OUTPUT_PATH, '{}_mask.png'.format(image)))
-        cv2.imwrite(os.path.join(OUTPUT_PATH, '{}_mask.png'.format(image)), mask*255)
+        if SAVE_AS_SPARSE:
+            SparseMask.from_buffered_stack(mask, image_stack).save(os.path.join(OUTPUT_PATH, '{}{}'.format(image, SPARSE_MASK_SUFIX)))
+        else:
+            cv2.imwrite(os.path.join(OUTPUT_PATH, '{}_mask.png'.format(image)), mask*255)
 
 
         img = np.zeros((5490, 5490, 3))
@@ -0,0 +1,58 @@
+import sys
+
+sys.path.append('../')
+
+from image.cache import load_cached_stack_bands
+from image.histogram import BAND_HISTOGRAM_BANDS, BAND_HISTOGRAM_SUFIX, build_band_histogram, get_band_histogram_file
+from active_fire.general import ActiveFireIndex
+from active_fire.calibration import count_detections
+
+import os
+from glob import glob
+from joblib import Parallel, delayed
+
+IMAGES_STACK_DIR = '../../resources/images/stack'
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../../resources/images/cache'
+# Sidecar files with the band histogram of each image
+BAND_HISTOGRAM_DIR = '../../resources/images/band_histograms'
+N_JOBS = -2
+
+# Example of query: pixels detected by Sahm with another threshold in the images of a month
+QUERY_PATTERN = '*_201808*'
+QUERY_METHOD = 'Sahm'
+QUERY_PARAMETERS = {'th': 0.35}
+
+
+def get_stack_names():
+    stacks = os.listdir(IMAGES_STACK_DIR)
+    names = [stack.replace('_10m_stack', '').replace('_20m_stack', '').replace('_60m_stack', '').replace('.tif', '') for stack in stacks]
+
+    return sorted(set(names))
+
+
+def build(stack_name):
+    if os.path.exists(get_band_histogram_file(BAND_HISTOGRAM_DIR, stack_name)):
+        return
+
+    try:
+        buffered_stack = load_cached_stack_bands(BAND_CACHE_DIR, IMAGES_STACK_DIR, stack_name, BAND_HISTOGRAM_BANDS)
+        build_band_histogram(IMAGES_STACK_DIR, stack_name, BAND_HISTOGRAM_DIR, buffered_stack=buffered_stack)
+    except Exception as e:
+        print('[ERROR] Processing: {} - {}'.format(stack_name, e))
+
+
+if __name__ == '__main__':
+
+    stack_names = get_stack_names()
+    print('Num. Images:', len(stack_names))
+
+    Parallel(n_jobs=N_JOBS, verbose=1)(delayed(build)(stack_name) for stack_name in stack_names)
+
+    histogram_files = sorted(glob(os.path.join(BAND_HISTOGRAM_DIR, '{}{}'.format(QUERY_PATTERN, BAND_HISTOGRAM_SUFIX))))
+    afi = ActiveFireIndex(QUERY_METHOD)
+    counts = count_detections(histogram_files, afi.transform, n_jobs=N_JOBS, **QUERY_PARAMETERS)
+
+    for histogram_file, count in counts.items():
+        print(os.path.basename(histogram_file).replace(BAND_HISTOGRAM_SUFIX, ''), count)
+    print('{} {}: {} pixels in {} images'.format(QUERY_METHOD, QUERY_PARAMETERS, sum(counts.values()), len(counts)))
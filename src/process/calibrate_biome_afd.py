@@ -0,0 +1,57 @@
+import sys
+
+sys.path.append('../')
+
+from active_fire.calibration import calibrate_biome_afd, get_biome_afd
+
+import os
+import numpy as np
+
+IMAGES_STACK_DIR = '../../resources/images/stack'
+# Ground truth masks, named <image>_mask.png
+MASKS_DIR = '../../resources/images/output'
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../../resources/images/cache'
+
+# Biome method calibrated with the images (the images must be of the same biome)
+BIOME = 'MediterraneanForest'
+METRIC = 'f1'
+N_JOBS = -2
+
+COEFFICIENTS_A = np.arange(0.3, 1.5, 0.001)
+COEFFICIENTS_B = np.arange(-0.4, 0.2, 0.001)
+
+
+def get_samples():
+    stacks = os.listdir(IMAGES_STACK_DIR)
+    images = [stack.replace('_10m_stack', '').replace('_20m_stack', '').replace('_60m_stack', '').replace('.tif', '') for stack in stacks]
+
+    samples = []
+    for image in sorted(set(images)):
+        mask = os.path.join(MASKS_DIR, '{}_mask.png'.format(image))
+        if not os.path.exists(mask):
+            print('[INFO] Ground truth not found: {} - Skiping image.'.format(image))
+            continue
+
+        samples.append({'image_dir': IMAGES_STACK_DIR, 'stack': image, 'mask': mask})
+
+    return samples
+
+
+if __name__ == '__main__':
+
+    samples = get_samples()
+    print('Num. Images:', len(samples))
+
+    (best_a, best_b), scores, statistics = calibrate_biome_afd(BIOME, samples, COEFFICIENTS_A, COEFFICIENTS_B, METRIC, BAND_CACHE_DIR, N_JOBS)
+    print('Num. histogram cells: ', len(statistics.histogram.cells))
+
+    algorithm = get_biome_afd(BIOME)
+    index_a = int(np.argmin(np.abs(COEFFICIENTS_A - algorithm.coefficient_a)))
+    index_b = int(np.argmin(np.abs(COEFFICIENTS_B - algorithm.coefficient_b)))
+    print('Published: a={} b={} {}: {}'.format(algorithm.coefficient_a, algorithm.coefficient_b, METRIC, scores[METRIC][index_a, index_b]))
+
+    best_a_index = int(np.argmin(np.abs(COEFFICIENTS_A - best_a)))
+    best_b_index = int(np.argmin(np.abs(COEFFICIENTS_B - best_b)))
+    print('Best: a={:.3f} b={:.3f}'.format(best_a, best_b))
+    print('P: ', scores['precision'][best_a_index, best_b_index], ' R: ', scores['recall'][best_a_index, best_b_index], ' IoU: ', scores['iou'][best_a_index, best_b_index], ' F-score: ', scores['f1'][best_a_index, best_b_index])
@@ -0,0 +1,82 @@
+import sys
+
+sys.path.append('../')
+
+from image.cache import load_cached_stack_bands
+from active_fire.biome import resolve_biome
+from active_fire.evaluation import evaluate_samples, summarize
+
+import os
+from glob import glob
+import pandas as pd
+
+IMAGES_STACK_DIR = '../../resources/images/stack'
+# Masks generated by generate_afi_masks.py: <OUTPUT_DIR>/<method>/<stack>/<stack>_mask.(npz|txt|tif)
+MASKS_DIR = '../../resources/images/output_txt'
+# Ground truth masks, named <image>_mask.png
+GROUND_TRUTH_DIR = '../../resources/images/output'
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../../resources/images/cache'
+# Set to None to skip the per-biome results
+BIOMES_SHAPE_FILE = '../../resources/ecoregions/Ecoregions2017.shp'
+
+RESULTS_DIR = '../../resources/images/evaluation'
+N_JOBS = -2
+
+
+def get_samples():
+    methods = sorted(os.listdir(MASKS_DIR))
+
+    samples = {}
+    for method in methods:
+        for stack_dir in glob(os.path.join(MASKS_DIR, method, '*')):
+            stack_name = os.path.basename(stack_dir)
+            masks = glob(os.path.join(stack_dir, '{}_mask.*'.format(stack_name)))
+            if len(masks) == 0:
+                continue
+
+            image = stack_name.replace('_20m_stack.tif', '')
+            ground_truth = os.path.join(GROUND_TRUTH_DIR, '{}_mask.png'.format(image))
+            if not os.path.exists(ground_truth):
+                continue
+
+            if image not in samples:
+                samples[image] = {'name': image, 'ground_truth': ground_truth, 'predictions': {}}
+
+            samples[image]['predictions'][method] = masks[0]
+
+    return list(samples.values())
+
+
+def set_biomes(samples):
+    for sample in samples:
+        try:
+            buffered_stack = load_cached_stack_bands(BAND_CACHE_DIR, IMAGES_STACK_DIR, sample['name'], (12,))
+            sample['biome'] = resolve_biome(BIOMES_SHAPE_FILE, buffered_stack)
+        except Exception as e:
+            print('[ERROR] Biome not resolved: {} - {}'.format(sample['name'], e))
+
+
+if __name__ == '__main__':
+
+    samples = get_samples()
+    print('Num. Images:', len(samples))
+
+    if BIOMES_SHAPE_FILE is not None:
+        set_biomes(samples)
+
+    df = evaluate_samples(samples, n_jobs=N_JOBS, verbose=1)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    df.to_csv(os.path.join(RESULTS_DIR, 'images.csv'), index=False)
+
+    summary = summarize(df)
+    summary.to_csv(os.path.join(RESULTS_DIR, 'methods.csv'), index=False)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(summary[['method', 'num_images', 'micro_precision', 'micro_recall', 'micro_f1', 'micro_iou', 'macro_f1', 'macro_iou']])
+
+    if BIOMES_SHAPE_FILE is not None:
+        summary = summarize(df, by_biome=True)
+        summary.to_csv(os.path.join(RESULTS_DIR, 'methods_biomes.csv'), index=False)
+        with pd.option_context('display.max_columns', None, 'display.width', 200):
+            print(summary[['method', 'biome', 'num_images', 'micro_precision', 'micro_recall', 'micro_f1', 'micro_iou', 'macro_f1']])
@@ -6,8 +6,15 @@ sys.path.append('../')
 
 
 from image.sentinel import ImageStack, BufferedImageStack, load_buffered_stack_bands
+from image.cache import load_cached_stack_bands
+from image.prefetch import PrefetchLoader
+from image.sparse import SparseMask, SPARSE_MASK_SUFIX
 from image.converter import get_gml_geometry
 from active_fire.general import ActiveFireIndex
+from active_fire.events import extract_events
+from active_fire.overlap import TileGrid, OverlapPlanner
+from active_fire.temporal import TemporalTileStore, detect_changes
+from active_fire.merge import get_acquisition
 from utils.reflectance_conversion import get_image_metadata
 
 from tqdm import tqdm
@@ -21,10 +28,31 @@ IMAGES_STACK_DIR = '../../resources/images/stack'
 QI_DATA_DIR = '../../resources/images/images/qi_data'
 
 OUTPUT_DIR = '../../resources/images/output_txt'
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../../resources/images/cache'
 # METADATA_DIR = '../resources/metadata'
 METADATA_DIR = '../../resources/Sentinel2/metadata'
 
-SAVE_AS_TXT = True
+# Save the masks as sparse files (fire pixel indices, see image.sparse), the TXT and TIFF have the size of the tile
+SAVE_AS_SPARSE = True
+SAVE_AS_TXT = False
+# Apply the methods only to the blocks that can have fire (see active_fire.general.transform_by_blocks)
+USE_BLOCKS = True
+# Skip the blocks covered by another tile of the same acquisition (see active_fire.overlap). The masks and events of a tile
+# are then empty in the strip processed by its neighbour, so use it only when the outputs are merged before the evaluation
+# (see process/merge_tile_detections.py). Ex: '../../resources/sentinel_grid/sentinel_land_grid.geojson'.
+# None: process the whole tiles (per-tile masks, as evaluated by process/evaluate_afi_masks.py)
+SENTINEL_GRID_FILE = None
+# Store of the last acquisition of each tile: the methods are applied only to the blocks that changed (see active_fire.temporal).
+# The blocks judged unchanged are saved without fire, so use it only for monitoring and not for the masks evaluated by
+# process/evaluate_afi_masks.py. Ex: '../../resources/images/temporal_store'.
+# None: process each acquisition from scratch
+TEMPORAL_STORE_DIR = None
+# Save the fire events (connected components with their statistics, see active_fire.events) as CSV
+SAVE_EVENTS = True
+# Prefetch (see image.prefetch)
+PREFETCH_DEPTH = 2
+PREFETCH_MEMORY_BUDGET = 2 * 1024 ** 3
 
 ALGORITHMS = [
     {'method': 'Baseline'}, # P: : 0.005999406879034109  R:  0.7987444225381343  IoU:  0.005990351623328869  F-score:  0.01190936198078334
@@ -44,28 +72,38 @@ def get_stack_names():
     # return list(set(names))
 
     stacks = os.listdir(IMAGES_STACK_DIR)
-    return stacks
+    # The acquisitions of each tile in time order (required by the temporal store)
+    return sorted(stacks, key=lambda stack: get_acquisition(stack)[::-1])
 
 def get_metadata_file(stack_name):
+    """Load the metadata of a stack (MTD_TL.xml and MTD_MSIL1C.xml in METADATA_DIR/L1C_<grid>_*_<timestamp>).
 
+    Returns:
+        dict: image metadata (see utils.reflectance_conversion.get_image_metadata) or None if the files are not found
+    """
     stack_name_parts = stack_name.split('_')
-    tile_name = stack_name_parts[0] + '_' + stack_name_parts[1]
-    print(tile_name)
+    metadata_dirs = glob(os.path.join(METADATA_DIR, 'L1C_{}_*_{}'.format(stack_name_parts[0], stack_name_parts[1])))
 
-    print(glob(os.path.join(METADATA_DIR, 'L1C_*', '*.xml'), recursive=True))
-    
-    print(os.path.join(METADATA_DIR,'L1C_{}_*_{}'.format(stack_name_parts[0], stack_name_parts[1]), '*.xml'))
-    metadata_file = glob(os.path.join(METADATA_DIR,'L1C_{}_*_{}'.format(stack_name_parts[0], stack_name_parts[1]), '*.xml'))
+    for metadata_dir in metadata_dirs:
+        mtd_tl = os.path.join(metadata_dir, 'MTD_TL.xml')
+        mtd_msil = os.path.join(metadata_dir, 'MTD_MSIL1C.xml')
+        if os.path.exists(mtd_tl) and os.path.exists(mtd_msil):
+            return get_image_metadata(mtd_tl_xml=mtd_tl, mtd_msil_xml=mtd_msil)
+
+    return None
 
-    print(metadata_file)
-    sys.exit()
+def load_stack(stack_name):
+    stack_partial_name = stack_name.replace('_20m_stack.tif', '')
+    return load_cached_stack_bands(BAND_CACHE_DIR, IMAGES_STACK_DIR, stack_partial_name, (12, 11, '8A'))
 
 def get_algorithms():
     algorithms = []
     
     for algorithm in ALGORITHMS:
         alg = algorithm.copy()
-        alg['afi'] = ActiveFireIndex(alg['method'])
+        alg['afi'] = ActiveFireIndex(alg['method'], use_blocks=USE_BLOCKS)
+        if TEMPORAL_STORE_DIR is not None:
+            alg['store'] = TemporalTileStore(os.path.join(TEMPORAL_STORE_DIR, alg['method']))
 
         algorithms.append(alg)
 
@@ -76,35 +114,40 @@ if __name__ == '__main__':
     stack_names = get_stack_names()
     algorithms = get_algorithms()
 
-    for stack_name in tqdm(stack_names):
-        
-        img_buffer = BufferedImageStack()
-
-        metadata = get_metadata_file(stack_name)
-        print(metadata)
-        sys.exit()
+    plans = {}
+    if SENTINEL_GRID_FILE is not None:
+        plans = OverlapPlanner(TileGrid.from_file(SENTINEL_GRID_FILE)).plan_acquisitions(stack_names)
 
-        stack_path = os.path.join(IMAGES_STACK_DIR, stack_name)
-        with rasterio.open(stack_path) as dataset:
-            img_stack = ImageStack(dataset)
-            img_buffer.load_band_from_stack(img_stack, 12)
-            img_buffer.load_band_from_stack(img_stack, 11)
-            img_buffer.load_band_from_stack(img_stack, '8A')
+    # The next stacks are read while the methods are applied to the current one
+    loader = PrefetchLoader(stack_names, load_stack, PREFETCH_DEPTH, PREFETCH_MEMORY_BUDGET)
+    for stack_name, img_buffer in tqdm(loader, total=len(stack_names)):
 
-        
+        if img_buffer is None:
+            continue
 
+        # The radiance of the events is computed only when the metadata of the stack is available
+        metadata = get_metadata_file(stack_name) if SAVE_EVENTS else None
 
         for algorithm in algorithms:
             method = algorithm['method']
 
             afi = algorithm['afi']
             
-            mask = afi.transform(img_buffer)
+            if TEMPORAL_STORE_DIR is not None:
+                grid_name, timestamp = get_acquisition(stack_name)
+                changes = detect_changes(afi, img_buffer, grid_name, timestamp, algorithm['store'], candidates=plans.get(stack_name))
+                mask = changes['mask']
+                print('[INFO] {} - {}: {} new, {} persisting, {} extinguished fire pixels ({}/{} blocks)'.format(
+                    method, stack_name, changes['new'].count(), changes['persisting'].count(), changes['extinguished'].count(), changes['num_evaluated_blocks'], changes['num_blocks']))
+            else:
+                mask = afi.transform(img_buffer, candidates=plans.get(stack_name))
             
             output_dir = os.path.join(OUTPUT_DIR, method, stack_name)    
             os.makedirs(output_dir, exist_ok=True)
 
-            if SAVE_AS_TXT:
+            if SAVE_AS_SPARSE:
+                SparseMask.from_buffered_stack(mask, img_buffer).save(os.path.join(output_dir, '{}{}'.format(stack_name, SPARSE_MASK_SUFIX)))
+            elif SAVE_AS_TXT:
                 # Save as TXT
                 np.savetxt(os.path.join(output_dir, '{}_mask.txt'.format(stack_name)), (mask != 0).astype(int), fmt='%i')
             else:
@@ -112,13 +155,17 @@ if __name__ == '__main__':
                 mask = mask * 255
                 # cv2.imwrite(os.path.join(output_dir, '{}_mask.png'.format(stack_name)), mask)
 
-                meta = img_stack.metas[12]
+                meta = img_buffer.metas[12].copy()
 
                 # Active Fire Mask
                 meta.update(count=1)
                 output_mask = os.path.join(output_dir, '{}_mask.tif'.format(stack_name))
                 with rasterio.open(output_mask, 'w', **meta) as dst:
-                    dst.write_band(1, (mask).astype(rasterio.uint16))   
+                    dst.write_band(1, (mask).astype(rasterio.uint16))
+
+            if SAVE_EVENTS:
+                events = extract_events(mask, img_buffer, metadata)
+                events.to_csv(os.path.join(output_dir, '{}_events.csv'.format(stack_name)), index=False)   
 
 
 
@@ -0,0 +1,32 @@
+import sys
+
+sys.path.append('../')
+
+from image.sparse import SPARSE_MASK_SUFIX
+from active_fire.merge import merge_detections
+
+import os
+from glob import glob
+
+# Sparse masks generated by generate_afi_masks.py: <MASKS_DIR>/<method>/<stack>/<stack>_mask.npz
+MASKS_DIR = '../../resources/images/output_txt'
+# One CSV per method with the merged events of each acquisition
+OUTPUT_DIR = '../../resources/images/merged_events'
+
+
+if __name__ == '__main__':
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    for method in sorted(os.listdir(MASKS_DIR)):
+        mask_files = glob(os.path.join(MASKS_DIR, method, '*', '*{}'.format(SPARSE_MASK_SUFIX)))
+        print('[INFO] {} - Num. Masks: {}'.format(method, len(mask_files)))
+
+        output_file = os.path.join(OUTPUT_DIR, '{}_events.csv'.format(method))
+        write_header = True
+        # The events are written one acquisition at a time
+        for timestamp, events in merge_detections(mask_files):
+            events.to_csv(output_file, mode='w' if write_header else 'a', header=write_header, index=False)
+            write_header = False
+
+            print('[INFO] {} - {}: {} events, {} duplicated pixels removed'.format(method, timestamp, len(events), events['num_duplicates'].sum()))
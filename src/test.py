@@ -3,7 +3,9 @@ import rasterio.mask
 # from rasterio.enums import Resampling
 from image.sentinel import ImageStack, BufferedImageStack, load_buffered_stack_bands
 from image.converter import get_gml_geometry
-from active_fire.biome import MediterraneanForestAFD, apply_biome_afd
+from image.sparse import SparseMask, SPARSE_MASK_SUFIX
+from active_fire.biome import MediterraneanForestAFD, apply_biome_afd, load_biome_bands
+from image.prefetch import PrefetchLoader
 import numpy as np
 from osgeo import ogr
 import gdal
@@ -15,6 +17,11 @@ import cv2
 IMAGES_DIR = '../images/stack'
 QI_DATA_DIR = '../images/qi_data'
 OUTPUT_DIR = '../images/output'
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../images/cache'
+# Prefetch (see image.prefetch)
+PREFETCH_DEPTH = 2
+PREFETCH_MEMORY_BUDGET = 2 * 1024 ** 3
 
 SAMPLES = [
     {'label': 'A', 'stack': 'T50MKB_20180928T022551', 'biome': 'TropicalMoistForest'},
@@ -27,9 +34,10 @@ SAMPLES = [
     {'label': 'H', 'stack': 'T50WPT_20180719T034529', 'biome': 'Taiga'},
 ]
 
-for sample in SAMPLES:
+loader = PrefetchLoader(SAMPLES, lambda sample: load_biome_bands(IMAGES_DIR, sample['stack'], cache_dir=BAND_CACHE_DIR), PREFETCH_DEPTH, PREFETCH_MEMORY_BUDGET)
+for sample, buffered_stack in loader:
     print('Processando: {} - {} - {}'.format(sample['label'], sample['stack'], sample['biome']))
-    mask, buffered_stack = apply_biome_afd(sample['biome'], IMAGES_DIR, sample['stack'])
+    mask, buffered_stack = apply_biome_afd(sample['biome'], IMAGES_DIR, sample['stack'], cache_dir=BAND_CACHE_DIR, buffered_stack=buffered_stack)
     # print(mask.shape)
 
     meta = buffered_stack.metas[12]
@@ -47,6 +55,8 @@ for sample in SAMPLES:
         os.makedirs(output_path)
 
     # Active Fire Mask
+    SparseMask.from_buffered_stack(mask, buffered_stack).save(os.path.join(output_path, '{}{}'.format(sample['stack'], SPARSE_MASK_SUFIX)))
+
     meta.update(count=1)
     output_mask = os.path.join(output_path, '{}_mask.tif'.format(sample['stack']))
     with rasterio.open(output_mask, 'w', **meta) as dst:
@@ -0,0 +1,70 @@
+''' Tests of the granule catalog (image.catalog) with a small index.csv of the Google Cloud bucket (fixtures/index.csv).
+Run from src: python -m pytest tests
+'''
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from image.catalog import GranuleCatalog
+
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'index.csv')
+
+
+def load_catalog(**kwargs):
+    catalog = GranuleCatalog()
+    catalog.load_index_csv(INDEX_FILE, **kwargs)
+
+    return catalog
+
+
+def get_granule_ids(catalog):
+    return [granule['granule_id'] for granule in catalog.get_granule_info()]
+
+
+def test_load_index_csv_keeps_only_l1c():
+    catalog = GranuleCatalog()
+
+    assert catalog.load_index_csv(INDEX_FILE) == 4
+    assert catalog.count() == 4
+
+
+def test_load_index_csv_filters():
+    catalog = load_catalog(tiles=['T50MKB', '20LQH'], start_date='2018-09-01', end_date='2019-01-01')
+
+    assert get_granule_ids(catalog) == ['L1C_T50MKB_A017060_20180928T024358', 'L1C_T50MKB_A017203_20181008T024519']
+
+
+def test_search_tile_name():
+    catalog = load_catalog()
+
+    assert get_granule_ids(catalog.search_tile_name('T34SFH')) == ['L1C_T34SFH_A016066_20180723T092855']
+
+    # The 'T' notation is optional
+    catalog.clear_search()
+    assert len(catalog.search_tile_name('50mkb').get_granule_info()) == 2
+
+
+def test_search_dates():
+    catalog = load_catalog()
+
+    # The end date is not included
+    granule_ids = get_granule_ids(catalog.search_dates('2018-07-23', '2018-10-08'))
+    assert granule_ids == ['L1C_T34SFH_A016066_20180723T092855', 'L1C_T50MKB_A017060_20180928T024358']
+
+    catalog.clear_search()
+    granule_ids = get_granule_ids(catalog.search_tile_name('T50MKB').search_dates('2018-10-01', '2018-10-09'))
+    assert granule_ids == ['L1C_T50MKB_A017203_20181008T024519']
+
+
+def test_search_point():
+    catalog = load_catalog()
+
+    granules = catalog.search_point((-59.5, -13.0)).get_granule_info()
+    assert [granule['granule_id'] for granule in granules] == ['L1C_T20LQH_A021762_20190821T142725']
+    assert granules[0]['product_id'] == 'S2B_MSIL1C_20190821T142041_N0208_R010_T20LQH_20190821T173407'
+    assert granules[0]['sensing_time'] == '2019-08-21T14:27:25'
+    assert granules[0]['cloud_cover'] == 3.2
+
+    catalog.clear_search()
+    assert catalog.search_point((0.0, 0.0)).get_granule_info() == []
@@ -0,0 +1,65 @@
+''' Tests of the merge of the detections of neighbour tiles (active_fire.merge).
+Run from src: python -m pytest tests
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from active_fire.merge import deduplicate, DUPLICATE_DISTANCE, CROSS_ZONE_DUPLICATE_DISTANCE
+
+PIXEL_SIZE = 20.0
+
+
+def get_block(size=10, offset=(0.0, 0.0)):
+    """Centres of a block of 20 m pixels (metres, planar coordinates as (n, 3) points)
+    """
+    rows, cols = np.mgrid[0:size, 0:size]
+    x = cols.ravel() * PIXEL_SIZE + offset[0]
+    y = rows.ravel() * PIXEL_SIZE + offset[1]
+
+    return np.stack([x, y, np.zeros(len(x))], axis=-1)
+
+
+def get_two_tiles(offset, size=10):
+    points = np.concatenate([get_block(size), get_block(size, offset)])
+    tiles = np.repeat([0, 1], size * size)
+
+    return points, tiles
+
+
+@pytest.mark.parametrize('offset', [(0.0, 0.0), (3.0, 3.0), (5.0, 0.0), (9.0, 9.0), (10.0, 10.0)])
+def test_deduplicate_cross_zone_offset_grids(offset):
+    points, tiles = get_two_tiles(offset)
+
+    unique, groups = deduplicate(points, tiles, DUPLICATE_DISTANCE, ['EPSG:32720', 'EPSG:32721'], CROSS_ZONE_DUPLICATE_DISTANCE)
+
+    # Each pixel of the second tile is the duplicate of one pixel of the first tile
+    assert len(unique) == 100
+    assert np.all(tiles[unique] == 0)
+    assert len(np.unique(groups[tiles == 1])) == 100
+
+
+def test_deduplicate_same_zone():
+    points, tiles = get_two_tiles((0.0, 0.0))
+    unique, _ = deduplicate(points, tiles, DUPLICATE_DISTANCE, ['EPSG:32720', 'EPSG:32720'], CROSS_ZONE_DUPLICATE_DISTANCE)
+    assert len(unique) == 100
+
+    # The tiles of a zone share the grid, the pixels 12.7 m apart are different pixels
+    points, tiles = get_two_tiles((9.0, 9.0))
+    unique, _ = deduplicate(points, tiles, DUPLICATE_DISTANCE, ['EPSG:32720', 'EPSG:32720'], CROSS_ZONE_DUPLICATE_DISTANCE)
+    assert len(unique) == 200
+
+
+def test_deduplicate_partial_overlap():
+    # Second tile shifted by 5 columns (and 5 m): only the 50 pixels of the overlap are duplicates
+    points, tiles = get_two_tiles((5 * PIXEL_SIZE + 5.0, 0.0))
+
+    unique, groups = deduplicate(points, tiles, DUPLICATE_DISTANCE, ['EPSG:32720', 'EPSG:32721'], CROSS_ZONE_DUPLICATE_DISTANCE)
+
+    assert len(unique) == 150
+    # The pixels of the first tile are kept
+    assert np.array_equal(unique[groups[tiles == 0]], np.flatnonzero(tiles == 0))
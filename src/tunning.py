@@ -3,6 +3,7 @@ import sys
 sys.path.append('../')
 
 from image.sentinel import BufferedImageStack, load_buffered_stack_bands
+from image.cache import load_cached_stack_bands
 from image.converter import get_gml_geometry, get_cloud_mask, reflectance_to_radiance
 from active_fire.general import CicalaAFI, LiangrocapartAFI, YongxueAFI
 # from utils import reflectance_conversion
@@ -12,6 +13,7 @@ from utils import metadata
 from PIL import Image
 
 from sklearn.metrics import f1_score, precision_score, recall_score, accuracy_score
+from active_fire.tuning import ThresholdSweep
 
 import os
 import numpy as np
@@ -27,6 +29,9 @@ import cv2
 
 
 
+# Band cache (see image.cache), None to disable
+BAND_CACHE_DIR = '../images/cache/'
+
 # G
 IMAGE = 'T09UYV_20180808T193901'
 MASK = 'T09UYV_20180808T193901_mask.png'
@@ -35,7 +40,7 @@ gt = Image.open(os.path.join('../images/output/G', MASK))
 gt = (np.array(gt) > 0)
 
 
-img_stack = load_buffered_stack_bands('../images/stack/', IMAGE, (12, 11, '8A'))
+img_stack = load_cached_stack_bands(BAND_CACHE_DIR, '../images/stack/', IMAGE, (12, 11, '8A'))
 
 cloud_mask = get_cloud_mask('../images/qi_data/{}/MSK_CLOUDS_B00.gml'.format(IMAGE), gt.shape, img_stack.metas[12]['transform'])
 
@@ -54,47 +59,22 @@ print(metadata)
 afi = CicalaAFI()
 # for i in np.arange(10, 20, 0.5):
 
+# Thresholds evaluated, the same range and finest step of the old coarse-to-fine search
+THRESHOLDS = np.arange(0, 110, 0.001)
+METRIC = 'f1_macro'
 
-gt = gt.flatten()
-best = 0
-best_th = 0
-
-bottom = 0
-top = 110
-step = 10
-
-iteration = 0
-num_iterations = 4
-
-
-while iteration <= num_iterations:
-    print('Iteration: ', iteration)
-    for i in np.arange(bottom, top, step):
-        print('Threshold: ', i)
-
-        mask = afi.transform(img_stack, metadata, alpha=0.5, th=i)
-
-        print(gt.sum())
-        print(mask.sum())
-
-        score = f1_score(gt, mask.flatten(), average='macro')
-        print('F1: ', score)
-        if score > best:
-            best = score
-            best_th = i
-    
-    print('Best score: ', best, ' Best TH: ', best_th)
-
-    bottom = best_th - step
-    top = best_th + step
-    step = step / 10
-
-    iteration += 1
-
+# The index is computed once, the scores of every threshold come from its histograms
+index = afi.index(img_stack, metadata, alpha=0.5)
+sweep = ThresholdSweep(THRESHOLDS)
+sweep.update(index, gt, img_stack.read_mask())
 
+best_th, best_scores = sweep.best(METRIC)
+print('Num. fire pixels (GT): ', gt.sum())
+print('Best score: ', best_scores[METRIC], ' Best TH: ', best_th)
+print('P: ', best_scores['precision'], ' R: ', best_scores['recall'], ' IoU: ', best_scores['iou'], ' F-score: ', best_scores['f1'])
 
-    # cv2.imwrite('../images/cicala/d/Cicala_{}.png'.format(i), mask*255)
-    # cv2.imwrite('../images/cicala/d/Cicala_{}_cloudless.png'.format(i), (mask & cloud_mask)*255)
+# cv2.imwrite('../images/cicala/d/Cicala_{}.png'.format(i), mask*255)
+# cv2.imwrite('../images/cicala/d/Cicala_{}_cloudless.png'.format(i), (mask & cloud_mask)*255)
 
 
 
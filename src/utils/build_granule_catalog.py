@@ -0,0 +1,40 @@
+import sys
+
+sys.path.append('../')
+
+import geopandas as gpd
+import os
+from image.catalog import GranuleCatalog
+
+# Sentinel-2 index from the Google Cloud public bucket: gs://gcp-public-data-sentinel-2/index.csv.gz
+SENTINEL_INDEX_FILE = '../../resources/sentinel_grid/index.csv.gz'
+
+# Sentinel geodataframe with grid information
+SAMPLES_SENTINEL_LAND_GRID_GEODATAFRAME = '../../resources/sentinel_grid/sentinel_land_grid.geojson'
+
+GRANULE_CATALOG_FILE = '../../resources/sentinel_grid/granule_catalog.sqlite'
+
+START_DATE = '2020-08-01' # date included
+END_DATE = '2020-09-01' # date NOT included
+
+
+'''
+Build the local granule catalog used to search the Sentinel-2 granules offline.
+Only the land tiles in the date range are stored.
+'''
+if __name__ == '__main__':
+
+    gdf = gpd.read_file(SAMPLES_SENTINEL_LAND_GRID_GEODATAFRAME)
+    tiles = gdf['name'].unique()
+    print(f'Num. tiles: {len(tiles)}')
+
+    os.makedirs(os.path.dirname(GRANULE_CATALOG_FILE), exist_ok=True)
+    catalog = GranuleCatalog(GRANULE_CATALOG_FILE)
+
+    num_granules = catalog.load_index_csv(SENTINEL_INDEX_FILE, tiles=tiles, start_date=START_DATE, end_date=END_DATE)
+    print(f'Num. granules inserted: {num_granules}')
+    print(f'Num. granules in the catalog: {catalog.count()}')
+
+    catalog.close()
+
+    print('Done!')
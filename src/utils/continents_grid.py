@@ -1,64 +1,98 @@
 import geopandas as gpd
+import pandas as pd
 import os
-import matplotlib.pyplot as plt 
 from glob import glob
 import fiona
 import sys
-from tqdm import tqdm
+from joblib import Parallel, delayed
 
 
 CONTINENTS_FOLDER = '../../resources/continentes'
 GRID_FOLDER = '../../resources/sentinel_grid/'
 
 OUTPUT_FILE_NAME = 'sentinel_land_grid.geojson'
+# Binary copy of the land grid (GeoParquet), faster to load than the GeoJSON. Set to None to skip
+OUTPUT_PARQUET_FILE_NAME = 'sentinel_land_grid.parquet'
 
 IGNORE_CONTINENTS = ['Antarctica', 'Continents']
 
+N_JOBS = -2
+
+
+def load_grid(grid_file):
+    """Load the sentinel grid with one row per geometry of each tile (the KML tiles are collections of geometries).
+    """
+    gpd.io.file.fiona.drvsupport.supported_drivers['KML'] = 'rw'
+    gdf_grid = gpd.read_file(grid_file, driver='KML')
+
+    gdf_grid = gdf_grid[['Name', 'Description', 'geometry']].explode(index_parts=False).reset_index(drop=True)
+    gdf_grid.index.name = 'part'
+
+    return gdf_grid
+
+
+def intersect_continent(shapefile, gdf_grid):
+    """Get the grid geometries that intersect the continent shapefile.
+    The join uses the spatial index of the continent polygons, so each tile is tested only against the polygons of its bounding box.
+
+    Args:
+        shapefile (str): continent shapefile
+        gdf_grid (gpd.GeoDataFrame): sentinel grid (see load_grid)
+
+    Returns:
+        gpd.GeoDataFrame: grid geometries with land (name, description, continent and geometry) or None if the continent is ignored
+    """
+    gdf = gpd.read_file(shapefile)
+    continent = gdf.loc[0]['CONTINENT']
+
+    if continent in IGNORE_CONTINENTS:
+        print(f'Ignoring {continent}')
+        return None
+
+    print(f"Shapefile of {continent}")
+    if gdf.crs is not None and gdf_grid.crs is not None and gdf.crs != gdf_grid.crs:
+        gdf = gdf.to_crs(gdf_grid.crs)
+
+    joined = gpd.sjoin(gdf_grid, gdf[['geometry']], how='inner', predicate='intersects')
+    # A geometry that intersects many polygons of the continent is added once, in the grid order
+    land = gdf_grid.loc[joined.index.unique().sort_values()]
+
+    return gpd.GeoDataFrame({
+        'name': land['Name'].values,
+        'description': land['Description'].values,
+        'continent': continent,
+        'geometry': land.geometry.values,
+    })
+
 
 '''
 Load the shapefile of the continents and the sentinel grid.
-Intersects the sentinel grid with the continents shapefile to get the grid with land. 
+Intersects the sentinel grid with the continents shapefile to get the grid with land.
 '''
 if __name__ == '__main__':
 
     print('Loading sentinel grid...')
     # Load the sentinel grid
-    gpd.io.file.fiona.drvsupport.supported_drivers['KML'] = 'rw'
-    gdf_grid = gpd.read_file(os.path.join(GRID_FOLDER, 'sentinel_grid.kml'), driver='KML')
+    gdf_grid = load_grid(os.path.join(GRID_FOLDER, 'sentinel_grid.kml'))
 
     print('Processing the shapefiles...')
     shapefiles = glob(os.path.join(CONTINENTS_FOLDER, '*.shp'))
 
-    grid_square_land = []
+    # The continents are processed in parallel, in the order of the shapefiles
+    grid_square_land = Parallel(n_jobs=N_JOBS, verbose=1)(delayed(intersect_continent)(shapefile, gdf_grid) for shapefile in shapefiles)
+    grid_square_land = [land for land in grid_square_land if land is not None]
 
-    for shapefile in shapefiles:
-        gdf = gpd.read_file(shapefile)
-        continent = gdf.loc[0]['CONTINENT']
-        print(f"Shapefile of {continent}")
-      
-        if continent in IGNORE_CONTINENTS:
-            print(f'Ignoring {continent}')
-            continue
-
-        for index, grid_row in tqdm(gdf_grid.iterrows()):
-
-            # Check the intersection between the continent shape and the sentinel grid
-            for grid_geometry in grid_row.geometry:
-                gdf_intersection = gdf.intersects(grid_geometry)
-                if gdf_intersection.any():
-                    grid_square_land.append({
-                        'name': grid_row.Name,
-                        'description': grid_row.Description,
-                        'continent': continent,
-                        'geometry': grid_geometry
-                    })
-
-
-    sentinel_grid = gpd.GeoDataFrame( grid_square_land )
+    sentinel_grid = gpd.GeoDataFrame(pd.concat(grid_square_land, ignore_index=True), crs=gdf_grid.crs)
     num_grids = len(sentinel_grid)
     print(f'Num. tiles: {num_grids}')
 
     with open(os.path.join(GRID_FOLDER, OUTPUT_FILE_NAME), 'w') as f:
         f.write(sentinel_grid.to_json())
 
-    print('Done!')
\ No newline at end of file
+    if OUTPUT_PARQUET_FILE_NAME is not None:
+        try:
+            sentinel_grid.to_parquet(os.path.join(GRID_FOLDER, OUTPUT_PARQUET_FILE_NAME))
+        except ImportError as e:
+            print('[ERROR] GeoParquet not saved (pyarrow is required): {}'.format(e))
+
+    print('Done!')
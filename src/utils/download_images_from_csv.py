@@ -15,9 +15,14 @@ from joblib import Parallel, delayed
 
 
 from active_fire.general import ActiveFireIndex
-from image.sentinel import BufferedImageStack
+from active_fire.triage import get_band_files, triage_tile
+from image.sentinel import BufferedImageStack, SharedStackHandle
 from image.converter import convert_dir_jp2_to_tiff, get_cloud_mask
 from utils.metadata import get_image_metadata
+from utils.pipeline import Stage, StagedPipeline
+from utils.job_store import JobStore, FireGridRegistry, STATUS_RUNNING, STATUS_TILE_FIRE, STATUS_FIRE, STATUS_NO_FIRE, STATUS_ERROR, STATUS_REJECTED
+from utils.granule_filter import check_usable_area
+from utils.scheduler import FirePrior, TileScheduler, get_grid_biomes, parse_tile_name
 import time
 from tqdm import tqdm
 import csv
@@ -25,6 +30,9 @@ import csv
 N_JOBS = -2
 # N_JOBS = 3
 
+# Number of tiles (grids) processed in parallel when the pipeline is not used
+N_TILE_JOBS = 1
+
 
 INPUT_CSV = '../../resources/s2_continent_202008_list_to_download.csv'
 OUTPUT_CSV = '../../resources/downloaded_images.csv'
@@ -36,6 +44,23 @@ OUTPUT_METADATA_PATH = '../../resources/images/metadata/'
 
 LOG_PATH = os.path.join(DOWNLOAD_PATH, 'log')
 
+# Status of the tiles and grids with fire, shared by all workers
+JOB_STORE_FILE = os.path.join(DOWNLOAD_PATH, 'jobs.sqlite')
+# Process again the tiles that failed in a previous execution
+RETRY_ERRORS = False
+
+# Overlap the download and the fire detection of different tiles
+USE_PIPELINE = True
+# Number of workers of each pipeline stage
+PIPELINE_WORKERS = {
+    'download': 4,
+    'detect': 1,
+    'finish': 2,
+}
+PIPELINE_QUEUE_SIZE = 4
+# Interval (seconds) between the reports of throughput and queue depth
+PIPELINE_REPORT_INTERVAL = 60
+
 
 SENTINEL_BANDS = ('B01','B02','B03','B04', 'B05','B06','B07','B08','B8A', 'B09','B10','B11','B12')
 CLASSIFICATION_BANDS = ('B8A', 'B11', 'B12')
@@ -49,22 +74,42 @@ ACTIVE_FIRE_ALGORITHMS = [
     {'method': 'Murphy'},
 ]
 
+# Only decide if the tile has fire: the methods are applied to the candidate blocks and stop at the first fire (see active_fire.triage).
+# The number of fire pixels is the number found in the first block with fire.
+USE_TRIAGE = True
+
+# The fire is detected in the downloaded JP2 bands (the decoder threads are set by image.sentinel.GDAL_NUM_THREADS),
+# the bands are converted to TIFF only for the tiles with fire
+BAND_EXTENSION = 'jp2'
+
+# Download the metadata and the cloud mask first and reject the granules with less usable area (data without clouds)
+# than the threshold, before the band download (see utils.granule_filter). Set to None to download all granules
+USABLE_AREA_THRESHOLD = 0.05
+
+# Process the tiles in the order of the fire prior (past detections, biome and season, see utils.scheduler).
+# The pending tiles of a grid zone get ahead when a fire is found in the zone
+USE_SCHEDULER = True
+# Biome of each grid for the prior. Set to None to ignore the biome
+SENTINEL_GRID_FILE = '../../resources/sentinel_grid/sentinel_land_grid.geojson'
+BIOMES_SHAPE_FILE = '../../resources/ecoregions/Ecoregions2017.shp'
 
-FIRE_GRIDS = []
+
+JOB_STORE = JobStore(JOB_STORE_FILE)
+FIRE_GRIDS = FireGridRegistry(JOB_STORE)
+# Set in the main when USE_SCHEDULER
+SCHEDULER = None
 
 def check_fire_in_tile(tiff_path, metadata):
+    if USE_TRIAGE:
+        return triage_fire_in_tile(tiff_path, metadata, BAND_EXTENSION)
+
     # Load the bands to a buffer
-    bands_files = glob(os.path.join(tiff_path, '*.tif'))
+    band_files = get_band_files(tiff_path, BAND_EXTENSION)
+    bands_files = list(band_files.values())
     img_buffer = BufferedImageStack()
     
     shape = None, None
-    for band_file in bands_files:
-        band = 12
-        if band_file.endswith('_B11.tif'):
-            band = 11
-        elif band_file.endswith('_B8A.tif'):
-            band = '8A'
-        
+    for band, band_file in band_files.items():
         img_buffer.load_file_as_band(band_file, band)
     
             
@@ -106,7 +151,9 @@ def check_fire_in_tile(tiff_path, metadata):
         # print('{} - Num. fire pixels: {}'.format(algorithm['method'], num_fire_pixels))
         
     
-    data = Parallel(n_jobs=N_JOBS, verbose=0)(delayed(process_image)(algorithm, img_buffer, metadata) for algorithm in ACTIVE_FIRE_ALGORITHMS)
+    # The workers attach to the shared bands instead of receiving a pickled copy
+    with img_buffer.to_shared() as stack_handle:
+        data = Parallel(n_jobs=N_JOBS, verbose=0)(delayed(process_image)(algorithm, stack_handle, metadata) for algorithm in ACTIVE_FIRE_ALGORITHMS)
     for d in data:
         d['grid_name'] = grid_name
         d['timestamp'] = timestamp
@@ -120,7 +167,44 @@ def check_fire_in_tile(tiff_path, metadata):
     
     return total_fire_pixels
 
+def triage_fire_in_tile(tiff_path, metadata, extension='tif'):
+    band_files = get_band_files(tiff_path, extension)
+
+    file_name = os.path.basename(band_files[12])
+    file_name = file_name.split('_')
+    
+    grid_name = file_name[0]
+    timestamp = file_name[1]
+
+    start_time = time.time()
+    try:
+        algorithms = {algorithm['method']: ActiveFireIndex(algorithm['method']).algorithm for algorithm in ACTIVE_FIRE_ALGORITHMS}
+        result = triage_tile(band_files, algorithms, metadata=metadata)
+    except Exception as e:
+        print('[ERROR] Triage: {} - {}'.format(tiff_path, e))
+        return None
+    end_time = time.time()
+
+    print('[INFO] Triage {}: {}/{} candidate blocks, {} evaluated'.format(grid_name, result['num_candidate_blocks'], result['num_blocks'], result['num_evaluated_blocks']))
+
+    with open(OUTPUT_CSV, 'a+') as out:
+        writer = csv.DictWriter(out, fieldnames=['method', 'num_fire_pixels', 'grid_name', 'timestamp', 'tmp_path', 'delta_time'])
+        writer.writerow({
+            'method': result['method'] if result['has_fire'] else 'triage',
+            'num_fire_pixels': result['num_fire_pixels'],
+            'grid_name': grid_name,
+            'timestamp': timestamp,
+            'tmp_path': tiff_path,
+            'delta_time': (end_time - start_time),
+        })
+
+    return result['num_fire_pixels']
+
+
 def process_image(algorithm, img_buffer, metadata):
+    if isinstance(img_buffer, SharedStackHandle):
+        img_buffer = img_buffer.attach()
+
     afi = ActiveFireIndex(algorithm['method'])
     start_time = time.time()
     mask = afi.transform(buffered_stack=img_buffer, metadata=metadata)
@@ -239,71 +323,157 @@ def download_sentinel_band(file, band, download_path):
 
     return download_path
 
-def download_file(file):
-    
+def start_tile(file):
+    """Check if the tile must be processed and create the task with its paths.
+
+    Args:
+        file (str): url of the tile, without the band sufix
+
+    Returns:
+        dict: task with the tile information or None if the tile must be ignored
+    """
     tile_name = os.path.basename(file)
-    log_file = os.path.join(LOG_PATH, '{}.log'.format(tile_name))
     
     # Get the grid name. Ex: T01GEM
     grid_name = tile_name.split('_')[0] 
 
-    # Ignore if the tile has already been processed (log exists)
-    if os.path.exists(log_file):
-        content = ''
-        with open(log_file) as f:
-            content = f.read()
+    # The tile is claimed atomically. It is ignored if it has already been processed (or is being processed by another worker)
+    # or if there are another image of the grid with fire
+    status, changed = JOB_STORE.claim(tile_name, grid_name, url=file)
+    if status != STATUS_RUNNING:
+        if status == STATUS_TILE_FIRE and changed:
+            with open(OUTPUT_CSV, 'a+') as out:
+                writer = csv.writer(out)
+                writer.writerow(['Ignore', 'tile-file', 'tile found fire before']) 
+                
+        return None
 
-        # Save if it is a fire tile
-        if content.startswith('FIRE') or content.startswith('TILE-FIRE'):
-           FIRE_GRIDS.append(grid_name)
-        return
-    
+    tmp_dir = os.path.join(DOWNLOAD_PATH, tile_name, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
 
-    # Ignore if there are another image of the grid with fire
-    if grid_name in FIRE_GRIDS:
-        with open(log_file, 'w+') as f:
-            f.write('TILE-FIRE')
-        
+    return {
+        'file': file,
+        'tile_name': tile_name,
+        'grid_name': grid_name,
+        'tmp_dir': tmp_dir,
+    }
+
+
+def skip_fire_grid(task):
+    """Ignore a claimed tile if another tile of its grid found fire meanwhile (the pipeline processes several tiles of a
+    grid at the same time). The tile is marked as TILE-FIRE and its downloaded files are removed.
+
+    Returns:
+        bool: True if the tile must be ignored
+    """
+    if task['grid_name'] not in FIRE_GRIDS:
+        return False
+
+    if JOB_STORE.transition(task['tile_name'], (STATUS_RUNNING,), STATUS_TILE_FIRE):
         with open(OUTPUT_CSV, 'a+') as out:
             writer = csv.writer(out)
-            writer.writerow(['Ignore', 'tile-file', 'tile found fire before']) 
-                
-        return
+            writer.writerow(['Ignore', 'tile-file', 'tile found fire before'])
 
-    tmp_dir = os.path.join(DOWNLOAD_PATH, tile_name, 'tmp')
-    os.makedirs(tmp_dir, exist_ok=True)
+    remove_files([task.get('mtd_tl'), task.get('mtd_msi'), task.get('cloud_file')])
+    download_path = task.get('download_path')
+    if download_path is not None and os.path.exists(download_path):
+        shutil.rmtree(download_path, ignore_errors=True)
 
-    download_path = download_sentinel_bands(file, CLASSIFICATION_BANDS)
+    return True
 
-    if download_path is None:
-        with open(log_file, 'a+') as f:
-            f.write('ERROR')
-        return
-        
-    mtd_tl, mtd_msi = download_metadata(file)
+
+def download_classification_data(file):
+    """Download the classification bands and the metadata of the tile.
+
+    Args:
+        file (str): url of the tile, without the band sufix
+
+    Returns:
+        dict: task with the tile information or None if the tile must be ignored
+    """
+    task = start_tile(file)
+    if task is None:
+        return None
+
+    # The metadata is downloaded before the bands, so the granules without usable area are rejected
+    mtd_tl, mtd_msi = download_metadata(task['file'])
     if mtd_tl is None or mtd_msi is None:
-        with open(log_file, 'a+') as f:
-            f.write('ERROR')
-        raise Exception('Error with metadata: {}'.format(file))
-        
-    metadata = get_image_metadata(mtd_tl_xml=mtd_tl, mtd_msil_xml=mtd_msi)
+        JOB_STORE.set_status(task['tile_name'], STATUS_ERROR, message='Error downloading the metadata')
+        raise Exception('Error with metadata: {}'.format(task['file']))
+
+    task['cloud_file'] = None
+    if USABLE_AREA_THRESHOLD is not None:
+        task['cloud_file'] = download_mask_cloud(task['file'])
+        try:
+            usable, message = check_usable_area(mtd_tl, mtd_msi, task['cloud_file'], USABLE_AREA_THRESHOLD)
+        except Exception as e:
+            # The filter only saves downloads, so a metadata or cloud mask that can not be parsed does not reject the tile
+            print('[ERROR] Checking the usable area: {} - {}'.format(task['tile_name'], e))
+            usable = True
+
+        if not usable:
+            JOB_STORE.set_status(task['tile_name'], STATUS_REJECTED, message=message)
+            remove_files([mtd_tl, mtd_msi, task['cloud_file']])
+            return None
+
+    task['mtd_tl'] = mtd_tl
+    task['mtd_msi'] = mtd_msi
+    if skip_fire_grid(task):
+        return None
+
+    download_path = download_sentinel_bands(task['file'], CLASSIFICATION_BANDS)
 
-    convert_dir_jp2_to_tiff(download_path, tmp_dir, verbose=False)
-    num_fire_pixels = check_fire_in_tile(tmp_dir, metadata)
+    if download_path is None:
+        JOB_STORE.set_status(task['tile_name'], STATUS_ERROR, message='Error downloading the classification bands')
+        return None
+
+    task['download_path'] = download_path
+    task['metadata'] = get_image_metadata(mtd_tl_xml=mtd_tl, mtd_msil_xml=mtd_msi)
+
+    return task
+
+
+def detect_fire(task):
+    """Apply the active fire algorithms in the classification bands (read from the downloaded files).
+    The grid is registered as soon as the fire is found, so the tiles of the grid still in the pipeline are ignored.
+    """
+    if skip_fire_grid(task):
+        return None
+
+    task['num_fire_pixels'] = check_fire_in_tile(task['download_path'], task['metadata'])
+    if task['num_fire_pixels'] is not None and task['num_fire_pixels'] > 0:
+        FIRE_GRIDS.add(task['grid_name'])
+
+    return task
+
+
+def finish_tile(task):
+    """Download the remaining bands of the fire tiles, register the result and remove the temporary files.
+    """
+    file = task['file']
+    tile_name = task['tile_name']
+    tmp_dir = task['tmp_dir']
+    download_path = task['download_path']
+    mtd_tl = task['mtd_tl']
+    mtd_msi = task['mtd_msi']
+    num_fire_pixels = task['num_fire_pixels']
 
     if num_fire_pixels is not None and num_fire_pixels > 0:
         # Save 
-        FIRE_GRIDS.append(grid_name)
+        FIRE_GRIDS.add(task['grid_name'])
+        if SCHEDULER is not None:
+            SCHEDULER.boost_zone(task['grid_name'])
 
-        # Download the cloud mask
-        cloud_file = download_mask_cloud(file)
+        # Download the cloud mask (if not downloaded with the metadata)
+        cloud_file = task.get('cloud_file')
+        if cloud_file is None:
+            cloud_file = download_mask_cloud(file)
 
         # Download the missing bands
         download_path = download_sentinel_bands(file, NON_CLASSIFICATION_BANDS)
         
         if download_path is None:
-            with open(log_file, 'a+') as f:
-                f.write('ERROR')
+            JOB_STORE.set_status(tile_name, STATUS_ERROR, message='Error downloading the non classification bands')
             raise Exception('Error downloading: {}'.format(download_path))
 
         # Convert the bands to TIFF
@@ -317,26 +487,17 @@ def download_file(file):
                 file_name = os.path.basename(downloaded_file)
                 shutil.move(downloaded_file, os.path.join(OUTPUT_PATH, file_name))
 
-        with open(log_file, 'w+') as f:
-            f.write('FIRE {}'.format(num_fire_pixels))
+        JOB_STORE.set_status(tile_name, STATUS_FIRE, num_fire_pixels=int(num_fire_pixels))
 
     else:
-        # Remove the cloud mask file
-        # if cloud_file is not None and os.path.exists(cloud_file):
-        #     os.remove(cloud_file)
-
-        if mtd_tl is not None and os.path.exists(mtd_tl):
-            os.remove(mtd_tl)
-
-        if mtd_msi is not None and os.path.exists(mtd_msi):
-            os.remove(mtd_msi)
+        # Remove the metadata and the cloud mask files
+        remove_files([mtd_tl, mtd_msi, task.get('cloud_file')])
 
         # Register that the image was processed
-        with open(log_file, 'w+') as f:
-            if num_fire_pixels is None:
-                f.write('ERROR')
-            else:
-                f.write('NO-FIRE')
+        if num_fire_pixels is None:
+            JOB_STORE.set_status(tile_name, STATUS_ERROR, message='Images with different shapes')
+        else:
+            JOB_STORE.set_status(tile_name, STATUS_NO_FIRE, num_fire_pixels=0)
 
     # Delete the temporary files
     try:
@@ -344,6 +505,54 @@ def download_file(file):
             shutil.rmtree(download_path)
     except:
         pass
+
+    return task
+
+
+def remove_files(files):
+    for file_path in files:
+        if file_path is not None and os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def download_file(file):
+    """Process a tile sequentially: download, detect the fire and download the remaining bands if needed.
+    """
+    task = download_classification_data(file)
+    if task is None:
+        return
+
+    task = detect_fire(task)
+    finish_tile(task)
+
+
+def download_tile_files(files):
+    """Process the files of a tile (grid) sequentially, so the grid is ignored after the first fire is found.
+    """
+    for file in files:
+        download_file(file)
+
+
+def download_files_pipeline(files):
+    """Process the tiles in a staged pipeline. The download and the fire detection of different tiles overlap.
+    Each stage has its own pool of workers (see PIPELINE_WORKERS).
+
+    Args:
+        files (list): url of the tiles, without the band sufix
+
+    Returns:
+        list: statistics of each stage
+    """
+    pipeline = StagedPipeline([
+        Stage('download', download_classification_data, PIPELINE_WORKERS['download'], PIPELINE_QUEUE_SIZE),
+        Stage('detect', detect_fire, PIPELINE_WORKERS['detect'], PIPELINE_QUEUE_SIZE),
+        Stage('finish', finish_tile, PIPELINE_WORKERS['finish'], PIPELINE_QUEUE_SIZE),
+    ], report_interval=PIPELINE_REPORT_INTERVAL)
+
+    pipeline.run(files)
+
+    return pipeline.get_stats()
+
         
 if __name__ == '__main__':
 
@@ -352,6 +561,11 @@ if __name__ == '__main__':
     os.makedirs(OUTPUT_PATH, exist_ok=True)
     os.makedirs(LOG_PATH, exist_ok=True)
 
+    # Resume the previous executions: import the old log files and release the interrupted tiles
+    JOB_STORE.import_log_dir(LOG_PATH)
+    JOB_STORE.reset_interrupted((STATUS_RUNNING, STATUS_ERROR) if RETRY_ERRORS else (STATUS_RUNNING,))
+    print('[INFO] Tiles status: {}'.format(JOB_STORE.count_by_status()))
+
     df = pd.read_csv(INPUT_CSV,  sep=';')
 
 
@@ -363,15 +577,43 @@ if __name__ == '__main__':
         
     # Group by tile to avoid download two times the same spot (if fire were found)
     g = df.groupby('sp1').size()
-    for tile, count in tqdm(g.items(), total=len(g)):
+
+    fire_prior = None
+    if USE_SCHEDULER:
+        grid_biomes = None
+        if SENTINEL_GRID_FILE is not None and BIOMES_SHAPE_FILE is not None:
+            grid_biomes = get_grid_biomes(SENTINEL_GRID_FILE, BIOMES_SHAPE_FILE)
+        fire_prior = FirePrior.from_job_store(JOB_STORE, grid_biomes)
+
+    if USE_PIPELINE:
+        # Keep the tile order, the tiles of the same grid are processed close to each other
+        files = []
+        for tile, count in g.items():
+            df_tile = df[ df['sp1'] == tile ]
+            tile_files = [f for f in df_tile.url.unique() if str(f) != 'nan']
+            files.extend(sorted(tile_files))
+
+        if fire_prior is not None:
+            # The pipeline takes the tiles from the scheduler on demand, so the boosted tiles get ahead
+            SCHEDULER = TileScheduler(fire_prior)
+            SCHEDULER.extend(files)
+            files = SCHEDULER
+
+        download_files_pipeline(files)
+        sys.exit()
+
+    tiles_files = []
+    for tile, count in g.items():
         df_tile = df[ df['sp1'] == tile ]
 
         files = df_tile.url.unique()
         files = [f for f in files if str(f) != 'nan']
         files.sort()
-        
+        tiles_files.append(files)
 
-        for file in files:
-            download_file(file)
-            
-        # Parallel(n_jobs=N_JOBS, verbose=100)(delayed(download_file)(file) for file in files)
+    if fire_prior is not None:
+        # The grids with the highest prior first
+        tiles_files.sort(key=lambda files: -max([fire_prior.score(*parse_tile_name(f)) for f in files], default=0.0))
+
+    # The job store is shared by the workers, so the tiles can be processed in parallel
+    Parallel(n_jobs=N_TILE_JOBS, verbose=0)(delayed(download_tile_files)(files) for files in tqdm(tiles_files))
@@ -6,9 +6,11 @@ sys.path.append('../')
 import geopandas as gpd
 from datetime import datetime, timedelta  
 from image.downloader import SentinelDownloader
+from image.catalog import GranuleCatalog
 from image.converter import convert_dir_jp2_to_tiff, get_cloud_mask
 from image.sentinel import BufferedImageStack
 from active_fire.general import ActiveFireIndex
+from utils.scheduler import FirePrior, get_grid_biomes
 import os
 from glob import glob
 import shutil
@@ -26,11 +28,17 @@ OUTPUT_QI_DATA = '../../resources/images/qi_data/'
 
 TEMP_PATH = '../../resources/images/tmp/'
 
+# Local granule catalog (see utils/build_granule_catalog.py). Earth Engine is queried only if the catalog does not exist
+GRANULE_CATALOG_FILE = '../../resources/sentinel_grid/granule_catalog.sqlite'
+
 START_DATE = '2020-08-01' # date included
 END_DATE = '2020-09-01' # date NOT included
 
 KEEP_FIRE_ONLY = True
 
+# Process the grids in the order of the fire prior (biome and season, see utils.scheduler). Set to None to keep the grid order
+BIOMES_SHAPE_FILE = '../../resources/ecoregions/Ecoregions2017.shp'
+
 SENTINEL_BANDS = ('B01','B02','B03','B04', 'B05','B06','B07','B08','B8A', 'B09','B10','B11','B12')
 CLASSIFICATION_BANDS = ('B8A', 'B11', 'B12')
 NON_CLASSIFICATION_BANDS = tuple(set(SENTINEL_BANDS) - set(CLASSIFICATION_BANDS))
@@ -115,12 +123,22 @@ if __name__ == '__main__':
     
     print(f'Num. tiles: {len(gdf)}')
 
+    if BIOMES_SHAPE_FILE is not None:
+        fire_prior = FirePrior(grid_biomes=get_grid_biomes(SAMPLES_SENTINEL_LAND_GRID_GEODATAFRAME, BIOMES_SHAPE_FILE))
+        gdf['fire_prior'] = [fire_prior.score(name, start_date.strftime('%Y%m%dT000000')) for name in gdf['name']]
+        gdf = gdf.sort_values('fire_prior', ascending=False, kind='mergesort')
+
     bands_to_download = None
     if KEEP_FIRE_ONLY:
         bands_to_download = CLASSIFICATION_BANDS
     
     downloader = SentinelDownloader()
 
+    # Search the granules offline when the catalog is available
+    searcher = downloader
+    if GRANULE_CATALOG_FILE is not None and os.path.exists(GRANULE_CATALOG_FILE):
+        searcher = GranuleCatalog(GRANULE_CATALOG_FILE)
+
     for index, row in gdf.iterrows():    
    
         download_path = os.path.join(TEMP_PATH, row['name'], 'jp2')
@@ -131,11 +149,11 @@ if __name__ == '__main__':
         os.makedirs(tmp_tiff_path, exist_ok=True)
         os.makedirs(qi_data_path, exist_ok=True)
    
-        granules = downloader.search_tile_name(row['name']) \
+        granules = searcher.search_tile_name(row['name']) \
                     .search_dates(start_date, end_date) \
                     .get_granule_info()
 
-        downloader.clear_search()
+        searcher.clear_search()
 
         num_granules = len(granules)
         print(f'[INFO] Num. Found: {num_granules}')
@@ -0,0 +1,95 @@
+''' Rejection of the granules without usable area before the band download.
+The metadata (MTD_TL and MTD_MSIL1C) and the cloud mask (MSK_CLOUDS_B00.gml) are a few KB, while the classification
+bands are tens of MB. The usable area of the tile is the area covered by the product data (the footprint of the
+product, smaller than the tile at the edges of the swath) and not covered by clouds.
+'''
+import xml.etree.ElementTree as ET
+from shapely.geometry import box, shape, Polygon
+from shapely.ops import unary_union
+from rasterio.warp import transform_geom
+
+from image.converter import get_gml_geometry
+from utils.metadata import get_tile_geocoding, get_cloudy_pixel_percentage, get_product_footprint
+
+# Minimum fraction of the tile with data and without clouds
+USABLE_AREA_THRESHOLD = 0.05
+
+
+def get_tile_box(geocoding):
+    return box(
+        geocoding['ulx'],
+        geocoding['uly'] - geocoding['nrows'] * geocoding['resolution'],
+        geocoding['ulx'] + geocoding['ncols'] * geocoding['resolution'],
+        geocoding['uly'],
+    )
+
+
+def get_cloud_geometry(cloud_gml):
+    """Get the union of the cloud polygons of the cloud mask (in the CRS of the tile).
+
+    Returns:
+        Geometry: clouds (empty if there are no clouds) or None if the mask can not be read
+    """
+    try:
+        geometries = get_gml_geometry(cloud_gml)
+    except Exception as e:
+        print('[ERROR] Reading the cloud mask: {} - {}'.format(cloud_gml, e))
+        return None
+
+    if geometries is None:
+        # The mask of a granule without clouds has no features
+        return Polygon()
+
+    return unary_union([shape(geometry) for geometry in geometries]).buffer(0)
+
+
+def get_usable_area(mtd_tl, mtd_msil, cloud_gml=None):
+    """Compute the fractions of the tile without data, with clouds and usable.
+    The clouds are read from the cloud mask. Without it, the cloudy pixel percentage of the tile metadata is used.
+
+    Args:
+        mtd_tl (str): tile metadata (MTD_TL.xml)
+        mtd_msil (str): product metadata (MTD_MSIL1C.xml)
+        cloud_gml (str, optional): cloud mask (MSK_CLOUDS_B00.gml). Defaults to None.
+
+    Returns:
+        dict: nodata_fraction, cloud_fraction and usable_fraction (of the tile area)
+    """
+    geocoding = get_tile_geocoding(ET.parse(mtd_tl))
+    tile = get_tile_box(geocoding)
+
+    data = tile
+    footprint = get_product_footprint(ET.parse(mtd_msil))
+    if footprint is not None:
+        footprint = transform_geom('EPSG:4326', geocoding['crs'], Polygon(footprint).__geo_interface__)
+        data = tile.intersection(shape(footprint).buffer(0))
+
+    data_fraction = data.area / tile.area
+
+    clouds = get_cloud_geometry(cloud_gml) if cloud_gml is not None else None
+    if clouds is not None:
+        cloud_fraction = data.intersection(clouds).area / tile.area
+    else:
+        # The percentage of the metadata is relative to the data pixels
+        cloudy_pixel_percentage = get_cloudy_pixel_percentage(ET.parse(mtd_tl))
+        cloud_fraction = data_fraction * (cloudy_pixel_percentage or 0.0) / 100.0
+
+    return {
+        'nodata_fraction': 1.0 - data_fraction,
+        'cloud_fraction': cloud_fraction,
+        'usable_fraction': max(data_fraction - cloud_fraction, 0.0),
+    }
+
+
+def check_usable_area(mtd_tl, mtd_msil, cloud_gml=None, threshold=USABLE_AREA_THRESHOLD):
+    """Check if a granule has enough usable area to be downloaded.
+
+    Returns:
+        tuple(bool, str): if the granule is usable and the message with the fractions
+    """
+    usable_area = get_usable_area(mtd_tl, mtd_msil, cloud_gml)
+    message = 'Usable: {:.3f} (no data: {:.3f}, clouds: {:.3f}, threshold: {:.3f})'.format(
+        usable_area['usable_fraction'], usable_area['nodata_fraction'], usable_area['cloud_fraction'], threshold
+    )
+
+    return usable_area['usable_fraction'] >= threshold, message
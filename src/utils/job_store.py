@@ -0,0 +1,285 @@
+''' SQLite store of the tile processing jobs.
+Replaces the per-tile log files. The status transitions are atomic, so several processes can share the same store.
+'''
+import sqlite3
+import threading
+import os
+import time
+from glob import glob
+
+
+STATUS_PENDING = 'PENDING'
+STATUS_RUNNING = 'RUNNING'
+STATUS_FIRE = 'FIRE'
+STATUS_TILE_FIRE = 'TILE-FIRE'
+STATUS_NO_FIRE = 'NO-FIRE'
+STATUS_ERROR = 'ERROR'
+# Granule without enough usable area (no data or clouds), rejected before the band download
+STATUS_REJECTED = 'REJECTED'
+
+# Status of the jobs that do not need to be processed again
+FINAL_STATUSES = (STATUS_FIRE, STATUS_TILE_FIRE, STATUS_NO_FIRE, STATUS_REJECTED)
+
+
+class JobStore:
+
+    def __init__(self, database_file, timeout=60.0) -> None:
+        """Store of the jobs status. Each process (and thread) opens its own connection, so the store can be sent to the workers.
+
+        Args:
+            database_file (str): SQLite file
+            timeout (float, optional): time (seconds) waiting for a lock before failing. Defaults to 60.0.
+        """
+        self.database_file = database_file
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __getstate__(self):
+        return {'database_file': self.database_file, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.database_file = state['database_file']
+        self.timeout = state['timeout']
+        self.local = threading.local()
+
+    def get_connection(self):
+        """Get the connection of the current process and thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            # Transactions are handled explicitly (BEGIN IMMEDIATE)
+            connection = sqlite3.connect(self.database_file, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.create_tables(connection)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return connection
+
+    def create_tables(self, connection):
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                tile_name TEXT PRIMARY KEY,
+                grid_name TEXT NOT NULL,
+                url TEXT,
+                status TEXT NOT NULL,
+                num_fire_pixels INTEGER,
+                message TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS idx_jobs_grid ON jobs (grid_name);
+            CREATE TABLE IF NOT EXISTS fire_grids (
+                grid_name TEXT PRIMARY KEY
+            );
+        ''')
+
+    def transaction(self):
+        """Start a write transaction. The lock is taken immediately, so the reads inside the transaction are consistent.
+        """
+        return Transaction(self.get_connection())
+
+    def claim(self, tile_name, grid_name, url=None):
+        """Try to start the processing of a tile. The operation is atomic.
+        If the grid already has fire, the tile is marked as TILE-FIRE and it is not claimed.
+
+        Args:
+            tile_name (str): tile name (file name without the band sufix). Ex: T01GEM_20200801T221941
+            grid_name (str): grid name. Ex: T01GEM
+            url (str, optional): url of the tile. Defaults to None.
+
+        Returns:
+            tuple(str, bool): status of the tile (RUNNING if it was claimed by the caller) and if the status was changed by this call
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO jobs (tile_name, grid_name, url, status, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (tile_name, grid_name, url, STATUS_PENDING, time.time())
+            )
+            status = connection.execute('SELECT status FROM jobs WHERE tile_name = ?', (tile_name,)).fetchone()[0]
+            if status != STATUS_PENDING:
+                return status, False
+
+            grid_has_fire = connection.execute('SELECT 1 FROM fire_grids WHERE grid_name = ?', (grid_name,)).fetchone() is not None
+            status = STATUS_TILE_FIRE if grid_has_fire else STATUS_RUNNING
+            connection.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE tile_name = ?', (status, time.time(), tile_name))
+
+        return status, True
+
+    def transition(self, tile_name, from_statuses, to_status, num_fire_pixels=None, message=None):
+        """Change the status of a tile if its current status is one of from_statuses.
+
+        Returns:
+            bool: True if the status was changed
+        """
+        placeholders = ', '.join('?' * len(from_statuses))
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, num_fire_pixels = ?, message = ?, updated_at = ? WHERE tile_name = ? AND status IN ({})'.format(placeholders),
+                (to_status, num_fire_pixels, message, time.time(), tile_name, *from_statuses)
+            )
+
+        return cursor.rowcount == 1
+
+    def set_status(self, tile_name, status, num_fire_pixels=None, message=None):
+        """Set the status of a tile. A fire status also registers the grid as a fire grid in the same transaction.
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, num_fire_pixels = ?, message = ?, updated_at = ? WHERE tile_name = ?',
+                (status, num_fire_pixels, message, time.time(), tile_name)
+            )
+            if status == STATUS_FIRE:
+                connection.execute(
+                    'INSERT OR IGNORE INTO fire_grids (grid_name) SELECT grid_name FROM jobs WHERE tile_name = ?', (tile_name,)
+                )
+
+    def get_status(self, tile_name):
+        row = self.get_connection().execute('SELECT status FROM jobs WHERE tile_name = ?', (tile_name,)).fetchone()
+        if row is None:
+            return None
+
+        return row[0]
+
+    def get_tiles(self, statuses):
+        """Get the name of the tiles with some status.
+
+        Args:
+            statuses (tuple): status of the tiles
+
+        Returns:
+            list: tile names
+        """
+        placeholders = ', '.join('?' * len(statuses))
+        rows = self.get_connection().execute('SELECT tile_name FROM jobs WHERE status IN ({}) ORDER BY tile_name'.format(placeholders), tuple(statuses))
+
+        return [row[0] for row in rows]
+
+    def get_grid_history(self):
+        """Get the results of the tiles checked for fire of each grid (the TILE-FIRE tiles are not checked).
+
+        Returns:
+            dict: number of tiles checked, with fire and fire pixels of each grid
+        """
+        rows = self.get_connection().execute(
+            'SELECT grid_name, COUNT(*), SUM(status = ?), COALESCE(SUM(num_fire_pixels), 0) FROM jobs WHERE status IN (?, ?) GROUP BY grid_name',
+            (STATUS_FIRE, STATUS_FIRE, STATUS_NO_FIRE)
+        )
+
+        return {row[0]: {'num_tiles': row[1], 'num_fire_tiles': row[2], 'num_fire_pixels': row[3]} for row in rows}
+
+    def count_by_status(self):
+        rows = self.get_connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+
+        return dict(rows.fetchall())
+
+    def reset_interrupted(self, statuses=(STATUS_RUNNING,)):
+        """Release the tiles of an interrupted execution, so they are processed again.
+        Must be called before the workers start.
+
+        Args:
+            statuses (tuple, optional): status of the tiles to release. Defaults to (RUNNING,).
+
+        Returns:
+            int: number of tiles released
+        """
+        placeholders = ', '.join('?' * len(statuses))
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, updated_at = ? WHERE status IN ({})'.format(placeholders), (STATUS_PENDING, time.time(), *statuses)
+            )
+
+        return cursor.rowcount
+
+    def import_log_dir(self, log_path):
+        """Import the status of the tiles from the old log files ({tile_name}.log).
+        The tiles already in the store are not changed.
+
+        Args:
+            log_path (str): directory with the log files
+
+        Returns:
+            int: number of tiles imported
+        """
+        num_imported = 0
+        with self.transaction() as connection:
+            for log_file in glob(os.path.join(log_path, '*.log')):
+                tile_name = os.path.basename(log_file)[:-len('.log')]
+                grid_name = tile_name.split('_')[0]
+
+                with open(log_file) as f:
+                    content = f.read()
+
+                num_fire_pixels = None
+                if content.startswith('FIRE'):
+                    status = STATUS_FIRE
+                    num_fire_pixels = int(content.split()[1])
+                elif content.startswith('TILE-FIRE'):
+                    status = STATUS_TILE_FIRE
+                elif content.startswith('NO-FIRE'):
+                    status = STATUS_NO_FIRE
+                else:
+                    status = STATUS_ERROR
+
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO jobs (tile_name, grid_name, status, num_fire_pixels, updated_at) VALUES (?, ?, ?, ?, ?)',
+                    (tile_name, grid_name, status, num_fire_pixels, os.path.getmtime(log_file))
+                )
+                num_imported += cursor.rowcount
+
+                if status in (STATUS_FIRE, STATUS_TILE_FIRE):
+                    connection.execute('INSERT OR IGNORE INTO fire_grids (grid_name) VALUES (?)', (grid_name,))
+
+        return num_imported
+
+
+class FireGridRegistry:
+
+    def __init__(self, job_store : JobStore) -> None:
+        """Set of the grids with fire, shared by all workers of the job store.
+
+        Args:
+            job_store (JobStore): store where the grids are saved
+        """
+        self.job_store = job_store
+
+    def add(self, grid_name):
+        self.job_store.get_connection().execute('INSERT OR IGNORE INTO fire_grids (grid_name) VALUES (?)', (grid_name,))
+
+    def append(self, grid_name):
+        """Same as add. Keeps the interface of the old FIRE_GRIDS list
+        """
+        self.add(grid_name)
+
+    def discard(self, grid_name):
+        self.job_store.get_connection().execute('DELETE FROM fire_grids WHERE grid_name = ?', (grid_name,))
+
+    def __contains__(self, grid_name):
+        row = self.job_store.get_connection().execute('SELECT 1 FROM fire_grids WHERE grid_name = ?', (grid_name,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.job_store.get_connection().execute('SELECT COUNT(*) FROM fire_grids').fetchone()[0]
+
+    def __iter__(self):
+        rows = self.job_store.get_connection().execute('SELECT grid_name FROM fire_grids ORDER BY grid_name').fetchall()
+        return iter([row[0] for row in rows])
+
+
+class Transaction:
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+        return False
@@ -54,3 +54,45 @@ def get_metadata_msil(xml_tree):
         reflectance_conversion[child.attrib['physicalBand']] = child.attrib['bandId']
 
     return reflectance_conversion
+
+def get_tile_geocoding(xml_tree, resolution=20):
+    """Get the geocoding of the tile (MTD_TL) in a resolution.
+
+    Returns:
+        dict: crs (ex: EPSG:32633), ulx, uly, nrows, ncols and resolution of the tile
+    """
+    root_xml = xml_tree.getroot()
+    geocoding = {'resolution': resolution}
+
+    for child in root_xml.iter('HORIZONTAL_CS_CODE'):
+        geocoding['crs'] = child.text
+
+    for child in root_xml.iter('Size'):
+        if int(child.attrib['resolution']) == resolution:
+            geocoding['nrows'] = int(child.find('NROWS').text)
+            geocoding['ncols'] = int(child.find('NCOLS').text)
+
+    for child in root_xml.iter('Geoposition'):
+        if int(child.attrib['resolution']) == resolution:
+            geocoding['ulx'] = float(child.find('ULX').text)
+            geocoding['uly'] = float(child.find('ULY').text)
+
+    return geocoding
+
+def get_cloudy_pixel_percentage(xml_tree):
+    """Get the cloudy pixel percentage of the tile (MTD_TL) or None if not informed
+    """
+    for child in xml_tree.getroot().iter('CLOUDY_PIXEL_PERCENTAGE'):
+        return float(child.text)
+
+    return None
+
+def get_product_footprint(xml_tree):
+    """Get the footprint of the product data (MTD_MSIL1C) as a list of (lon, lat) coordinates
+    """
+    for child in xml_tree.getroot().iter('EXT_POS_LIST'):
+        values = [float(value) for value in child.text.split()]
+        # The positions are lat lon pairs
+        return list(zip(values[1::2], values[0::2]))
+
+    return None
@@ -0,0 +1,209 @@
+''' Staged producer/consumer pipeline.
+Each stage has its own pool of worker threads and a bounded input queue, so the stages overlap across items
+(ex: the network download of an image while the previous one is decoded and the one before it is classified).
+The blocking I/O (requests, GDAL) and most of the numpy operations release the GIL, so threads are enough to overlap them.
+'''
+import threading
+import queue
+import time
+import traceback
+
+
+# Marks the end of the items in a queue
+END_OF_QUEUE = object()
+
+
+class Stage:
+
+    def __init__(self, name, function, num_workers=1, queue_size=4) -> None:
+        """Pipeline stage.
+        The function receives an item and returns the item to the next stage. If the function returns None the item is dropped.
+
+        Args:
+            name (str): stage name, used in the reports
+            function (callable): function applied to each item
+            num_workers (int, optional): number of worker threads. Defaults to 1.
+            queue_size (int, optional): maximum number of items waiting in the input queue. Defaults to 4.
+        """
+        self.name = name
+        self.function = function
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.reset()
+
+    def reset(self):
+        self.input_queue = queue.Queue(maxsize=self.queue_size)
+        self.lock = threading.Lock()
+        self.active_workers = self.num_workers
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+
+    def put(self, item):
+        self.input_queue.put(item)
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.input_queue.qsize())
+
+    def register(self, busy_time, dropped=False, failed=False):
+        with self.lock:
+            self.processed += 1
+            self.busy_time += busy_time
+            if dropped:
+                self.dropped += 1
+            if failed:
+                self.failed += 1
+
+    def get_stats(self, elapsed_time):
+        """Get the stage statistics.
+
+        Args:
+            elapsed_time (float): time since the pipeline started (seconds)
+
+        Returns:
+            dict: stage statistics
+        """
+        with self.lock:
+            elapsed_time = max(elapsed_time, 1e-9)
+            return {
+                'stage': self.name,
+                'num_workers': self.num_workers,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'throughput': self.processed / elapsed_time,
+                'utilization': self.busy_time / (elapsed_time * self.num_workers),
+                'mean_time': self.busy_time / self.processed if self.processed > 0 else 0.0,
+                'queue_depth': self.input_queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+
+class StagedPipeline:
+
+    def __init__(self, stages, report_interval=None, verbose=True) -> None:
+        """Pipeline of stages connected by bounded queues.
+
+        Args:
+            stages (list): list of Stage
+            report_interval (float, optional): interval (seconds) between the progress reports. Defaults to None (no report while running).
+            verbose (bool, optional): print the errors and the reports. Defaults to True.
+        """
+        self.stages = stages
+        self.report_interval = report_interval
+        self.verbose = verbose
+        self.results = []
+        self.start_time = None
+        self.end_time = None
+
+    def run(self, items):
+        """Feed the items to the first stage and wait until all stages have finished.
+
+        Args:
+            items (iterable): items to process
+
+        Returns:
+            list: items returned by the last stage (the order is not preserved)
+        """
+        self.results = []
+        for stage in self.stages:
+            stage.reset()
+
+        self.start_time = time.time()
+        self.end_time = None
+
+        workers = []
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.num_workers):
+                worker = threading.Thread(target=self.work, args=(stage, next_stage), daemon=True)
+                worker.start()
+                workers.append(worker)
+
+        finished = threading.Event()
+        reporter = None
+        if self.report_interval is not None:
+            reporter = threading.Thread(target=self.report_periodically, args=(finished,), daemon=True)
+            reporter.start()
+
+        # The first queue is bounded, so the items are produced on demand
+        first_stage = self.stages[0]
+        for item in items:
+            first_stage.put(item)
+
+        for _ in range(first_stage.num_workers):
+            first_stage.put(END_OF_QUEUE)
+
+        for worker in workers:
+            worker.join()
+
+        self.end_time = time.time()
+        finished.set()
+        if reporter is not None:
+            reporter.join()
+
+        if self.verbose:
+            self.report()
+
+        return self.results
+
+    def work(self, stage, next_stage):
+        while True:
+            item = stage.input_queue.get()
+            if item is END_OF_QUEUE:
+                break
+
+            start_time = time.time()
+            result = None
+            failed = False
+            try:
+                result = stage.function(item)
+            except Exception:
+                failed = True
+                if self.verbose:
+                    print('[ERROR] Stage {}: {}'.format(stage.name, traceback.format_exc()))
+
+            stage.register(time.time() - start_time, dropped=(result is None and not failed), failed=failed)
+
+            if result is None:
+                continue
+
+            if next_stage is None:
+                with stage.lock:
+                    self.results.append(result)
+            else:
+                next_stage.put(result)
+
+        # The last worker of the stage finishes the next stage
+        with stage.lock:
+            stage.active_workers -= 1
+            last_worker = stage.active_workers == 0
+
+        if last_worker and next_stage is not None:
+            for _ in range(next_stage.num_workers):
+                next_stage.put(END_OF_QUEUE)
+
+    def get_stats(self):
+        """Get the statistics of each stage.
+
+        Returns:
+            list: statistics (dict) of each stage
+        """
+        if self.start_time is None:
+            return []
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+        elapsed_time = end_time - self.start_time
+
+        return [stage.get_stats(elapsed_time) for stage in self.stages]
+
+    def report(self):
+        for stats in self.get_stats():
+            print('[INFO] {stage}: workers={num_workers} processed={processed} dropped={dropped} failed={failed} '
+                  'throughput={throughput:.3f}/s mean_time={mean_time:.2f}s utilization={utilization:.0%} '
+                  'queue={queue_depth} max_queue={max_queue_depth}'.format(**stats))
+
+    def report_periodically(self, finished):
+        while not finished.wait(self.report_interval):
+            self.report()
@@ -0,0 +1,265 @@
+''' Scheduling of the tiles by the prior probability of fire.
+The tiles are processed in the order of a fire prior, so the tiles with fire (and the grids skipped after the first fire)
+are found early in a campaign. The prior combines:
+- history: fire rate of the grid in the tiles already checked (job store), smoothed for the grids with few tiles
+- biome: the biomes with a specific detector (BIOME_TO_AFD_MAP) are the fire prone ones
+- season: distance of the acquisition month to the peak of the fire (dry) season of the latitude
+The queue is lazy: the tiles are taken one at a time (ex: by a StagedPipeline), so the pending tiles can be reprioritized.
+When a fire is found the pending tiles of the same grid zone (ex: 33T) are boosted and get ahead of the others.
+'''
+import re
+import heapq
+import threading
+import numpy as np
+import geopandas as gpd
+
+from active_fire.biome import BIOME_TO_AFD_MAP
+
+PRIOR_WEIGHTS = {'history': 0.5, 'biome': 0.25, 'season': 0.25}
+# Pseudo count of the history (grids with few tiles checked stay close to the prior of the other components)
+HISTORY_PSEUDO_COUNT = 2.0
+
+FIRE_BIOME_PRIOR = 1.0
+OTHER_BIOME_PRIOR = 0.25
+UNKNOWN_BIOME_PRIOR = 0.5
+
+# Peak month of the fire season by latitude range: (min latitude, max latitude, month)
+SEASON_PEAK_MONTHS = [
+    (-90.0, -23.5, 1),
+    (-23.5, 0.0, 9),
+    (0.0, 23.5, 2),
+    (23.5, 90.0, 8),
+]
+
+# Score added to the pending tiles of a grid zone when a fire is found
+ZONE_BOOST = 0.5
+
+# MGRS latitude bands (8 degrees from -80, without I and O)
+LATITUDE_BANDS = 'CDEFGHJKLMNPQRSTUVWX'
+
+
+def parse_tile_name(tile_name):
+    """Get the grid name and the timestamp of a tile (<grid>_<timestamp>). Ex: T01GEM_20200801T221941
+
+    Returns:
+        tuple(str, str): grid name (ex: T01GEM) and timestamp (None if not in the name)
+    """
+    name_parts = tile_name.split('/')[-1].split('_')
+    timestamp = name_parts[1] if len(name_parts) > 1 else None
+
+    return name_parts[0], timestamp
+
+
+def get_grid_zone(grid_name):
+    """Get the grid zone (UTM zone and latitude band) of a grid. Ex: T33TWN -> 33T
+    """
+    match = re.match(r'T?(\d{1,2}[C-X])', grid_name.upper())
+    return match.group(1).zfill(3) if match is not None else None
+
+
+def get_grid_latitude(grid_name):
+    """Get the latitude of the center of the latitude band of a grid.
+    """
+    grid_zone = get_grid_zone(grid_name)
+    if grid_zone is None:
+        return None
+
+    return -80.0 + 8.0 * LATITUDE_BANDS.index(grid_zone[-1]) + 4.0
+
+
+def get_season_prior(grid_name, timestamp):
+    """Prior of the season: 1 in the peak month of the fire season of the latitude and 0 six months later.
+    """
+    latitude = get_grid_latitude(grid_name)
+    if latitude is None or timestamp is None:
+        return 0.5
+
+    month = int(timestamp[4:6])
+    for min_latitude, max_latitude, peak_month in SEASON_PEAK_MONTHS:
+        if min_latitude <= latitude < max_latitude:
+            return 0.5 * (1.0 + np.cos(2.0 * np.pi * (month - peak_month) / 12.0))
+
+    return 0.5
+
+
+def get_biome_prior(biome):
+    if biome is None or biome not in BIOME_TO_AFD_MAP:
+        return UNKNOWN_BIOME_PRIOR
+
+    return FIRE_BIOME_PRIOR if BIOME_TO_AFD_MAP[biome] != '' else OTHER_BIOME_PRIOR
+
+
+def get_grid_biomes(grid_file, biome_shape_file, biome_column_name='BIOME_NAME'):
+    """Get the biome of the center of each grid.
+
+    Args:
+        grid_file (str): sentinel grid (see utils/continents_grid.py)
+        biome_shape_file (str): shapefile of the biomes
+        biome_column_name (str, optional): column with the biome name. Defaults to 'BIOME_NAME'.
+
+    Returns:
+        dict: biome of each grid name (ex: 33TWN)
+    """
+    gdf_grid = gpd.read_parquet(grid_file) if grid_file.endswith('.parquet') else gpd.read_file(grid_file)
+    gdf_grid = gdf_grid.drop_duplicates('name')
+    gdf_biomes = gpd.read_file(biome_shape_file)[[biome_column_name, 'geometry']]
+
+    centers = gpd.GeoDataFrame({'name': gdf_grid['name'].values}, geometry=gdf_grid.geometry.representative_point().values, crs=gdf_grid.crs)
+    if gdf_biomes.crs is not None and centers.crs is not None and gdf_biomes.crs != centers.crs:
+        gdf_biomes = gdf_biomes.to_crs(centers.crs)
+
+    joined = gpd.sjoin(centers, gdf_biomes, how='inner', predicate='within').drop_duplicates('name')
+
+    return dict(zip(joined['name'], joined[biome_column_name]))
+
+
+class FirePrior:
+
+    def __init__(self, history=None, grid_biomes=None, weights=PRIOR_WEIGHTS) -> None:
+        """Prior probability of fire of a tile.
+
+        Args:
+            history (dict, optional): results of each grid (see JobStore.get_grid_history). Defaults to None.
+            grid_biomes (dict, optional): biome of each grid (see get_grid_biomes). Defaults to None.
+            weights (dict, optional): weights of the history, biome and season priors. Defaults to PRIOR_WEIGHTS.
+        """
+        self.history = history if history is not None else {}
+        self.grid_biomes = grid_biomes if grid_biomes is not None else {}
+        self.weights = weights
+
+    @classmethod
+    def from_job_store(cls, job_store, grid_biomes=None, weights=PRIOR_WEIGHTS):
+        return cls(job_store.get_grid_history(), grid_biomes, weights)
+
+    def get_history_prior(self, grid_name, default_prior):
+        """Fire rate of the grid, smoothed towards the default prior.
+        """
+        history = self.history.get(grid_name)
+        if history is None:
+            return default_prior
+
+        return (history['num_fire_tiles'] + HISTORY_PSEUDO_COUNT * default_prior) / (history['num_tiles'] + HISTORY_PSEUDO_COUNT)
+
+    def score(self, grid_name, timestamp=None):
+        """Score of a tile, between 0 and 1.
+
+        Args:
+            grid_name (str): grid name. Ex: T33TWN
+            timestamp (str, optional): timestamp of the acquisition. Ex: 20200801T221941. Defaults to None.
+
+        Returns:
+            float: fire prior of the tile
+        """
+        # The grid names of the land grid have no 'T' (tile) notation
+        biome_prior = get_biome_prior(self.grid_biomes.get(grid_name.upper()[-5:]))
+        season_prior = get_season_prior(grid_name, timestamp)
+        default_prior = (biome_prior + season_prior) / 2.0
+
+        return self.weights['history'] * self.get_history_prior(grid_name, default_prior) + \
+            self.weights['biome'] * biome_prior + \
+            self.weights['season'] * season_prior
+
+
+class TileScheduler:
+
+    def __init__(self, fire_prior : FirePrior, zone_boost=ZONE_BOOST) -> None:
+        """Priority queue of the tiles, ordered by the fire prior (the highest first).
+        The queue can be consumed by many threads while the priorities are changed (see boost_zone).
+
+        Args:
+            fire_prior (FirePrior): prior of the tiles
+            zone_boost (float, optional): score added to the pending tiles of a zone with fire. Defaults to ZONE_BOOST.
+        """
+        self.fire_prior = fire_prior
+        self.zone_boost = zone_boost
+        self.lock = threading.Lock()
+
+        self.heap = []
+        # Score of the pending tiles. The heap entries with another score are outdated (the tile was reprioritized)
+        self.scores = {}
+        self.zones = {}
+        self.boosted_zones = set()
+        self.counter = 0
+
+    def add(self, tile, grid_name=None, timestamp=None):
+        """Add a tile to the queue.
+
+        Args:
+            tile (str): tile (ex: url or tile name <grid>_<timestamp>)
+            grid_name (str, optional): grid name. Defaults to None (from the tile name).
+            timestamp (str, optional): timestamp of the acquisition. Defaults to None (from the tile name).
+        """
+        if grid_name is None:
+            grid_name, timestamp = parse_tile_name(tile)
+
+        grid_zone = get_grid_zone(grid_name)
+        score = self.fire_prior.score(grid_name, timestamp)
+        if grid_zone in self.boosted_zones:
+            score += self.zone_boost
+
+        with self.lock:
+            self.zones.setdefault(grid_zone, set()).add(tile)
+            self.push(tile, score)
+
+        return score
+
+    def extend(self, tiles):
+        for tile in tiles:
+            self.add(tile)
+
+    def push(self, tile, score):
+        self.scores[tile] = score
+        # The counter keeps the insertion order for the same score
+        heapq.heappush(self.heap, (-score, self.counter, tile))
+        self.counter += 1
+
+    def pop(self):
+        """Take the tile with the highest score.
+
+        Returns:
+            str: tile or None if the queue is empty
+        """
+        with self.lock:
+            while len(self.heap) > 0:
+                score, _, tile = heapq.heappop(self.heap)
+                if self.scores.get(tile) != -score:
+                    continue
+
+                del self.scores[tile]
+                return tile
+
+        return None
+
+    def boost_zone(self, grid_name):
+        """Move the pending tiles of the grid zone of a grid with fire ahead (once per zone).
+
+        Args:
+            grid_name (str): grid name with fire. Ex: T33TWN
+
+        Returns:
+            int: number of pending tiles boosted
+        """
+        grid_zone = get_grid_zone(grid_name)
+        with self.lock:
+            if grid_zone in self.boosted_zones:
+                return 0
+            self.boosted_zones.add(grid_zone)
+
+            pending = sorted(tile for tile in self.zones.get(grid_zone, ()) if tile in self.scores)
+            for tile in pending:
+                self.push(tile, self.scores[tile] + self.zone_boost)
+
+        return len(pending)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        """Consume the queue. The tiles added or boosted while iterating are taken into account.
+        """
+        while True:
+            tile = self.pop()
+            if tile is None:
+                return
+
+            yield tile